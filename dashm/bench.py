@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the data, training and inference hot paths, run against
+a synthetic git repo generated locally, so that results only depend
+on the code and the machine.
+
+    python -m dashm.bench                      # run, compare to baseline
+    python -m dashm.bench --save-baseline      # run, store as baseline
+
+Every benchmark reports a rate (higher is better) or a duration (lower
+is better), see `METRICS`. The results are written as JSON, and any
+metric more than `--tolerance` worse than in the stored baseline is
+reported as a regression, failing the run. The baseline records the
+machine and interpreter it was run with, and is not compared against
+on another: store one for every machine first.
+"""
+
+import os
+import sys
+import json
+import time
+import warnings
+import shutil
+import platform
+import subprocess as sp
+from pathlib import Path
+import argparse
+from typing import Union, Optional, List, Dict, Callable
+
+import numpy as np
+
+ROOT = Path(__file__).parents[1]
+BASELINE = Path(__file__).parent / 'bench-baseline.json'
+REPO_NAME = 'dashm-bench'
+
+# metric : (unit, higher is better)
+METRICS = {
+    'process_commits_per_sec': ('commits/s', True),
+    'load_samples_per_sec': ('samples/s', True),
+    'load_train_generator_samples_per_sec': ('samples/s', True),
+    'format_batch_samples_per_sec': ('samples/s', True),
+    'encode_batch_samples_per_sec': ('samples/s', True),
+    'train_steps_per_sec': ('steps/s', True),
+    'predict_cold_start_sec': ('s', False),
+    'predict_chars_per_sec': ('chars/s', True),
+}
+
+STAGES = ['process', 'load', 'train', 'predict']
+
+_WORDS = ['self', 'value', 'index', 'count', 'result', 'data', 'path',
+          'name', 'return', 'if', 'for', 'in', 'None', 'True', 'len',
+          'append', 'items', 'update', 'config', 'model', 'batch']
+_VERBS = ['Fix', 'Add', 'Remove', 'Update', 'Refactor', 'Speed up',
+          'Document', 'Rename', 'Simplify', 'Test']
+
+
+def _line(rng: np.random.RandomState) -> bytes:
+    words = rng.choice(_WORDS, size=rng.randint(2, 8))
+    indent = b'    ' * rng.randint(0, 4)
+    return indent + ' '.join(words).encode('ascii') + b'\n'
+
+
+def make_repo(path: Union[str, Path], n_commits: int=200,
+              diff_size: int=2000, n_files: int=20, seed: int=0) -> Path:
+    """
+    Create a git repo at `path` with a reproducible synthetic history,
+    written in a single `git fast-import` call.
+
+    Inputs
+    ------
+    path : str or Path-like
+        Folder of the new repo. Must not exist.
+    n_commits : int
+        Number of commits.
+    diff_size : int
+        Approximate number of changed bytes per commit.
+    n_files : int
+        Number of files the history is spread over.
+    seed : int
+        Seed of the generated content.
+
+    Returns
+    -------
+    path : Path
+    """
+    path = Path(path)
+    rng = np.random.RandomState(seed)
+    sp.check_call(['git', 'init', '-q', str(path)])
+
+    files = [[_line(rng) for _ in range(200)] for _ in range(n_files)]
+    stream = []  # type: List[bytes]
+    for i in range(n_commits):
+        # about half the changed bytes are added lines, half removed
+        n_changed = max(diff_size // 60, 1)
+        f = rng.randint(n_files)
+        start = rng.randint(len(files[f]))
+        files[f][start:start + n_changed] = [_line(rng)
+                                             for _ in range(n_changed)]
+        msg = '{} {} in {}\n'.format(rng.choice(_VERBS),
+                                     ' '.join(rng.choice(_WORDS, size=3)),
+                                     'file{}.py'.format(f)).encode('ascii')
+        content = b''.join(files[f])
+        stream += [
+            b'commit refs/heads/master\n',
+            'mark :{}\n'.format(i + 1).encode('ascii'),
+            'committer Bench <bench@example.com> {} +0000\n'
+            .format(1500000000 + 60 * i).encode('ascii'),
+            'data {}\n'.format(len(msg)).encode('ascii'), msg,
+        ]
+        if i:
+            stream.append('from :{}\n'.format(i).encode('ascii'))
+        stream += [
+            'M 100644 inline file{}.py\n'.format(f).encode('ascii'),
+            'data {}\n'.format(len(content)).encode('ascii'), content,
+            b'\n',
+        ]
+    sp.run(['git', 'fast-import', '--quiet'], input=b''.join(stream),
+           cwd=str(path), check=True)
+    sp.check_call(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'],
+                  cwd=str(path))
+    return path
+
+
+def _rate(count: float, seconds: float) -> float:
+    return count / max(seconds, 1e-9)
+
+
+def _best_time(fn: Callable[[], object], repeat: int=3) -> float:
+    """
+    The shortest of `repeat` timings of `fn()`, the least noisy
+    estimate of its cost.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_process(repo_path: Path) -> Dict[str, float]:
+    from .data.process_data import process
+
+    n_commits = int(sp.check_output(['git', 'rev-list', '--count', 'HEAD'],
+                                    cwd=str(repo_path)))
+    elapsed = _best_time(lambda: process(repo_path, incremental=False))
+    # every commit but the first is diffed against the previous one
+    return {'process_commits_per_sec': _rate(n_commits - 1, elapsed)}
+
+
+def bench_load(name: str, max_diff_len: int=200, max_msg_len: int=200,
+               n_samples: int=2000, batch_size: int=64
+               ) -> Dict[str, float]:
+    from .data.load import (load, load_train_generator, format_batch,
+                            encode_batch, open_corpus)
+
+    results = {}
+    x, y = load(name, 1.0, 'train', max_diff_len, max_msg_len)
+    results['load_samples_per_sec'] = _rate(len(x), _best_time(
+        lambda: load(name, 1.0, 'train', max_diff_len, max_msg_len)
+    ))
+
+    gen = load_train_generator(name, 1.0, max_diff_len, max_msg_len)
+
+    def generate():
+        for _ in range(n_samples):
+            next(gen)
+
+    results['load_train_generator_samples_per_sec'] = _rate(
+        n_samples, _best_time(generate)
+    )
+
+    n_batches = max(n_samples // batch_size, 1)
+    pairs = list(zip(x, y))
+    order = np.random.RandomState(0).randint(len(pairs),
+                                            size=(n_batches, batch_size))
+
+    def format_batches():
+        for indices in order:
+            format_batch([pairs[i] for i in indices], max_diff_len,
+                         max_msg_len)
+
+    results['format_batch_samples_per_sec'] = _rate(
+        order.size, _best_time(format_batches)
+    )
+
+    corpus = open_corpus(name)
+    diffs = [bytes(corpus.diff(i, max_diff_len)) for i in range(len(corpus))]
+    msgs = [bytes(corpus.msg(i, max_msg_len)) for i in range(len(corpus))]
+
+    def encode_batches():
+        for indices in order:
+            encode_batch([diffs[i] for i in indices],
+                         [msgs[i] for i in indices], max_diff_len,
+                         max_msg_len)
+
+    results['encode_batch_samples_per_sec'] = _rate(
+        order.size, _best_time(encode_batches)
+    )
+    return results
+
+
+def _saved_runs(saved_path: Path, name: str) -> List[Path]:
+    return sorted(saved_path.glob('*_' + name))
+
+
+def bench_train(name: str, saved_path: Path, steps: int=50
+                ) -> Dict[str, float]:
+    """
+    The training steps are timed as the difference between a run of
+    `steps + 2` steps and one of 2 steps, so that building the models
+    and loading the validation data are not counted. A first run warms
+    up tensorflow. The runs are saved in `saved_path`, not with the
+    real models.
+    """
+    from .models.train import train
+
+    durations = []
+    for n in [2, 2, steps + 2]:
+        start = time.perf_counter()
+        train(name, 0.9, steps_per_epoch=n, epochs=1, verbose=0,
+              saved_path=saved_path)
+        durations.append(time.perf_counter() - start)
+    return {'train_steps_per_sec': _rate(steps,
+                                         durations[2] - durations[1])}
+
+
+_COLD_START = '''
+import sys, time
+start = time.perf_counter()
+from dashm.models.predict import Predictor
+Predictor(sys.argv[1]).predict(b'diff', max_len=1)
+print(time.perf_counter() - start)
+'''
+
+
+def bench_predict(name: str, model_dir: str, n_diffs: int=20,
+                  max_len: int=100) -> Dict[str, float]:
+    """
+    The cold start is the time a new process takes to import the
+    predictor, load the model and predict one character.
+    """
+    from .data.load import open_corpus
+    from .models.predict import Predictor
+
+    out = sp.check_output([sys.executable, '-c', _COLD_START, model_dir],
+                          cwd=str(ROOT), stderr=sp.DEVNULL)
+    results = {'predict_cold_start_sec': float(out.split()[-1])}
+
+    corpus = open_corpus(name)
+    diffs = [bytes(corpus.diff(i)) for i in range(min(n_diffs, len(corpus)))]
+    # distinct diffs, so that the encoder states are never cached
+    predictor = Predictor(model_dir, cache_size=0)
+    chars = 0
+    start = time.perf_counter()
+    for diff in diffs:
+        # one decoder step per character, and per marker
+        chars += len(predictor.predict(diff, max_len)) + 2
+    results['predict_chars_per_sec'] = _rate(chars,
+                                             time.perf_counter() - start)
+    return results
+
+
+def _clean(name: str) -> None:
+    processed = ROOT / 'data/processed-repos' / name
+    shutil.rmtree(str(processed), ignore_errors=True)
+    try:
+        os.remove(str(processed) + '.dashm')
+    except FileNotFoundError:
+        pass
+
+
+def run(n_commits: int=200, diff_size: int=2000, train_steps: int=50,
+        stages: Optional[List[str]]=None, workdir: Optional[Path]=None
+        ) -> dict:
+    """
+    Generate the synthetic repo and run the benchmarks of `stages`
+    (default: all of `STAGES`) against it. The processed data and
+    trained models are removed afterwards.
+
+    Returns
+    -------
+    report : dict
+        "config" holds the arguments, "machine" describes where it
+        ran, and "results" maps the names in `METRICS` to values.
+    """
+    import tempfile
+
+    stages = STAGES if stages is None else stages
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError('Unknown stages {}, must be in {}'
+                         .format(sorted(unknown), STAGES))
+
+    results = {}  # type: Dict[str, float]
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        repo_path = make_repo(Path(tmp) / REPO_NAME, n_commits, diff_size)
+        saved_path = Path(tmp) / 'saved'
+        _clean(REPO_NAME)
+        try:
+            # every later stage needs the processed data
+            timed = bench_process(repo_path)
+            if 'process' in stages:
+                results.update(timed)
+            if 'load' in stages:
+                results.update(bench_load(REPO_NAME))
+            if 'train' in stages or 'predict' in stages:
+                train_results = bench_train(REPO_NAME, saved_path,
+                                            train_steps)
+                if 'train' in stages:
+                    results.update(train_results)
+            if 'predict' in stages:
+                model_dir = str(_saved_runs(saved_path, REPO_NAME)[-1])
+                results.update(bench_predict(REPO_NAME, model_dir))
+        finally:
+            _clean(REPO_NAME)
+
+    return {
+        'config': {'n_commits': n_commits, 'diff_size': diff_size,
+                   'train_steps': train_steps},
+        'machine': {'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'cpus': os.cpu_count()},
+        'results': results,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float=0.3
+            ) -> List[str]:
+    """
+    The regressions of `report` against `baseline`: every metric that
+    is more than a fraction `tolerance` worse than in the baseline.
+    None, with a warning, if the baseline was run on another machine
+    or interpreter, whose timings are not comparable.
+
+    Raises
+    ------
+    ValueError
+        If the two were not run with the same config.
+    """
+    if report['config'] != baseline['config']:
+        raise ValueError('The baseline was run with {}, not {}'
+                         .format(baseline['config'], report['config']))
+    if report.get('machine') != baseline.get('machine'):
+        warnings.warn('The baseline was run on {}, not {}. Not comparing,'
+                      ' store a baseline for this machine with'
+                      ' --save-baseline.'.format(baseline.get('machine'),
+                                                 report.get('machine')))
+        return []
+    regressions = []
+    for name, value in sorted(report['results'].items()):
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        unit, higher_is_better = METRICS[name]
+        if higher_is_better:
+            worse = value < base * (1 - tolerance)
+        else:
+            worse = value > base * (1 + tolerance)
+        if worse:
+            regressions.append('{}: {:.4g} {} (baseline {:.4g} {})'
+                               .format(name, value, unit, base, unit))
+    return regressions
+
+
+def _print_report(report: dict, baseline: Optional[dict]) -> None:
+    for name, value in sorted(report['results'].items()):
+        unit = METRICS[name][0]
+        line = '{:<40} {:>12.4g} {:<10}'.format(name, value, unit)
+        if baseline is not None and name in baseline['results']:
+            base = baseline['results'][name]
+            line += ' ({:+.1%} vs. baseline)'.format(value / base - 1)
+        print(line)
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description=('Benchmark the data, training and inference hot paths'
+                     ' on a synthetic git repo')
+    )
+    p.add_argument('--commits', type=int, default=200,
+                   help='Number of commits of the synthetic repo.')
+    p.add_argument('--diff-size', dest='diff_size', type=int, default=2000,
+                   help='Approximate number of changed bytes per commit.')
+    p.add_argument('--train-steps', dest='train_steps', type=int,
+                   default=50, help='Number of training steps timed.')
+    p.add_argument('--stages', type=str, default=','.join(STAGES),
+                   help=('Comma separated stages to benchmark, among'
+                         ' {}.'.format(', '.join(STAGES))))
+    p.add_argument('--output', type=str, default=None,
+                   help='Write the results as JSON to this file.')
+    p.add_argument('--baseline', type=str, default=str(BASELINE),
+                   help='JSON results to compare against.')
+    p.add_argument('--tolerance', type=float, default=0.3,
+                   help=('Fraction by which a metric may be worse than the'
+                         ' baseline before failing.'))
+    p.add_argument('--save-baseline', dest='save_baseline',
+                   action='store_true',
+                   help='Store the results as the new baseline.')
+
+    args = p.parse_args()
+
+    report = run(args.commits, args.diff_size, args.train_steps,
+                 [s for s in args.stages.split(',') if s])
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        _print_report(report, None)
+        return
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = None
+    _print_report(report, baseline)
+    if baseline is None:
+        print('No baseline at {}, nothing to compare to.'
+              .format(args.baseline))
+        return
+    regressions = compare(report, baseline, args.tolerance)
+    if regressions:
+        raise SystemExit('Regressions against the baseline:\n  '
+                         + '\n  '.join(regressions))
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
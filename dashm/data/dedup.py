@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+"""
+Utils to find duplicate commits in a processed repo.
+
+Cherry-picks, merges, reverts of reverts and vendored bumps produce
+many commits with the same diff and message. They inflate the corpus,
+and duplicates on both sides of the train/validation split leak
+validation data into training.
+
+`dedup` hashes every commit's normalized diff and message, and records
+in `<processed repo>/.dedup` one line per commit
+
+    <commit-hash> <content-hash> <canonical commit-hash>
+
+Commits sharing a content hash form a group, represented by a single
+canonical commit. With `near_duplicates`, groups whose diffs are
+similar enough (estimated by MinHash) are merged as well. The commit
+files are kept, `dashm.data.load` and `dashm.data.pack` only read the
+canonical commits, and assign them to training or validation by their
+content hash, see `dashm.data.load.split_indices`.
+"""
+
+import re
+import hashlib
+from pathlib import Path
+import argparse
+from typing import Union, Dict, Tuple, List, Iterable, Set
+
+import numpy as np
+
+from .humanify_git import humanify
+
+DEDUP = '.dedup'
+
+_INDEX_LINE = re.compile(rb'^index [0-9a-f]+\.\.[0-9a-f]+.*$', re.MULTILINE)
+_HUNK = re.compile(rb'^@@ [^@]* @@', re.MULTILINE)
+_TRAILING = re.compile(rb'[ \t\r]+$', re.MULTILINE)
+_CHERRY_PICK = re.compile(rb'^\(cherry picked from commit [0-9a-f]+\)$',
+                          re.MULTILINE)
+_SPACE = re.compile(rb'\s+')
+
+# MinHash permutations are (a * h + b) mod _PRIME, exact in uint64
+_PRIME = (1 << 31) - 1
+_ROWS = 4
+
+
+def normalize_diff(diff: bytes) -> bytes:
+    """
+    Remove what differs between copies of the same change: the blob
+    hashes of `index` lines, the line numbers of hunk headers, trailing
+    whitespace and blank lines.
+    """
+    diff = _INDEX_LINE.sub(b'', bytes(diff))
+    diff = _HUNK.sub(b'@@', diff)
+    diff = _TRAILING.sub(b'', diff)
+    return b'\n'.join(line for line in diff.split(b'\n') if line)
+
+
+def normalize_msg(msg: bytes) -> bytes:
+    """
+    Remove `(cherry picked from commit ...)` lines and collapse
+    whitespace.
+    """
+    msg = _CHERRY_PICK.sub(b'', bytes(msg))
+    return _SPACE.sub(b' ', msg).strip()
+
+
+def content_hash(diff: bytes, msg: bytes) -> str:
+    """
+    Hex digest of the normalized diff and message.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(normalize_diff(diff))
+    h.update(b'\0')
+    h.update(normalize_msg(msg))
+    return h.hexdigest()
+
+
+def minhash(diff: bytes, num_perm: int=64, seed: int=0) -> np.ndarray:
+    """
+    MinHash signature of the set of changed lines of the normalized
+    diff. The fraction of equal entries of two signatures estimates
+    the Jaccard similarity of the two sets.
+
+    Returns
+    -------
+    signature : numpy.ndarray
+        Length `num_perm` uint64 array, all `_PRIME` if the diff
+        changes no lines.
+    """
+    lines = {line for line in normalize_diff(diff).split(b'\n')
+             if line[:1] in (b'+', b'-')
+             and not line.startswith((b'+++', b'---'))}
+    if not lines:
+        return np.full(num_perm, _PRIME, dtype=np.uint64)
+    h = np.array([int.from_bytes(hashlib.blake2b(line, digest_size=4)
+                                 .digest(), 'little')
+                  for line in lines], dtype=np.uint64) % _PRIME
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, _PRIME, num_perm).astype(np.uint64)
+    b = rng.randint(0, _PRIME, num_perm).astype(np.uint64)
+    return ((a[:, None] * h[None, :] + b[:, None]) % _PRIME).min(axis=1)
+
+
+def _near_groups(signatures: np.ndarray, threshold: float
+                 ) -> List[List[int]]:
+    """
+    Connected components of the rows of `signatures` estimated to be
+    at least `threshold` similar. Candidates are the rows sharing a
+    band of `_ROWS` entries (locality sensitive hashing).
+    """
+    parent = list(range(len(signatures)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    empty = (signatures == _PRIME).all(axis=1)
+    for start in range(0, signatures.shape[1] - _ROWS + 1, _ROWS):
+        buckets = {}  # type: Dict[bytes, int]
+        for i, row in enumerate(signatures[:, start:start + _ROWS]):
+            if empty[i]:
+                continue
+            j = buckets.setdefault(row.tobytes(), i)
+            if j == i or find(i) == find(j):
+                continue
+            if (signatures[i] == signatures[j]).mean() >= threshold:
+                parent[find(i)] = find(j)
+
+    groups = {}  # type: Dict[int, List[int]]
+    for i in range(len(signatures)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def _resolve(repo_path: Union[str, Path]) -> Path:
+    repo_path = Path(repo_path)
+    if not repo_path.is_absolute():
+        repo_path = (Path(__file__).parents[2] / 'data/processed-repos'
+                     / repo_path)
+    return repo_path
+
+
+def read_index(repo_path: Union[str, Path]) -> Dict[str, Tuple[str, str]]:
+    """
+    Read the `.dedup` index of a processed repo.
+
+    Returns
+    -------
+    index : dict
+        Maps every indexed commit to `(content hash, canonical commit)`.
+        Empty if `dedup` was never run.
+    """
+    index = {}
+    try:
+        with open(_resolve(repo_path) / DEDUP) as f:
+            for line in f:
+                sha, digest, canonical = line.split()
+                index[sha] = (digest, canonical)
+    except FileNotFoundError:
+        pass
+    return index
+
+
+def _write_index(repo_path: Path,
+                 index: Dict[str, Tuple[str, str]]) -> None:
+    tmp = repo_path / (DEDUP + '.tmp')
+    with open(tmp, 'w') as f:
+        for sha in sorted(index):
+            f.write('{} {} {}\n'.format(sha, *index[sha]))
+    tmp.replace(repo_path / DEDUP)
+
+
+def _read(filename: Path) -> bytes:
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def _canonical(shas: Iterable[str], present: Set[str],
+               previous: Dict[str, str]) -> str:
+    # prefer a commit still on disk, then the commit that was canonical
+    # before, so that the chosen samples stay stable as the repo grows
+    return min(shas, key=lambda s: (s not in present, previous.get(s) != s,
+                                    s))
+
+
+def dedup(repo_path: Union[str, Path], near_duplicates: bool=False,
+          threshold: float=0.8, num_perm: int=64) -> int:
+    """
+    Group the duplicate commits of a processed repo and record one
+    canonical commit per group in the `.dedup` index.
+
+    Only the commits missing from the index are hashed, so re-running
+    after `dashm.data.process_data.process` is cheap. Near duplicate
+    detection re-reads every canonical diff.
+
+    Inputs
+    ------
+    repo_path : str or Path-like
+        Absolute path to the processed repo, or a folder in
+        `<project path>/data/processed-repos`.
+    near_duplicates : bool
+        If True, also merge the groups whose changed lines have an
+        estimated Jaccard similarity of at least `threshold`.
+    threshold : float
+        See `near_duplicates`.
+    num_perm : int
+        Length of the MinHash signatures, a multiple of 4. Longer
+        signatures are more accurate and slower.
+
+    Returns
+    -------
+    n_duplicates : int
+        The number of commits that are not canonical.
+    """
+    if num_perm % _ROWS:
+        raise ValueError('`num_perm` must be a multiple of {}'.format(_ROWS))
+    repo_path = _resolve(repo_path)
+    index = read_index(repo_path)
+    previous = {sha: canonical for sha, (_, canonical) in index.items()}
+
+    commits = sorted(f.stem for f in repo_path.glob('*.diff'))
+    present = set(commits)
+    for sha in commits:
+        if sha not in index:
+            digest = content_hash(_read(repo_path / (sha + '.diff')),
+                                  _read(repo_path / (sha + '.msg')))
+            index[sha] = (digest, '')
+
+    groups = {}  # type: Dict[str, List[str]]
+    for sha in sorted(index):
+        groups.setdefault(index[sha][0], []).append(sha)
+    canonical = {digest: _canonical(shas, present, previous)
+                 for digest, shas in groups.items()}
+
+    if near_duplicates:
+        # only groups with a commit on disk can be compared
+        digests = sorted(d for d, sha in canonical.items() if sha in present)
+        signatures = np.array(
+            [minhash(_read(repo_path / (canonical[d] + '.diff')), num_perm)
+             for d in digests], dtype=np.uint64
+        ).reshape(len(digests), num_perm)
+        for members in _near_groups(signatures, threshold):
+            shas = [canonical[digests[i]] for i in members]
+            chosen = _canonical(shas, present, previous)
+            for i in members:
+                canonical[digests[i]] = chosen
+
+    for sha, (digest, _) in index.items():
+        index[sha] = (digest, canonical[digest])
+    _write_index(repo_path, index)
+
+    return sum(sha != c for sha, (_, c) in index.items())
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description='Find the duplicate commits of a processed repo'
+    )
+    p.add_argument('repo', type=str,
+                   help=('Absolute path to processed repo, or folder name'
+                         ' of a folder that exists in'
+                         ' "<project path>/data/processed-repos/".'
+                         ' Alternatively, can be a git repo where we will'
+                         ' use the human-ish portion of the git repo.'))
+    p.add_argument('--near-duplicates', dest='near_duplicates',
+                   action='store_true',
+                   help=('Also group commits with similar diffs, found'
+                         ' by MinHash.'))
+    p.add_argument('--threshold', type=float, default=0.8,
+                   help=('Minimum estimated Jaccard similarity of the'
+                         ' changed lines of near duplicates.'))
+
+    args = p.parse_args()
+
+    repo = args.repo
+    if ':' in repo:
+        repo = humanify(repo)
+    n = dedup(repo, near_duplicates=args.near_duplicates,
+              threshold=args.threshold)
+    print('{} duplicate commits'.format(n))
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
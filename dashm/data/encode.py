@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""
+Utils to encode raw diffs and commit messages into numpy arrays.
+
+Only depends on numpy, so that inference does not need to import keras.
+"""
+
+from typing import Tuple, List, Iterator
+
+import numpy as np
+
+DIFF_END = b'\x01'
+MSG_BEGIN = b'\x00'
+MSG_END = b'\x01'
+
+# Integer id used to pad compact encodings fed to an embedding layer.
+PAD = 128
+
+__diff_end = np.frombuffer(DIFF_END, np.uint8)[0]
+__msg_begin = np.frombuffer(MSG_BEGIN, np.uint8)[0]
+__msg_end = np.frombuffer(MSG_END, np.uint8)[0]
+
+
+def encode_diff(bytes_to_encode: bytes) -> np.ndarray:
+    """
+    Encode the given bytes into a compact 1D uint8 numpy array.
+
+    Any bytes with values < 2 are sent to 2, and any values > 127
+    are sent to 127. The value 1 is used as a special marker:
+
+        1 : end of commit diff
+
+    See also: DIFF_END and MSG_END.
+
+    Inputs
+    ------
+    bytes_to_encode : bytes-like
+        The bytes to be encoded.
+
+    Returns
+    -------
+    x : 1D uint8 numpy array of values in [0, 128)
+    """
+    x = np.empty(len(bytes_to_encode) + 1, np.uint8)
+    np.clip(np.frombuffer(bytes_to_encode, np.uint8), 2, 127, out=x[:-1])
+    x[-1] = __diff_end
+    return x
+
+
+def encode_diff_chunks(bytes_to_encode: bytes, chunk_size: int
+                       ) -> Iterator[np.ndarray]:
+    """
+    Encode the given bytes like `encode_diff`, one chunk at a time,
+    without encoding them all at once.
+
+    Inputs
+    ------
+    bytes_to_encode : bytes-like
+        The bytes to be encoded.
+    chunk_size : int > 0
+        Length of the chunks. The last one may be shorter.
+
+    Returns
+    -------
+    generator yielding
+        x : 1D uint8 numpy array of values in [0, 128). Concatenated,
+            the chunks are `encode_diff(bytes_to_encode)`.
+    """
+    data = memoryview(bytes_to_encode).cast('B')
+    n = len(data) + 1  # with DIFF_END
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        x = np.empty(end - start, np.uint8)
+        body = np.frombuffer(data[start:min(end, len(data))], np.uint8)
+        np.clip(body, 2, 127, out=x[:len(body)])
+        if end == n:
+            x[-1] = __diff_end
+        yield x
+
+
+def encode_msg(bytes_to_encode: bytes) -> np.ndarray:
+    """
+    Encode the given bytes into a compact 1D uint8 numpy array.
+
+    Any bytes with values < 2 are sent to 2, and any values > 127
+    are sent to 127. The values 0 and 1 are used as special markers:
+
+        0 : beginning of commit message
+        1 : end of commit message
+
+    See also: DIFF_END and MSG_END.
+
+    Inputs
+    ------
+    bytes_to_encode : bytes-like
+        The bytes to be encoded.
+
+    Returns
+    -------
+    x : 1D uint8 numpy array of values in [0, 128)
+    """
+    x = np.empty(len(bytes_to_encode) + 2, np.uint8)
+    np.clip(np.frombuffer(bytes_to_encode, np.uint8), 2, 127, out=x[1:-1])
+    x[0] = __msg_begin
+    x[-1] = __msg_end
+    return x
+
+
+def one_hot(x: np.ndarray) -> np.ndarray:
+    """
+    Expand an integer array of any shape into float32 one-hot rows,
+    adding a trailing axis of size 128. Negative values are treated
+    as padding and become rows of all 0s.
+
+    Inputs
+    ------
+    x : integer numpy array
+        Values as returned by `encode_diff` or `encode_msg`.
+
+    Returns
+    -------
+    y : float32 numpy array of shape `x.shape + (128,)`
+    """
+    x = np.asarray(x)
+    y = np.zeros(x.shape + (128,), dtype=np.float32)
+    mask = x >= 0
+    y[np.nonzero(mask) + (x[mask],)] = 1.0
+    return y
+
+
+def one_hot_encode_diff(bytes_to_encode: bytes) -> np.ndarray:
+    """
+    One-hot encode the given bytes into 2D float32 numpy array.
+    Same as `one_hot(encode_diff(bytes_to_encode))`.
+
+    Inputs
+    ------
+    bytes_to_encode : bytes-like
+        The bytes to be one-hot encode.
+
+    Returns
+    -------
+    y : 2D float32 numpy array of one-hot encoded values
+    """
+    return one_hot(encode_diff(bytes_to_encode))
+
+
+def one_hot_encode_msg(bytes_to_encode: bytes) -> np.ndarray:
+    """
+    One-hot encode the given bytes into 2D float32 numpy array.
+    Same as `one_hot(encode_msg(bytes_to_encode))`.
+
+    Inputs
+    ------
+    bytes_to_encode : bytes-like
+        The bytes to be one-hot encode.
+
+    Returns
+    -------
+    y : 2D float32 numpy array of one-hot encoded values
+    """
+    return one_hot(encode_msg(bytes_to_encode))
+
+
+def _one_hot_valid(ids: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """
+    `one_hot` of the 2D `ids`, with rows of all 0s where not `valid`.
+    """
+    y = np.zeros(ids.shape + (128,), dtype=np.float32)
+    cells = np.flatnonzero(valid)
+    y.reshape(-1)[cells * 128 + ids.reshape(-1)[cells]] = 1.0
+    return y
+
+
+def encode_batch(diffs: List[bytes], msgs: List[bytes],
+                 max_diff_len: int, max_msg_len: int,
+                 sparse: bool=False) -> Tuple:
+    """
+    Encode a batch of raw diffs and messages straight into padded
+    arrays. The output is the same as
+
+        format_batch([(encode_diff(d), encode_msg(m))
+                      for d, m in zip(diffs, msgs)],
+                     max_diff_len, max_msg_len, sparse)
+
+    but every sample is copied straight from its buffer into its row
+    of one preallocated array per input, and clipped with the others,
+    without building any per-sample encodings.
+
+    Inputs
+    ------
+    diffs : List of bytes-like
+        The raw diffs.
+    msgs : List of bytes-like
+        The raw commit messages, in the same order.
+    max_diff_len : int
+        Length the diff encodings are padded/truncated to, see
+        `format_batch`.
+    max_msg_len : int
+        Length the message encodings are padded/truncated to, see
+        `format_batch`.
+    sparse : bool
+        See `format_batch`.
+
+    Returns
+    -------
+    Same as `format_batch`.
+    """
+    n = len(diffs)
+
+    # Diffs keep their *last* bytes and are right-aligned, DIFF_END last.
+    diff_keep = np.minimum([len(d) for d in diffs], max_diff_len - 1)
+    diff_starts = max_diff_len - 1 - diff_keep
+    xs = np.zeros((n, max_diff_len), dtype=np.uint8)
+    for i, d in enumerate(diffs):
+        xs[i, diff_starts[i]:-1] = np.frombuffer(d, np.uint8)[
+            len(d) - diff_keep[i]:
+        ]
+    np.clip(xs, 2, 127, out=xs)
+    xs[:, -1] = __diff_end
+    x_valid = np.arange(max_diff_len) >= diff_starts[:, None]
+
+    # Messages keep their *first* bytes and are left-aligned after
+    # MSG_BEGIN, followed by MSG_END if there is room for it.
+    msg_lens = np.array([len(m) for m in msgs], dtype=np.int64)
+    msg_keep = np.minimum(msg_lens, max_msg_len - 1)
+    ys = np.zeros((n, max_msg_len), dtype=np.uint8)
+    for i, m in enumerate(msgs):
+        ys[i, 1:msg_keep[i] + 1] = np.frombuffer(m, np.uint8)[:msg_keep[i]]
+    np.clip(ys, 2, 127, out=ys)
+    ys[:, 0] = __msg_begin
+    ended = np.flatnonzero(msg_lens + 2 <= max_msg_len)
+    ys[ended, msg_lens[ended] + 1] = __msg_end
+    y_len = msg_keep + 1
+    y_len[ended] += 1
+    y_valid = np.arange(max_msg_len) < y_len[:, None]
+
+    if sparse:
+        xs = np.where(x_valid, xs, PAD).astype(np.int32)
+        y0 = np.where(y_valid[:, :-1], ys[:, :-1], PAD).astype(np.int32)
+        y1 = np.where(y_valid[:, 1:], ys[:, 1:], 0).astype(np.int32)
+        w = y_valid[:, 1:].astype(np.float32)
+        return [xs, y0], y1, w
+
+    xs = _one_hot_valid(xs, x_valid)
+    ys = _one_hot_valid(ys, y_valid)
+    return [xs, ys[:, :-1, :]], ys[:, 1:, :] # type: ignore # mypy hates slice
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+Clone, or fetch, and process many repos concurrently.
+
+    python -m dashm.data.ingest git@github.com:kbrose/dashm.git /srv/repo.git
+    python -m dashm.data.ingest --file repos.txt --fetches 8 --processes 2
+
+Every repo goes through the same steps as `make process`: it is cloned
+into `<project path>/data/raw-repos/<repo name>` by `git clone`, or, if
+already there, brought up to date by `git pull --ff-only`, which only
+fetches the new objects. It is then processed by
+`dashm.data.process_data.process`, which only extracts the new commits.
+
+The git commands run as asyncio subprocesses, at most `max_fetches` at
+a time, and at most `max_processes` repos are processed at a time in
+worker threads. A repo that fails does not stop the others. Repos
+with the same name would share their folders, only the first one
+listed is ingested.
+"""
+
+import sys
+import time
+import asyncio
+import functools
+from pathlib import Path
+import argparse
+from typing import List, Dict, Optional, Callable
+
+from .humanify_git import humanify
+from .process_data import process
+
+RAW_REPOS = Path(__file__).parents[2] / 'data/raw-repos'
+
+
+async def _git(*args: str) -> None:
+    proc = await asyncio.create_subprocess_exec(
+        'git', *args, stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode:
+        raise RuntimeError('git {} failed: {}'.format(
+            args[0], stderr.decode('utf-8', 'replace').strip()
+        ))
+
+
+async def _update(repo: str, target: Path) -> str:
+    """
+    Clone `repo` into `target`, or pull the new commits if it is
+    already there. Returns the step run, 'fetch' or 'clone'.
+    """
+    if (target / '.git').exists():
+        await _git('-C', str(target), 'pull', '--ff-only', '-q')
+        return 'fetch'
+    await _git('clone', '-q', repo, str(target))
+    # create the .dashm file, as `get_data.clone` does
+    with open(str(target) + '.dashm', 'a'):
+        pass
+    return 'clone'
+
+
+def _print_progress(repo: str, step: str, done: int, total: int) -> None:
+    print('[{}/{}] {}: {}'.format(done, total, humanify(repo), step),
+          flush=True)
+
+
+async def ingest(repos: List[str], max_fetches: int=4,
+                 max_processes: int=2,
+                 progress: Optional[Callable]=_print_progress,
+                 **process_kwargs) -> Dict[str, Optional[str]]:
+    """
+    Clone or fetch, then process, every repo of `repos`.
+
+    Inputs
+    ------
+    repos : List of str
+        Paths/URLs of the repos, see "git clone --help". Local bare
+        repos work too.
+    max_fetches : int
+        Maximum number of clones and fetches running at once.
+    max_processes : int
+        Maximum number of repos processed at once.
+    progress : callable
+        Called as `progress(repo, step, done, total)` when a repo
+        starts a step, one of 'clone', 'fetch', 'process', or ends
+        with 'done in <seconds>s' or 'failed: <error>'. `done` is the
+        number of repos finished so far. Use None for no reports.
+    **process_kwargs
+        Passed through to `dashm.data.process_data.process`.
+
+    Returns
+    -------
+    errors : dict
+        Maps every repo to None if it was ingested, or to the error
+        that stopped it, e.g. for a repo with the same name as one
+        listed before it.
+    """
+    repos = list(dict.fromkeys(repos))  # each repo once
+    first = {}  # type: Dict[str, str]
+    for repo in repos:
+        first.setdefault(humanify(repo), repo)
+    fetches = asyncio.Semaphore(max_fetches)
+    processes = asyncio.Semaphore(max_processes)
+    loop = asyncio.get_event_loop()  # the running loop
+    total = len(repos)
+    finished = [0]
+
+    def report(repo, step):
+        if progress is not None:
+            progress(repo, step, finished[0], total)
+
+    async def one(repo: str) -> Optional[str]:
+        start = time.perf_counter()
+        name = humanify(repo)
+        try:
+            if first[name] != repo:
+                raise ValueError('same name, {}, as {}'.format(name,
+                                                              first[name]))
+            async with fetches:
+                exists = (RAW_REPOS / name).exists()
+                report(repo, 'fetch' if exists else 'clone')
+                await _update(repo, RAW_REPOS / name)
+            async with processes:
+                report(repo, 'process')
+                await loop.run_in_executor(
+                    None, functools.partial(process, name, **process_kwargs)
+                )
+        except Exception as e:
+            finished[0] += 1
+            report(repo, 'failed: {}'.format(e))
+            return str(e)
+        finished[0] += 1
+        report(repo, 'done in {:.1f}s'.format(time.perf_counter() - start))
+        return None
+
+    RAW_REPOS.mkdir(parents=True, exist_ok=True)
+    errors = await asyncio.gather(*[one(repo) for repo in repos])
+    return dict(zip(repos, errors))
+
+
+def run(repos: List[str], **kwargs) -> Dict[str, Optional[str]]:
+    """
+    Run `ingest` to completion in a new event loop, and return its
+    result. Takes the same arguments.
+    """
+    loop = asyncio.new_event_loop()
+    # the event loop of the main thread reaps the git subprocesses
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(ingest(repos, **kwargs))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def read_repo_list(path: str) -> List[str]:
+    """
+    The repos of a file listing one per line. Blank lines and lines
+    starting with '#' are skipped.
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description='Clone, or fetch, and process many git repos'
+    )
+    p.add_argument('repos', type=str, nargs='*',
+                   help='The paths/URLs. See "git clone --help".')
+    p.add_argument('--file', type=str, default=None,
+                   help='File listing more repos, one per line.')
+    p.add_argument('--fetches', type=int, default=4,
+                   help='Maximum number of clones/fetches at once.')
+    p.add_argument('--processes', type=int, default=2,
+                   help='Maximum number of repos processed at once.')
+    p.add_argument('--jobs', type=int, default=1,
+                   help=('Number of worker processes used to process each'
+                         ' repo, see dashm.data.process_data.'))
+
+    args = p.parse_args()
+
+    repos = list(args.repos)
+    if args.file is not None:
+        repos += read_repo_list(args.file)
+    if not repos:
+        p.error('no repos given')
+
+    errors = run(repos, max_fetches=args.fetches,
+                 max_processes=args.processes, jobs=args.jobs)
+    failed = [repo for repo, error in errors.items() if error is not None]
+    if failed:
+        print('{} of {} repos failed: {}'.format(len(failed), len(repos),
+                                                 ', '.join(failed)),
+              file=sys.stderr)
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
@@ -1,125 +1,229 @@
 # -*- coding: utf-8 -*-
 
+import os
 from pathlib import Path
 import random
-from typing import Tuple, Union, Iterable, List
+from typing import Tuple, Union, Iterable, List, Optional, Iterator
 
 import numpy as np
 from keras.preprocessing.sequence import pad_sequences
+from keras.utils import Sequence
+
+from .. import profiling
+from .pack import PACKED, PackedCorpus
+from .dedup import read_index
+from .multi import MultiCorpus, is_manifest
+from .tokenizer import Tokenizer
+from .encode import (DIFF_END, MSG_BEGIN, MSG_END, PAD,
+                     encode_diff, encode_diff_chunks, encode_msg, one_hot,
+                     one_hot_encode_diff, one_hot_encode_msg, encode_batch)
 
 """
 Utils to load processed data into python data structures.
 """
 
-DIFF_END = b'\x01'
-MSG_BEGIN = b'\x00'
-MSG_END = b'\x01'
 
-__diff_end = np.fromstring(DIFF_END, np.uint8)[0]
-__msg_begin = np.fromstring(MSG_BEGIN, np.uint8)[0]
-__msg_end = np.fromstring(MSG_END, np.uint8)[0]
+class Ragged():
+    """
+    A compact list of variable length 1D arrays, stored as one
+    contiguous `values` array and an `offsets` array such that the
+    i-th element is `values[offsets[i]:offsets[i+1]]`.
+    """
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_arrays(cls, arrays: List[np.ndarray],
+                    dtype=np.uint8) -> 'Ragged':
+        """
+        Pack a list of 1D arrays into a single `Ragged` array.
+        """
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        if arrays:
+            values = np.concatenate(arrays).astype(dtype, copy=False)
+        else:
+            values = np.zeros(0, dtype=dtype)
+        return cls(values, offsets)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Ragged index out of range')
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
 
-def one_hot_encode_diff(bytes_to_encode: bytes) -> np.ndarray:
+def _read(filename: Union[str, Path], maxlen: int=-1):
+    with profiling.timer('load.read'), open(filename, 'rb') as fp:
+        return fp.read(maxlen)
+
+
+class _DirectoryCorpus():
+    """
+    The same interface as `PackedCorpus`, over the one-file-per-commit
+    layout written by `dashm.data.process_data`. Only the canonical
+    commits of the `dashm.data.dedup` index, if any, are read.
     """
-    One-hot encode the given bytes into 2D float32 numpy array.
 
-    Any bytes with values < 2 are sent to 2, and any values > 127
-    are sent to 127. The value 1 is used as a special marker:
+    def __init__(self, repo_path: Path):
+        commits = sorted(f.parent / f.stem for f in repo_path.glob('*.diff'))
+        index = read_index(repo_path)
+        commits = [c for c in commits
+                   if index.get(c.name, ('', c.name))[1] == c.name]
+        self.shas = [c.name for c in commits]
+        self.split_keys = [index.get(sha, (sha, ''))[0] for sha in self.shas]
+        self._commits = commits
 
-        1 : end of commit diff
+    def __len__(self) -> int:
+        return len(self._commits)
 
-    See also: DIFF_END and MSG_END.
+    def msg_lengths(self) -> np.ndarray:
+        return np.array([os.stat(c.with_suffix('.msg')).st_size
+                         for c in self._commits], dtype=np.int64)
 
-    Inputs
-    ------
-    bytes_to_encode : bytes
-        The bytes to be one-hot encode.
+    def diff_lengths(self) -> np.ndarray:
+        return np.array([os.stat(c.with_suffix('.diff')).st_size
+                         for c in self._commits], dtype=np.int64)
+
+    def msg(self, i: int, maxlen: int=-1) -> bytes:
+        return _read(self._commits[i].with_suffix('.msg'), maxlen)
+
+    def diff(self, i: int, maxlen: int=-1) -> bytes:
+        return _read(self._commits[i].with_suffix('.diff'), maxlen)
 
-    Returns
-    -------
-    y : 2D float32 numpy array of one-hot encoded values
-    """
-    x = np.fromstring(bytes_to_encode + DIFF_END, np.uint8)
-    x = np.clip(x, 2, 127)
-    x[-1] = __diff_end
-    y = np.zeros((x.size, 128), dtype=np.float32)
-    y[np.arange(y.shape[0]), x] = 1.0
-    return y
 
+def open_corpus(repo_path: Union[str, Path]
+                ) -> Union[PackedCorpus, _DirectoryCorpus, MultiCorpus]:
+    """
+    Open the processed data in `<project path>/data/processed-repos/<repo>`,
+    preferring the packed format (see `dashm.data.pack`) if present.
+    Commits are sorted by SHA in either case.
 
-def one_hot_encode_msg(bytes_to_encode: bytes) -> np.ndarray:
+    If `repo_path` is the path of a `.json` manifest, the commits of
+    all its repos are opened instead, see `dashm.data.multi`.
     """
-    One-hot encode the given bytes into 2D float32 numpy array.
+    if is_manifest(repo_path):
+        return MultiCorpus(repo_path)
+    repo_path = Path(__file__).parents[2] / 'data/processed-repos' / repo_path
+    if (repo_path / PACKED / 'index.npz').exists():
+        return PackedCorpus(repo_path / PACKED)
+    return _DirectoryCorpus(repo_path)
 
-    Any bytes with values < 2 are sent to 2, and any values > 127
-    are sent to 127. The values 0 and 1 are used as special markers:
 
-        0 : beginning of commit message
-        1 : end of commit message
+def split_indices(corpus: Union[PackedCorpus, _DirectoryCorpus, MultiCorpus],
+                  cv_train_split: float, which: str) -> np.ndarray:
+    """
+    The indices of the training or validation commits of `corpus`.
 
-    See also: DIFF_END and MSG_END.
+    A commit is used for training if the first 32 bits of its split
+    key, as a fraction of 2**32, are less than `cv_train_split`. The
+    key is the content hash of the commit if the repo was deduplicated
+    (see `dashm.data.dedup`), otherwise its SHA. A commit therefore
+    never changes sides as the repo grows, and copies of a change are
+    all on the same side.
 
     Inputs
     ------
-    bytes_to_encode : bytes
-        The bytes to be one-hot encode.
+    corpus : PackedCorpus or _DirectoryCorpus
+        See `open_corpus`.
+    cv_train_split : float
+        A number between 0 and 1 inclusive, the expected fraction
+        of the commits used for training.
+    which : str
+        One of 'train' or 'val'.
 
     Returns
     -------
-    y : 2D float32 numpy array of one-hot encoded values
+    indices : numpy.ndarray
+        The sorted int64 indices of the commits.
     """
-    x = np.fromstring(MSG_BEGIN + bytes_to_encode + MSG_END, np.uint8)
-    x = np.clip(x, 2, 127)
-    x[0] = __msg_begin
-    x[-1] = __msg_end
-    y = np.zeros((x.size, 128), dtype=np.float32)
-    y[np.arange(y.shape[0]), x] = 1.0
-    return y
-
-
-def _read(filename: Union[str, Path], maxlen: int=-1):
-    with open(filename, 'rb') as fp:
-        return fp.read(maxlen)
+    if which not in ['train', 'val']:
+        raise ValueError('`which` must be one of ["train", "val"]')
+    fractions = np.array([int(key[:8], 16) for key in corpus.split_keys],
+                         dtype=np.int64) / 2 ** 32
+    is_train = fractions < cv_train_split
+    return np.flatnonzero(is_train if which == 'train' else ~is_train)
+
+
+def _encode_commit(corpus: Union[PackedCorpus, _DirectoryCorpus,
+                                 MultiCorpus], i: int,
+                   max_diff_len: int, max_msg_len: int,
+                   tokenizer: Optional[Tokenizer]
+                   ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compact encodings of the diff and message of commit `i`, with at
+    most `max_diff_len`/`max_msg_len` characters, or tokens if a
+    tokenizer is given, before the markers.
+    """
+    if tokenizer is None:
+        diff = corpus.diff(i, max_diff_len)
+        msg = corpus.msg(i, max_msg_len)
+        with profiling.timer('load.encode'):
+            return encode_diff(diff), encode_msg(msg)
+    # enough bytes for the maximum number of tokens
+    n = tokenizer.max_token_len
+    diff = corpus.diff(i, max_diff_len * n if max_diff_len >= 0 else -1)
+    msg = corpus.msg(i, max_msg_len * n if max_msg_len >= 0 else -1)
+    with profiling.timer('load.encode'):
+        return (tokenizer.encode_diff(diff, max_diff_len),
+                tokenizer.encode_msg(msg, max_msg_len))
 
 
 def load(repo_path: Union[str, Path], cv_train_split: float, which: str,
-         max_diff_len: int=-1, max_msg_len: int=-1
-         ) -> Tuple[np.ndarray, np.ndarray]:
+         max_diff_len: int=-1, max_msg_len: int=-1,
+         tokenizer: Optional[Tokenizer]=None
+         ) -> Tuple[Ragged, Ragged]:
     """
     Loads the processed data from
     `<project path>/data/processed-repos/<repo name>` into
-    two length-N lists `x,y` of 2D numpy arrays such that
+    two length-N `Ragged` arrays `x,y` such that
 
-        x[i] : JxL array encoding the commit diff
-        y[i] : KxL array encoding the commit message
+        x[i] : length J uint8 array encoding the commit diff
+        y[i] : length K uint8 array encoding the commit message
 
-    The one-hot-encoding is done one character at a time,
-    treating the text as ASCII text, and any bytes with
+    The encoding is done one character at a time, treating
+    the text as ASCII text, and any bytes with
     values < 2 are sent to 2, and any values > 127 are sent
     to 127. The values 0 and 1 are used as special markers:
 
         0 : beginning of message
         1 : end of commit message/end of diff
 
-    Data will be split into training/validation by sorting the
-    commits SHAs and taking the first section as training and
-    the second section as validation.
+    Data will be split into training/validation by the content
+    hashes of the commits, see `split_indices`. Duplicate commits
+    are skipped if the repo was deduplicated, see `dashm.data.dedup`.
+
+    If the repo has been packed (see `dashm.data.pack`), the data
+    is read from the memory-mapped packed corpus instead.
 
     WARNING :
-        Since data is split by the commit SHAs, data leakage may
-        occur. For example, a regular commit and a *merge* commit
-        with the same diff/message may be in different splits.
+        If the repo was not deduplicated, data is split by the commit
+        SHAs and data leakage may occur. For example, a regular commit
+        and a *merge* commit with the same diff/message may be in
+        different splits.
 
     Inputs
     ------
     repo : str or Path-like
-        A folder relative to `<project path>/data/processed-repos`
+        A folder relative to `<project path>/data/processed-repos`,
+        or the path of a multi-repo manifest, see `dashm.data.multi`.
     cv_train_split : float
         A number between 0 and 1 inclusive, the amount of data
-        used for training vs. validation. The number of commits
-        multiplied by this number and truncated will be used for
-        training and the rest for validation.
+        used for training vs. validation, see `split_indices`.
     which : str
         One of 'train' or 'val' indicating whether the training
         data or the validation data should be returned respectively.
@@ -133,96 +237,148 @@ def load(repo_path: Union[str, Path], cv_train_split: float, which: str,
         If negative, the whole file is read. Note that an extra
         two bytes are added to messages, so the maximum length of
         y-data returned will be `max_msg_len + 2`.
+    tokenizer : Tokenizer
+        If given, encode into the uint16 token ids of the tokenizer
+        instead of one id per character, see `dashm.data.tokenizer`.
+        `max_diff_len` and `max_msg_len` then count tokens.
 
     Returns
     -------
-    (x,y) tuples of lists of 2D numpy arrays.
+    (x,y) tuple of `Ragged` uint8 arrays (uint16 with a tokenizer).
+    The one-hot expansion
+    is deferred until the batch is formed, see `format_batch`.
 
     See also
     --------
-    `one_hot_encode_diff`
-    `one_hot_encode_msg`
+    `encode_diff`
+    `encode_msg`
     """
-    repo_path = Path(__file__).parents[2] / 'data/processed-repos' / repo_path
-    commits = sorted(set([f.parent / f.stem for f in repo_path.glob('*')]))
+    corpus = open_corpus(repo_path)
+    indices = split_indices(corpus, cv_train_split, which)
 
-    x = [one_hot_encode_diff(_read(c.with_suffix('.diff'), max_diff_len))
-         for c in commits]
-    y = [one_hot_encode_msg(_read(c.with_suffix('.msg'), max_msg_len))
-         for c in commits]
-
-    split = int(len(commits) * cv_train_split)
-
-    if which == 'train':
-        return x[:split], y[:split]
-    if which == 'val':
-        return x[split:], y[split:]
-    raise ValueError('`which` must be one of ["train", "val"]')
+    dtype = np.uint8 if tokenizer is None else np.uint16
+    encoded = [_encode_commit(corpus, i, max_diff_len, max_msg_len,
+                              tokenizer)
+               for i in indices]
+    x = Ragged.from_arrays([x for x, _ in encoded], dtype)
+    y = Ragged.from_arrays([y for _, y in encoded], dtype)
+    return x, y
 
 
 def load_train_generator(repo_path: Union[str, Path], cv_train_split: float,
-                         max_diff_len: int=-1, max_msg_len: int=-1
+                         max_diff_len: int=-1, max_msg_len: int=-1,
+                         encoding: str='one_hot',
+                         tokenizer: Optional[Tokenizer]=None,
+                         which: str='train'
                          ) -> Iterable[Tuple[np.ndarray, np.ndarray]]:
     """
     A generator giving access to the data located in
     `<project path>/data/processed-repos/<repo name>`.
-    Will continue to return samples x,y with
+    Will continue to return samples x,y with, depending on `encoding`,
 
-        x : JxL array encoding the commit diff
-        y : KxL array encoding the commit message
+        'one_hot' : Jx128 and Kx128 float32 one-hot arrays
+        'compact' : length J and K uint8 arrays of the same ids
+        'raw'     : the bytes of the diff and message, unencoded
 
-    The one-hot-encoding is done one character at a time,
-    treating the text as ASCII text, and any bytes with
-    values < 2 are sent to 2, and any values > 127 are sent
-    to 127. The values 0 and 1 are used as special markers:
+    encoding the commit diff and commit message respectively.
+
+    The encoding is done one character at a time, treating the
+    text as ASCII text, and any bytes with values < 2 are sent
+    to 2, and any values > 127 are sent to 127. The values 0
+    and 1 are used as special markers (see `encode_diff` and
+    `encode_msg`):
+
+        1 : end of commit diff (DIFF_END)
+        0 : beginning of commit message (MSG_BEGIN)
+        1 : end of commit message (MSG_END)
 
-        0 : end of commit diff
-        1 : end of commit message
+    With a tokenizer, 'compact' yields uint16 token ids instead,
+    with the same markers, see `dashm.data.tokenizer`. The padding
+    id PAD is only added when sparse batches are formed, see
+    `format_batch`.
 
-    The generator will only yield the training portion of the data.
+    The generator will only yield the training portion of the data,
+    unless `which` is 'val'.
 
     Inputs
     ------
     repo : str or Path-like
-        A folder relative to `<project path>/data/processed-repos`
+        A folder relative to `<project path>/data/processed-repos`,
+        or the path of a multi-repo manifest, see `dashm.data.multi`.
     cv_train_split : float
         A number between 0 and 1 inclusive, the amount of data
-        used for training vs. validation. The number of commits
-        multiplied by this number and truncated will be used for
-        training and the rest for validation.
+        used for training vs. validation, see `split_indices`.
     max_diff_len : int
         Maximum number of bytes to read from the diff file.
         If negative, the whole file is read.
     max_msg_len : int
         Maximum number of bytes to read from the message file.
         If negative, the whole file is read.
+    encoding : str
+        One of 'one_hot' (default), 'compact' to yield the 1D uint8
+        encodings (see `encode_diff`), or 'raw' to yield the bytes
+        read from disk unencoded (see `encode_batch`).
+    tokenizer : Tokenizer
+        If given, 'compact' yields token ids instead, see `load`.
+        Cannot be used with the other encodings.
+    which : str
+        One of 'train' (default) or 'val', the portion of the data
+        drawn from.
 
     WARNING :
-        Since data is split by the commit SHAs, data leakage may
-        occur. For example, a regular commit and a *merge* commit
-        with the same diff/message may be in different splits.
+        If the repo was not deduplicated, data is split by the commit
+        SHAs and data leakage may occur. For example, a regular commit
+        and a *merge* commit with the same diff/message may be in
+        different splits.
 
     Returns
     -------
     generator repeatedly yielding
-        x,y : Two 2D numpy arrays.
+        x,y : Two 2D numpy arrays (1D if 'compact', bytes if 'raw').
     """
-    repo_path = Path(__file__).parents[2] / 'data/processed-repos' / repo_path
-    commits = sorted(set(f.parent / f.stem for f in repo_path.glob('*')))
-
-    split = int(len(commits) * cv_train_split)
-    commits = commits[:split]
+    if encoding not in ['one_hot', 'compact', 'raw']:
+        raise ValueError(
+            '`encoding` must be one of ["one_hot", "compact", "raw"]'
+        )
+    if tokenizer is not None and encoding != 'compact':
+        raise ValueError('A tokenizer requires the "compact" encoding')
+    corpus = open_corpus(repo_path)
+
+    if isinstance(corpus, MultiCorpus):
+        # weighted, and only opening the repos sampled
+        def draw():
+            return corpus.sample(cv_train_split, which=which)
+    else:
+        indices = split_indices(corpus, cv_train_split, which)
+
+        def draw():
+            return int(random.choice(indices))
     while True:
-        c = random.choice(commits)
-        x = one_hot_encode_diff(_read(c.with_suffix('.diff'), max_diff_len))
-        y = one_hot_encode_msg(_read(c.with_suffix('.msg'), max_msg_len))
-        yield x, y
+        i = draw()
+        if tokenizer is not None:
+            yield _encode_commit(corpus, i, max_diff_len, max_msg_len,
+                                 tokenizer)
+            continue
+        x = corpus.diff(i, max_diff_len)
+        y = corpus.msg(i, max_msg_len)
+        if encoding == 'raw':
+            yield bytes(x), bytes(y)
+            continue
+        with profiling.timer('load.encode'):
+            x, y = encode_diff(x), encode_msg(y)
+        if encoding == 'compact':
+            yield x, y
+        else:
+            with profiling.timer('load.one_hot'):
+                x, y = one_hot(x), one_hot(y)
+            yield x, y
 
 
 def format_batch(batch: List[Tuple[np.ndarray, np.ndarray]],
                  max_diff_len: int,
-                 max_msg_len: int
-                 ) -> Tuple[List[np.ndarray], np.ndarray]:
+                 max_msg_len: int,
+                 sparse: bool=False
+                 ) -> Tuple:
     """
     Format a batch by padding sequences with 0s up to the maximum lengths
     given. Also slices the message `y` into `y0` and `y1` similarly to
@@ -238,7 +394,9 @@ def format_batch(batch: List[Tuple[np.ndarray, np.ndarray]],
     ------
     batch : List
         Each element of batch is a tuple of (x,y) data where x is the
-        encoded diff and y is the encoded commit message.
+        encoded diff and y is the encoded commit message. Either both
+        are 2D one-hot encodings, or both are 1D integer encodings
+        (see `encode_diff`) which are one-hot expanded here.
     max_diff_len : int
         The encoded diffs will be padded to at most this length by
         adding 0s to the *front* of the sequence. Any encodings
@@ -251,6 +409,11 @@ def format_batch(batch: List[Tuple[np.ndarray, np.ndarray]],
         greater than this length are truncated by removing from
         the *end*. This ensures that the beginning of the message
         is still indicated by the special MSG_BEGIN value.
+    sparse : bool
+        If True, the batch must hold compact encodings and is returned
+        as integer ids for a model built with `embedding_dim`, see
+        `dashm.models.make_models`. Inputs are padded with `PAD`.
+        Required for the token ids of a `dashm.data.tokenizer`.
 
     Returns
     -------
@@ -258,21 +421,302 @@ def format_batch(batch: List[Tuple[np.ndarray, np.ndarray]],
         x is the 3D padded diff encodings
         y0 is the 3D padded message encodings, except the last element
         y1 is the 3D padded message encodings, except the first element
+    or, if `sparse`,
+    ([x,y0], y1, w)
+        x, y0 and y1 are 2D int32 arrays of ids instead, and w is the
+        2D float32 sample weight that is 0 where y1 is padding.
     """
-    xs = [d[0] for d in batch]
-    xs = pad_sequences(xs,
-                       maxlen=max_diff_len,
-                       dtype='float32',
-                       padding='pre',
-                       truncating='pre',
-                       value=0.0)
-
-    ys = [d[1] for d in batch]
-    ys = pad_sequences(ys,
-                       maxlen=max_msg_len,
-                       dtype='float32',
-                       padding='post',
-                       truncating='post',
-                       value=0.0)
+    if sparse:
+        return _format_sparse_batch(batch, max_diff_len, max_msg_len)
+
+    compact = np.ndim(batch[0][0]) == 1
+    # compact encodings are padded with -1, which `one_hot` sends to 0s
+    dtype, value = ('int16', -1) if compact else ('float32', 0.0)
+
+    with profiling.timer('load.pad'):
+        xs = [d[0] for d in batch]
+        xs = pad_sequences(xs,
+                           maxlen=max_diff_len,
+                           dtype=dtype,
+                           padding='pre',
+                           truncating='pre',
+                           value=value)
+
+        ys = [d[1] for d in batch]
+        ys = pad_sequences(ys,
+                           maxlen=max_msg_len,
+                           dtype=dtype,
+                           padding='post',
+                           truncating='post',
+                           value=value)
+
+    if compact:
+        with profiling.timer('load.one_hot'):
+            xs, ys = one_hot(xs), one_hot(ys)
 
     return [xs, ys[:, :-1, :]], ys[:, 1:, :] # type: ignore # mypy hates slice
+
+
+def _format_sparse_batch(batch: List[Tuple[np.ndarray, np.ndarray]],
+                         max_diff_len: int,
+                         max_msg_len: int
+                         ) -> Tuple[List[np.ndarray], np.ndarray, np.ndarray]:
+    with profiling.timer('load.pad'):
+        xs = pad_sequences([d[0] for d in batch],
+                           maxlen=max_diff_len,
+                           dtype='int32',
+                           padding='pre',
+                           truncating='pre',
+                           value=PAD)
+
+        ys = pad_sequences([d[1] for d in batch],
+                           maxlen=max_msg_len,
+                           dtype='int32',
+                           padding='post',
+                           truncating='post',
+                           value=-1)
+
+    y0, y1 = ys[:, :-1], ys[:, 1:]
+    w = (y1 >= 0).astype(np.float32)
+    y0 = np.where(y0 >= 0, y0, PAD)
+    y1 = np.where(y1 >= 0, y1, 0)
+    return [xs, y0], y1, w
+
+
+def _bucket_bounds(max_len: int, min_len: int) -> np.ndarray:
+    """
+    Powers of two between `min_len` and `max_len`, always ending
+    with `max_len` itself.
+    """
+    bounds = [min_len]
+    while bounds[-1] * 2 < max_len:
+        bounds.append(bounds[-1] * 2)
+    bounds.append(max_len)
+    return np.unique(bounds)
+
+
+class BucketSampler():
+    """
+    Yields training batches of commits with similar diff and message
+    lengths, each padded only to the lengths of its own bucket instead
+    of to `max_diff_len`/`max_msg_len`.
+
+    Every commit is assigned to the bucket `(diff_bound, msg_bound)`
+    holding the smallest of `diff_bounds`/`msg_bounds` at least as long
+    as its encoding. The bounds default to powers of two up to the
+    maximum lengths, so only a handful of batch shapes are ever used.
+    """
+
+    def __init__(self, repo_path: Union[str, Path], cv_train_split: float,
+                 batch_size: int, max_diff_len: int, max_msg_len: int,
+                 replace: bool=True, sparse: bool=False,
+                 diff_bounds: Optional[List[int]]=None,
+                 msg_bounds: Optional[List[int]]=None):
+        """
+        Inputs
+        ------
+        repo_path : str or Path-like
+            A folder relative to `<project path>/data/processed-repos`,
+            or the path of a multi-repo manifest, see `dashm.data.multi`.
+        cv_train_split : float
+            Only the training portion of the data is sampled,
+            see `load`.
+        batch_size : int
+            Maximum number of commits per batch.
+        max_diff_len : int
+            Maximum length of the diff encodings, see `format_batch`.
+        max_msg_len : int
+            Maximum length of the message encodings, see `format_batch`.
+        replace : bool
+            If True (default), sample forever with replacement, picking
+            buckets proportionally to their size. If False, every epoch
+            yields each training commit exactly once, in
+            `batches_per_epoch` batches.
+        sparse : bool
+            See `format_batch`.
+        diff_bounds, msg_bounds : List of int
+            Optional bucket lengths. `max_diff_len`/`max_msg_len` are
+            always added as the last bucket.
+        """
+        self.corpus = open_corpus(repo_path)
+        self.batch_size = batch_size
+        self.max_diff_len = max_diff_len
+        self.max_msg_len = max_msg_len
+        self.replace = replace
+        self.sparse = sparse
+
+        if diff_bounds is None:
+            self.diff_bounds = _bucket_bounds(max_diff_len, 16)
+        else:
+            self.diff_bounds = np.unique(
+                [b for b in diff_bounds if b < max_diff_len] + [max_diff_len]
+            )
+        if msg_bounds is None:
+            self.msg_bounds = _bucket_bounds(max_msg_len, 16)
+        else:
+            self.msg_bounds = np.unique(
+                [b for b in msg_bounds if b < max_msg_len] + [max_msg_len]
+            )
+
+        train = split_indices(self.corpus, cv_train_split, 'train')
+        # lengths of the encodings, see `encode_diff` and `encode_msg`
+        diff_lens = np.minimum(self.corpus.diff_lengths()[train] + 1,
+                               max_diff_len)
+        msg_lens = np.minimum(self.corpus.msg_lengths()[train] + 2,
+                              max_msg_len)
+        diff_bucket = np.searchsorted(self.diff_bounds, diff_lens)
+        msg_bucket = np.searchsorted(self.msg_bounds, msg_lens)
+
+        key = diff_bucket * len(self.msg_bounds) + msg_bucket
+        order = np.argsort(key, kind='stable')
+        keys, starts = np.unique(key[order], return_index=True)
+        order = train[order]
+        self.buckets = [
+            (int(self.diff_bounds[k // len(self.msg_bounds)]),
+             int(self.msg_bounds[k % len(self.msg_bounds)]),
+             indices)
+            for k, indices in zip(keys, np.split(order, starts[1:]))
+        ]
+
+    @property
+    def batches_per_epoch(self) -> int:
+        """
+        Number of batches yielded per epoch when `replace` is False.
+        """
+        return int(sum(np.ceil(len(b[2]) / self.batch_size)
+                       for b in self.buckets))
+
+    def _batch(self, diff_len: int, msg_len: int,
+               indices: np.ndarray) -> Tuple:
+        diffs = [self.corpus.diff(i, self.max_diff_len) for i in indices]
+        msgs = [self.corpus.msg(i, self.max_msg_len) for i in indices]
+        return encode_batch(diffs, msgs, diff_len, msg_len, self.sparse)
+
+    def __iter__(self) -> Iterator[Tuple]:
+        if not self.buckets:
+            raise ValueError('No training data to sample from.')
+        sizes = np.array([len(b[2]) for b in self.buckets], dtype=np.float64)
+        while True:
+            if self.replace:
+                b = np.random.choice(len(self.buckets), p=sizes / sizes.sum())
+                diff_len, msg_len, indices = self.buckets[b]
+                chosen = np.random.choice(indices, self.batch_size)
+                yield self._batch(diff_len, msg_len, chosen)
+                continue
+
+            batches = []
+            for diff_len, msg_len, indices in self.buckets:
+                indices = np.random.permutation(indices)
+                for i in range(0, len(indices), self.batch_size):
+                    batches.append((diff_len, msg_len,
+                                    indices[i:i + self.batch_size]))
+            for b in np.random.permutation(len(batches)):
+                yield self._batch(*batches[b])
+
+
+class CommitSequence(Sequence):
+    """
+    A `keras.utils.Sequence` over the training portion of a processed
+    repo. Batches can be read in any order, from several workers, and
+    in several processes (`use_multiprocessing=True`).
+
+    The commits are shuffled once per epoch by a permutation that only
+    depends on `seed` and the epoch number, so every worker agrees on
+    the content of every batch. With `num_shards > 1` the training
+    commits are split into disjoint shards, one per training process.
+
+    Over a multi-repo corpus with unequal weights (see
+    `dashm.data.multi`), an epoch instead draws as many commits, with
+    replacement, with probabilities proportional to their weights.
+    """
+
+    def __init__(self, repo_path: Union[str, Path], cv_train_split: float,
+                 batch_size: int, max_diff_len: int, max_msg_len: int,
+                 sparse: bool=False, seed: int=0, shard: int=0,
+                 num_shards: int=1, tokenizer: Optional[Tokenizer]=None):
+        """
+        Inputs
+        ------
+        repo_path : str or Path-like
+            A folder relative to `<project path>/data/processed-repos`,
+            or the path of a multi-repo manifest, see `dashm.data.multi`.
+        cv_train_split : float
+            Only the training portion of the data is used, see `load`.
+        batch_size : int
+            Number of commits per batch. The last batch of an epoch
+            may be smaller.
+        max_diff_len : int
+            Length of the diff encodings, see `format_batch`.
+        max_msg_len : int
+            Length of the message encodings, see `format_batch`.
+        sparse : bool
+            See `format_batch`.
+        seed : int
+            Seed of the per-epoch shuffling.
+        shard : int
+            Which shard, in `[0, num_shards)`, this sequence reads.
+        num_shards : int
+            Number of disjoint shards the training data is split into.
+        tokenizer : Tokenizer
+            If given, batches hold its token ids, see `load`. Requires
+            `sparse`.
+        """
+        if not 0 <= shard < num_shards:
+            raise ValueError('`shard` must be in [0, num_shards)')
+        self.repo_path = repo_path
+        self.batch_size = batch_size
+        self.max_diff_len = max_diff_len
+        self.max_msg_len = max_msg_len
+        self.sparse = sparse
+        self.seed = seed
+        self.tokenizer = tokenizer
+        self.epoch = 0
+
+        self._corpus = open_corpus(repo_path)
+        train = split_indices(self._corpus, cv_train_split, 'train')
+        self.indices = train[shard::num_shards]
+        self.p = None
+        if isinstance(self._corpus, MultiCorpus):
+            weights = self._corpus.commit_weights()[self.indices]
+            if len(weights) and weights.min() != weights.max():
+                self.p = weights / weights.sum()
+        # the commits of the epoch, in order, drawn once per epoch
+        self.order = self._order()
+
+    def __getstate__(self):
+        # memory maps cannot be pickled, workers re-open the corpus
+        state = self.__dict__.copy()
+        state['_corpus'] = None
+        return state
+
+    @property
+    def corpus(self) -> Union[PackedCorpus, _DirectoryCorpus, MultiCorpus]:
+        if self._corpus is None:
+            self._corpus = open_corpus(self.repo_path)
+        return self._corpus
+
+    def __len__(self) -> int:
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def _order(self) -> np.ndarray:
+        rng = np.random.RandomState([self.seed, self.epoch])
+        if self.p is None:
+            return rng.permutation(self.indices)
+        return rng.choice(self.indices, len(self.indices), p=self.p)
+
+    def __getitem__(self, idx: int) -> Tuple:
+        chosen = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+        if self.tokenizer is not None:
+            batch = [_encode_commit(self.corpus, i, self.max_diff_len,
+                                    self.max_msg_len, self.tokenizer)
+                     for i in chosen]
+            return format_batch(batch, self.max_diff_len, self.max_msg_len,
+                                self.sparse)
+        diffs = [self.corpus.diff(i, self.max_diff_len) for i in chosen]
+        msgs = [self.corpus.msg(i, self.max_msg_len) for i in chosen]
+        return encode_batch(diffs, msgs, self.max_diff_len,
+                            self.max_msg_len, self.sparse)
+
+    def on_epoch_end(self) -> None:
+        self.epoch += 1
+        self.order = self._order()
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""
+Utils to train on many processed repos at once.
+
+A multi-repo corpus is described by a JSON manifest
+
+    {"repos": [{"name": "<processed repo>", "weight": 1.0,
+                "n_commits": 1234, "stamp": 1700000000000000000}, ...]}
+
+written by `write_manifest`. It is opened by
+`dashm.data.load.open_corpus` like a single repo, when given the path
+of the manifest, and has the same interface as the corpus of a single
+repo, the commits of the repos following each other in manifest order.
+
+The sizes in the manifest let commits be sampled without opening, or
+globbing, the folder of every repo: a repo is only opened the first
+time one of its commits is read. The stamp, the modification time of
+the `.manifest` of the processed repo, tells which repos were processed
+again since: their commits are counted again when the corpus is
+opened. The train/validation split is that of each repo, see
+`dashm.data.load.split_indices`.
+"""
+
+import os
+import json
+import warnings
+from pathlib import Path
+import argparse
+from typing import Union, List, Optional, Dict
+
+import numpy as np
+
+from .humanify_git import humanify
+from .process_data import MANIFEST
+
+
+def is_manifest(repo_path: Union[str, Path]) -> bool:
+    """
+    Whether `repo_path` names a multi-repo manifest, not a repo.
+    """
+    return str(repo_path).endswith('.json')
+
+
+def _stamp(repo: str) -> int:
+    """
+    Modification time of the manifest of a processed repo, which
+    changes whenever commits are extracted, 0 if it has none.
+    """
+    path = Path(__file__).parents[2] / 'data/processed-repos' / repo
+    try:
+        return os.stat(str(path / MANIFEST)).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def write_manifest(path: Union[str, Path], repos: List[str],
+                   weights: Optional[List[float]]=None) -> dict:
+    """
+    Count the commits of every repo, and write the manifest of a
+    multi-repo corpus to `path`. Run it again after processing new
+    commits.
+
+    Inputs
+    ------
+    path : str or Path-like
+        Where to write the manifest, a `.json` file.
+    repos : List of str
+        Folders relative to `<project path>/data/processed-repos`, or
+        absolute paths to processed repos.
+    weights : List of float
+        Relative sampling weight of the commits of each repo, 1 by
+        default. A commit of a repo with weight 2 is drawn twice as
+        often as a commit of a repo with weight 1.
+
+    Returns
+    -------
+    manifest : dict
+        The content written.
+    """
+    from .load import open_corpus  # imports keras
+
+    if not is_manifest(path):
+        raise ValueError('The manifest must be a .json file')
+    if weights is None:
+        weights = [1.0] * len(repos)
+    if len(weights) != len(repos):
+        raise ValueError('`weights` must have one weight per repo')
+    if any(w < 0 for w in weights):
+        raise ValueError('`weights` must be non-negative')
+    manifest = {'repos': [
+        {'name': str(repo), 'weight': float(weight),
+         'n_commits': len(open_corpus(repo)), 'stamp': _stamp(str(repo))}
+        for repo, weight in zip(repos, weights)
+    ]}
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class MultiCorpus():
+    """
+    The commits of several processed repos, read through the corpus
+    of each repo, see `dashm.data.load.open_corpus`.
+    """
+
+    def __init__(self, manifest_path: Union[str, Path]):
+        """
+        Inputs
+        ------
+        manifest_path : str or Path-like
+            A manifest written by `write_manifest`. The repos processed
+            again since it was written are opened to count their
+            commits, with a warning.
+        """
+        with open(manifest_path) as f:
+            repos = json.load(f)['repos']
+        self.names = [r['name'] for r in repos]
+        self.weights = np.array([r['weight'] for r in repos],
+                                dtype=np.float64)
+        self.sizes = np.array([r['n_commits'] for r in repos],
+                              dtype=np.int64)
+        self._corpora = {}  # type: Dict[int, object]
+        self._split = {}  # type: Dict[tuple, np.ndarray]
+
+        stale = [r for r, repo in enumerate(repos)
+                 if 'stamp' in repo and repo['stamp'] != _stamp(repo['name'])]
+        if stale:
+            from .load import open_corpus  # circular import
+            for r in stale:
+                self._corpora[r] = open_corpus(self.names[r])
+                self.sizes[r] = len(self._corpora[r])
+            warnings.warn(
+                '{} processed again since {} was written, their commits'
+                ' were counted again. Write the manifest again to skip'
+                ' this.'.format(', '.join(self.names[r] for r in stale),
+                                manifest_path)
+            )
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+
+    def __getstate__(self):
+        # the corpora may hold memory maps, workers re-open them
+        state = self.__dict__.copy()
+        state['_corpora'] = {}
+        return state
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def corpus(self, r: int):
+        """
+        The corpus of the r-th repo, opened on first use.
+        """
+        if r not in self._corpora:
+            from .load import open_corpus  # circular import
+            corpus = open_corpus(self.names[r])
+            if len(corpus) != self.sizes[r]:
+                raise ValueError(
+                    '{} has {} commits, not {} as in the manifest. Write'
+                    ' the manifest again.'.format(self.names[r],
+                                                  len(corpus),
+                                                  self.sizes[r])
+                )
+            self._corpora[r] = corpus
+        return self._corpora[r]
+
+    def _locate(self, i: int):
+        if not 0 <= i < len(self):
+            raise IndexError('Commit index out of range')
+        r = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return self.corpus(r), i - int(self.offsets[r])
+
+    @property
+    def shas(self) -> List[str]:
+        return [sha for r in range(len(self.names))
+                for sha in self.corpus(r).shas]
+
+    @property
+    def split_keys(self) -> List[str]:
+        return [key for r in range(len(self.names))
+                for key in self.corpus(r).split_keys]
+
+    def msg_lengths(self) -> np.ndarray:
+        return np.concatenate([self.corpus(r).msg_lengths()
+                               for r in range(len(self.names))]
+                              + [np.zeros(0, dtype=np.int64)])
+
+    def diff_lengths(self) -> np.ndarray:
+        return np.concatenate([self.corpus(r).diff_lengths()
+                               for r in range(len(self.names))]
+                              + [np.zeros(0, dtype=np.int64)])
+
+    def msg(self, i: int, maxlen: int=-1):
+        corpus, j = self._locate(i)
+        return corpus.msg(j, maxlen)
+
+    def diff(self, i: int, maxlen: int=-1):
+        corpus, j = self._locate(i)
+        return corpus.diff(j, maxlen)
+
+    def commit_weights(self) -> np.ndarray:
+        """
+        The sampling weight of every commit, from the manifest only.
+        """
+        return np.repeat(self.weights, self.sizes)
+
+    def _split_indices(self, r: int, cv_train_split: float, which: str,
+                       shard: int, num_shards: int) -> np.ndarray:
+        key = (r, cv_train_split, which, shard, num_shards)
+        if key not in self._split:
+            from .load import split_indices  # circular import
+            indices = split_indices(self.corpus(r), cv_train_split, which)
+            self._split[key] = indices[shard::num_shards] + self.offsets[r]
+        return self._split[key]
+
+    def sample(self, cv_train_split: float,
+               rng: np.random.RandomState=np.random, shard: int=0,
+               num_shards: int=1, which: str='train') -> int:
+        """
+        Draw the index of a training commit. The repo is drawn with a
+        probability proportional to its weight times its number of
+        commits, then one of its training commits uniformly. Only the
+        repos drawn are opened.
+
+        Inputs
+        ------
+        cv_train_split : float
+            See `dashm.data.load.split_indices`.
+        rng : numpy.random.RandomState
+            Source of randomness.
+        shard, num_shards : int
+            Only draw from the `shard`-th of `num_shards` disjoint
+            parts of the training commits of every repo.
+        which : str
+            One of 'train' or 'val', to draw a validation commit
+            the same way instead.
+        """
+        p = self.weights * self.sizes
+        for _ in range(len(self.names)):
+            if not p.sum():
+                break
+            r = rng.choice(len(p), p=p / p.sum())
+            indices = self._split_indices(r, cv_train_split, which, shard,
+                                          num_shards)
+            if len(indices):
+                return int(indices[rng.randint(len(indices))])
+            p = p.copy()
+            p[r] = 0  # nothing to draw in this repo
+        raise ValueError('No {} data to sample from.'.format(
+            'training' if which == 'train' else 'validation'
+        ))
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description='Write the manifest of a multi-repo training corpus'
+    )
+    p.add_argument('manifest', type=str,
+                   help='Path of the manifest, a .json file.')
+    p.add_argument('repos', type=str, nargs='+',
+                   help=('Processed repos, as folder names of folders that'
+                         ' exist in "<project path>/data/processed-repos/"'
+                         ' or git repos whose human-ish names are used.'
+                         ' Append "=<weight>" to sample the commits of a'
+                         ' repo more, or less, often.'))
+
+    args = p.parse_args()
+
+    repos, weights = [], []
+    for repo in args.repos:
+        repo, _, weight = repo.rpartition('=') if '=' in repo else (
+            repo, '', '1'
+        )
+        if ':' in repo:
+            repo = humanify(repo)
+        repos.append(repo)
+        weights.append(float(weight))
+    manifest = write_manifest(args.manifest, repos, weights)
+    print('{} commits in {} repos'.format(
+        sum(r['n_commits'] for r in manifest['repos']), len(repos)
+    ))
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Utils to pack a processed repo into a few large files, and to read
+them back without copying.
+
+The packed corpus lives in `<processed repo>/packed/` and consists of
+
+    msgs.bin  : every commit message, concatenated
+    diffs.bin : every commit diff, concatenated
+    index.npz : the sorted commit SHAs, their split keys (see
+                `dashm.data.load.split_indices`) and the offsets of
+                each message/diff into the two blobs
+
+The commit `shas[i]` has message `msgs.bin[msg_offsets[i]:msg_offsets[i+1]]`
+and similarly for its diff.
+"""
+
+import os
+import mmap
+from pathlib import Path
+import argparse
+from typing import Union, Dict
+
+import numpy as np
+
+from .humanify_git import humanify
+from .dedup import read_index
+
+PACKED = 'packed'
+
+
+def _resolve(repo_path: Union[str, Path]) -> Path:
+    repo_path = Path(repo_path)
+    if not repo_path.is_absolute():
+        repo_path = (Path(__file__).parents[2] / 'data/processed-repos'
+                     / repo_path)
+    return repo_path
+
+
+def pack(repo_path: Union[str, Path], remove: bool=False) -> Path:
+    """
+    Convert the `<commit-hash>.msg` and `<commit-hash>.diff` files of a
+    processed repo into the packed format. If the repo was deduplicated
+    (see `dashm.data.dedup`), only the canonical commits are packed.
+
+    If the repo was packed before, the commits already packed are kept,
+    so that packing again after `dashm.data.process_data.process`
+    extracted new commits adds them, even if the files of the commits
+    packed before were removed.
+
+    Inputs
+    ------
+    repo_path : str or Path-like
+        Absolute path to the processed repo, or a folder in
+        `<project path>/data/processed-repos`.
+    remove : bool
+        If True, delete the per-commit files once they are packed.
+
+    Returns
+    -------
+    packed_path : Path
+        The folder holding the packed corpus.
+    """
+    repo_path = _resolve(repo_path)
+    dst_path = repo_path / PACKED
+    commits = {f.stem: f.parent / f.stem for f in repo_path.glob('*.diff')}
+    dedup_index = read_index(repo_path)
+
+    old = None
+    old_rows = {}  # type: Dict[str, int]
+    if (dst_path / 'index.npz').exists():
+        old = PackedCorpus(dst_path)
+        old_rows = {sha: i for i, sha in enumerate(old.shas)}
+    packed = [sha for sha in sorted(set(commits) | set(old_rows))
+              if dedup_index.get(sha, ('', sha))[1] == sha]
+
+    def key(sha):
+        # packed before keys were stored: split by commit SHA
+        default = old.split_keys[old_rows[sha]] if sha in old_rows else sha
+        return dedup_index.get(sha, (default, ''))[0]
+
+    dst_path.mkdir(exist_ok=True)
+
+    msg_offsets = np.zeros(len(packed) + 1, dtype=np.int64)
+    diff_offsets = np.zeros(len(packed) + 1, dtype=np.int64)
+    with open(dst_path / 'msgs.bin.tmp', 'wb') as msgs, \
+            open(dst_path / 'diffs.bin.tmp', 'wb') as diffs:
+        for i, sha in enumerate(packed):
+            if sha in commits:
+                with open(commits[sha].with_suffix('.msg'), 'rb') as fp:
+                    msg = fp.read()
+                with open(commits[sha].with_suffix('.diff'), 'rb') as fp:
+                    diff = fp.read()
+            else:
+                msg = old.msg(old_rows[sha])
+                diff = old.diff(old_rows[sha])
+            msg_offsets[i + 1] = msg_offsets[i] + msgs.write(msg)
+            diff_offsets[i + 1] = diff_offsets[i] + diffs.write(diff)
+
+    shas = np.array([sha.encode('ascii') for sha in packed], dtype=bytes)
+    keys = np.array([key(sha).encode('ascii') for sha in packed],
+                    dtype=bytes)
+    with open(dst_path / 'index.npz.tmp', 'wb') as fp:
+        np.savez(fp, shas=shas, keys=keys, msg_offsets=msg_offsets,
+                 diff_offsets=diff_offsets)
+    old = None  # release the memory maps of the previous pack
+
+    # index.npz goes last, its presence marks a complete corpus
+    for name in ['msgs.bin', 'diffs.bin', 'index.npz']:
+        os.replace(str(dst_path / (name + '.tmp')), str(dst_path / name))
+
+    if remove:
+        for c in commits.values():
+            c.with_suffix('.msg').unlink()
+            c.with_suffix('.diff').unlink()
+
+    return dst_path
+
+
+def _map(filename: Path) -> Union[mmap.mmap, bytes]:
+    with open(filename, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b''  # empty files cannot be mapped
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PackedCorpus():
+    """
+    Read-only, memory-mapped access to a packed corpus.
+    """
+
+    def __init__(self, packed_path: Union[str, Path]):
+        """
+        Inputs
+        ------
+        packed_path : str or Path-like
+            The folder written by `pack`.
+        """
+        packed_path = Path(packed_path)
+        with np.load(packed_path / 'index.npz') as index:
+            self.shas = [s.decode('ascii') for s in index['shas']]
+            # packed before keys were stored: split by commit SHA
+            self.split_keys = ([k.decode('ascii') for k in index['keys']]
+                               if 'keys' in index else self.shas)
+            self.msg_offsets = index['msg_offsets']
+            self.diff_offsets = index['diff_offsets']
+        self._msgs = memoryview(_map(packed_path / 'msgs.bin'))
+        self._diffs = memoryview(_map(packed_path / 'diffs.bin'))
+
+    def __len__(self) -> int:
+        return len(self.shas)
+
+    def msg_lengths(self) -> np.ndarray:
+        """
+        Length in bytes of every message, without reading them.
+        """
+        return np.diff(self.msg_offsets)
+
+    def diff_lengths(self) -> np.ndarray:
+        """
+        Length in bytes of every diff, without reading them.
+        """
+        return np.diff(self.diff_offsets)
+
+    @staticmethod
+    def _slice(blob: memoryview, offsets: np.ndarray, i: int,
+               maxlen: int) -> memoryview:
+        start, end = int(offsets[i]), int(offsets[i + 1])
+        if maxlen >= 0:
+            end = min(end, start + maxlen)
+        return blob[start:end]
+
+    def msg(self, i: int, maxlen: int=-1) -> memoryview:
+        """
+        Zero-copy view of the first `maxlen` bytes of the i-th message.
+        If `maxlen` is negative, the whole message is returned.
+        """
+        return self._slice(self._msgs, self.msg_offsets, i, maxlen)
+
+    def diff(self, i: int, maxlen: int=-1) -> memoryview:
+        """
+        Zero-copy view of the first `maxlen` bytes of the i-th diff.
+        If `maxlen` is negative, the whole diff is returned.
+        """
+        return self._slice(self._diffs, self.diff_offsets, i, maxlen)
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description='Pack a processed repo into a single-file corpus'
+    )
+    p.add_argument('repo', type=str,
+                   help=('Absolute path to processed repo, or folder name'
+                         ' of a folder that exists in'
+                         ' "<project path>/data/processed-repos/".'
+                         ' Alternatively, can be a git repo where we will'
+                         ' use the human-ish portion of the git repo.'))
+    p.add_argument('--remove', action='store_true',
+                   help='Delete the per-commit files once packed.')
+
+    args = p.parse_args()
+
+    repo = args.repo
+    if ':' in repo:
+        repo = humanify(repo)
+    pack(repo, remove=args.remove)
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
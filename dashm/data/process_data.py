@@ -5,15 +5,403 @@ Utils to process git repos into something more usable and save
 the result back to disk.
 """
 
+import shutil
 import subprocess as sp
 from pathlib import Path
 import argparse
-from typing import Union
+import threading
+import fnmatch
+from concurrent.futures import ProcessPoolExecutor
+from typing import (Union, List, Iterable, Iterator, Tuple, IO, Set,
+                    Optional)
 
 from .humanify_git import humanify
+from .dedup import dedup, DEDUP
+from .pack import PACKED, pack
+from .. import profiling
 
+MANIFEST = '.manifest'
+# Format of the manifest and of the commits it records. Bump it when
+# the commits extracted change, processed repos of another format are
+# then extracted again from scratch.
+MANIFEST_FORMAT = 2
 
-def process(repo_path: Union[str, Path]) -> None:
+# Lockfiles and generated files, matched against the path and the file
+# name of every file in a diff, see `filter_diff`.
+DEFAULT_EXCLUDE = [
+    '*.lock', 'package-lock.json', 'npm-shrinkwrap.json', 'go.sum',
+    '*.min.js', '*.min.css', '*.map', '*_pb2.py', '*.pb.go', '*.pb.cc',
+    '*.pb.h', '*.svg',
+]
+# Markers of generated code in the first lines of an added file
+_GENERATED = [b'@generated', b'DO NOT EDIT']
+_HEADER_LINES = 5
+
+
+def _feed(stream: IO[bytes], lines: Iterable[bytes]) -> None:
+    try:
+        for line in lines:
+            stream.write(line)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+class _GitStream():
+    """
+    Runs a single git command whose stdin is fed from a background
+    thread, so that its stdout can be consumed incrementally without
+    either pipe filling up and dead-locking the other.
+    """
+
+    def __init__(self, args: List[str], lines: Iterable[bytes],
+                 cwd: Union[str, Path]):
+        self.args = ['git'] + args
+        self.proc = sp.Popen(self.args, stdin=sp.PIPE, stdout=sp.PIPE,
+                             cwd=cwd)
+        self._feeder = threading.Thread(target=_feed,
+                                        args=(self.proc.stdin, lines),
+                                        daemon=True)
+        self._feeder.start()
+
+    @property
+    def stdout(self) -> IO[bytes]:
+        return self.proc.stdout
+
+    def close(self) -> None:
+        """
+        Wait for git to exit, raising `CalledProcessError` on failure.
+        """
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        self._feeder.join()
+        if returncode:
+            raise sp.CalledProcessError(returncode, self.args)
+
+
+def _split_records(stream: IO[bytes], sep: bytes=b'\0',
+                   chunk_size: int=1 << 16) -> Iterator[bytes]:
+    buffered = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        records = (buffered + chunk).split(sep)
+        buffered = records.pop()
+        yield from records
+    if buffered:
+        yield buffered
+
+
+def stream_messages(repo_path: Union[str, Path],
+                    commits: List[str]) -> Iterator[Tuple[str, bytes]]:
+    """
+    Read the commit messages of `commits` in a single `git log` call.
+
+    Inputs
+    ------
+    repo_path : str or Path-like
+        The path to the git repo.
+    commits : list of str
+        The SHAs of the commits whose messages are wanted.
+
+    Returns
+    -------
+    generator yielding
+        (sha, msg) : The commit SHA and its message, byte-for-byte the
+            output of `git log --pretty=%B -n 1 <sha>`.
+    """
+    git = _GitStream(['log', '--no-walk=unsorted', '--stdin', '-z',
+                      '--pretty=tformat:%H%n%B'],
+                     (c.encode('ascii') + b'\n' for c in commits),
+                     repo_path)
+    for record in _split_records(git.stdout):
+        sha, _, msg = record.partition(b'\n')
+        yield sha.decode('ascii'), msg + b'\n'
+    git.close()
+
+
+def stream_diffs(repo_path: Union[str, Path],
+                 pairs: List[Tuple[str, str]]) -> Iterator[Tuple[str, bytes]]:
+    """
+    Read the diffs between each pair of commits in a single
+    `git diff-tree --stdin` call.
+
+    Inputs
+    ------
+    repo_path : str or Path-like
+        The path to the git repo.
+    pairs : list of (str, str)
+        Tuples `(new, old)` of commit SHAs. The diff yielded is the
+        same as `git diff <old> <new>`.
+
+    Returns
+    -------
+    generator yielding
+        (sha, diff) : The SHA `new` and the diff, one per pair, in order.
+    """
+    git = _GitStream(['diff-tree', '--stdin', '-p', '-M', '--always'],
+                     ('{} {}\n'.format(new, old).encode('ascii')
+                      for new, old in pairs),
+                     repo_path)
+    # diff-tree starts each diff with a line holding just the SHA of the
+    # first commit on the input line. No line of a patch can look like that.
+    headers = ((new + '\n').encode('ascii') for new, _ in pairs)
+    expected = next(headers, None)
+    current = None
+    lines = []  # type: List[bytes]
+    for line in git.stdout:
+        if line == expected:
+            if current is not None:
+                yield current, b''.join(lines)
+            current = line.rstrip(b'\n').decode('ascii')
+            expected = next(headers, None)
+            lines = []
+        else:
+            lines.append(line)
+    if current is not None:
+        yield current, b''.join(lines)
+    git.close()
+
+
+def _path(header: bytes) -> str:
+    """
+    The destination path of a `diff --git a/<path> b/<path>` line.
+    """
+    path = header.rstrip(b'\n').rpartition(b' b/')[2].strip(b'"')
+    return path.decode('utf-8', 'replace')
+
+
+def _excluded(section: bytes, exclude: List[str],
+              keep_binary: bool) -> bool:
+    header, _, body = section.partition(b'\n')
+    path = _path(header)
+    name = path.rpartition('/')[2]
+    if any(fnmatch.fnmatchcase(path, pattern)
+           or fnmatch.fnmatchcase(name, pattern) for pattern in exclude):
+        return True
+    if not keep_binary and (b'\nBinary files ' in section
+                            or b'\nGIT binary patch' in section):
+        return True
+    hunk = body.find(b'\n@@')
+    if hunk >= 0 and b'\nnew file mode ' in b'\n' + body[:hunk]:
+        lines = body[hunk + 1:].split(b'\n', _HEADER_LINES + 1)
+        top = b'\n'.join(line for line in lines[1:_HEADER_LINES + 1]
+                         if line.startswith(b'+'))
+        return any(marker in top for marker in _GENERATED)
+    return False
+
+
+def filter_diff(diff: bytes, exclude: Optional[List[str]]=None,
+                keep_binary: bool=False, max_bytes: int=-1,
+                strip_context: bool=False) -> bytes:
+    """
+    Remove the parts of a diff the model cannot learn from.
+
+    Inputs
+    ------
+    diff : bytes
+        A diff as output by `git diff`.
+    exclude : list of str
+        Glob patterns of the files to remove from the diff, matched
+        against both the path and the file name. Defaults to
+        `DEFAULT_EXCLUDE`. Added files with a generated-code marker,
+        "@generated" or "DO NOT EDIT", in their first lines are
+        removed too.
+    keep_binary : bool
+        If False (default), binary files are removed.
+    max_bytes : int
+        If non-negative, the diff is cut at the last line ending
+        within its first `max_bytes` bytes, or at `max_bytes` if
+        there is none.
+    strip_context : bool
+        If True, the unchanged context lines of every hunk are removed.
+
+    Returns
+    -------
+    diff : bytes
+        The filtered diff, possibly empty.
+    """
+    if exclude is None:
+        exclude = DEFAULT_EXCLUDE
+    sections = diff.split(b'\ndiff --git ')
+    sections = sections[:1] + [b'diff --git ' + s for s in sections[1:]]
+    kept = []
+    for section in sections:
+        if not section:
+            continue
+        if not section.endswith(b'\n'):
+            section += b'\n'
+        if section.startswith(b'diff --git ') and _excluded(
+                section, exclude, keep_binary):
+            continue
+        if strip_context:
+            section = b''.join(line for line in
+                               section.splitlines(keepends=True)
+                               if not line.startswith(b' '))
+        kept.append(section)
+    diff = b''.join(kept)
+    if 0 <= max_bytes < len(diff):
+        end = diff.rfind(b'\n', 0, max_bytes) + 1
+        diff = diff[:end or max_bytes]
+    return diff
+
+
+def read_manifest(dst_path: Union[str, Path]) -> Tuple[Set[str], str]:
+    """
+    Read the manifest of a processed repo.
+
+    The manifest is an append-only text file `<dst_path>/.manifest`.
+    It starts with a line `format <MANIFEST_FORMAT>`. A line
+    `<commit> <parent>` is appended as soon as the files of commit
+    (diffed against its first parent) are fully written, and a line
+    `HEAD <sha>` is appended when a run of `process` completes.
+
+    Inputs
+    ------
+    dst_path : str or Path-like
+        The folder holding the processed repo.
+
+    Returns
+    -------
+    done : set of str
+        The `<commit> <parent>` lines of finished commits.
+    head : str
+        The HEAD seen by the last completed run, or '' if none.
+    """
+    done = set()
+    head = ''
+    try:
+        with open(Path(dst_path) / MANIFEST) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('HEAD '):
+                    head = line[len('HEAD '):]
+                elif line and not line.startswith('format '):
+                    done.add(line)
+    except FileNotFoundError:
+        pass
+    return done, head
+
+
+def manifest_format(dst_path: Union[str, Path]) -> int:
+    """
+    The format of the manifest of a processed repo, 0 if it has none.
+    Manifests written before the format was recorded, which paired
+    every commit with the one after it in the log, are format 1.
+    """
+    try:
+        with open(Path(dst_path) / MANIFEST) as f:
+            first = f.readline().split()
+    except FileNotFoundError:
+        return 0
+    if len(first) == 2 and first[0] == 'format':
+        return int(first[1])
+    return 1
+
+
+def _start_over(dst_path: Path) -> None:
+    """
+    Remove the extracted commits, the manifest, the index of duplicates
+    and the packed corpus of a processed repo, and start a new manifest.
+    """
+    for pattern in ['*.msg', '*.diff']:
+        for f in dst_path.glob(pattern):
+            f.unlink()
+    for name in [DEDUP, PACKED]:
+        if (dst_path / name).is_dir():
+            shutil.rmtree(str(dst_path / name))
+        elif (dst_path / name).exists():
+            (dst_path / name).unlink()
+    with open(dst_path / MANIFEST, 'w') as manifest:
+        manifest.write('format {}\n'.format(MANIFEST_FORMAT))
+
+
+def _extract(repo_path: Path, dst_path: Path,
+             pairs: List[Tuple[str, str]], filters: dict) -> int:
+    """
+    Write the `.msg` and `.diff` files for each pair `(commit, parent)`.
+    The diff from parent to commit, filtered by `filter_diff(**filters)`,
+    is stored alongside commit. Commits whose filtered diff is empty are
+    not written. Each finished commit is recorded in the manifest.
+    Returns the number of pairs extracted.
+    """
+    with profiling.timer('process.messages'):
+        for commit, msg in stream_messages(repo_path,
+                                           [c for c, _ in pairs]):
+            with open(dst_path / (commit + '.msg'), 'wb') as f:
+                f.write(msg)
+
+    parents = dict(pairs)
+    with profiling.timer('process.diffs'), \
+            open(dst_path / MANIFEST, 'a') as manifest:
+        for commit, diff in stream_diffs(repo_path, pairs):
+            with profiling.timer('process.filter'):
+                diff = filter_diff(diff, **filters)
+            if diff:
+                with open(dst_path / (commit + '.diff'), 'wb') as f:
+                    f.write(diff)
+            else:
+                profiling.count('process.skipped_empty')
+                (dst_path / (commit + '.msg')).unlink()
+            manifest.write('{} {}\n'.format(commit, parents[commit]))
+            manifest.flush()
+
+    profiling.count('process.commits', len(pairs))
+    return len(pairs)
+
+
+def _split(seq: List, n: int) -> List[List]:
+    """
+    Split `seq` into `n` contiguous ranges of (nearly) equal size.
+    """
+    k, m = divmod(len(seq), n)
+    bounds = [i * k + min(i, m) for i in range(n + 1)]
+    return [seq[a:b] for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def _process_pairs(repo_path: Path, dst_path: Path, done: Set[str],
+                   jobs: int, merges: bool, filters: dict) -> int:
+    """
+    Extract every commit not already in `done`, diffed against its
+    first parent, using `jobs` worker processes. Root commits are
+    skipped, and merges too unless `merges` is True. Returns the number
+    of commits extracted.
+    """
+    with profiling.timer('process.log'):
+        log = sp.check_output(['git', 'log', '--pretty=%H %P'],
+                              cwd=repo_path)
+    pairs = []
+    for line in log.decode('ascii').splitlines():
+        commit, *parents = line.split()
+        if not parents or (len(parents) > 1 and not merges):
+            continue
+        if '{} {}'.format(commit, parents[0]) not in done:
+            pairs.append((commit, parents[0]))
+
+    if jobs > 1 and len(pairs) > 1:
+        ranges = _split(pairs, jobs)
+        with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+            futures = [pool.submit(_extract, repo_path, dst_path, r,
+                                   filters)
+                       for r in ranges]
+            for future in futures:
+                future.result()
+    elif pairs:
+        _extract(repo_path, dst_path, pairs, filters)
+    return len(pairs)
+
+
+def process(repo_path: Union[str, Path], jobs: int=1,
+            incremental: bool=True, deduplicate: bool=True,
+            near_duplicates: bool=False, merges: bool=False,
+            exclude: Optional[List[str]]=None, keep_binary: bool=False,
+            max_diff_bytes: int=1 << 16,
+            strip_context: bool=False) -> None:
     """
     Processes the commits in the git repo found at `repo_path`.
     If `repo_path` is not absolute, then it is assumed to be
@@ -26,14 +414,59 @@ def process(repo_path: Union[str, Path]) -> None:
         <commit-hash>.msg
         <commit-hash>.diff
 
+    where the diff is that of the commit against its first parent,
+    with the files the model cannot learn from removed, see
+    `filter_diff`. Root commits, merge commits (unless `merges`) and
+    commits left with an empty diff are skipped.
+
     A file called `<repo name>.dashm` will also be created
     in the destination.
 
+    Already processed commits are tracked in a manifest (see
+    `read_manifest`), so that re-running only extracts new commits
+    and an interrupted run resumes where it stopped. If the repo was
+    packed (see `dashm.data.pack`), the new commits are added to the
+    pack. A repo processed with another format (see `MANIFEST_FORMAT`),
+    e.g. by an older version of this function, is extracted again from
+    scratch, and the commits it no longer extracts are removed.
+
+    The whole history is read in one streaming pass with a constant
+    number of git processes, see `stream_messages` and `stream_diffs`.
+
+    Duplicate commits are then grouped by the content hash of their
+    diffs and messages, see `dashm.data.dedup`. Only one commit per
+    group is loaded for training, and the train/validation split is
+    decided by the content hash.
+
     Inputs
     ------
     repo : str or Path-like
         The path to the git repo. Either an absolute path, or
         a folder within `<project path>/data/raw-repos`.
+    jobs : int
+        Number of worker processes. If greater than 1, the commits
+        are split into contiguous ranges which are extracted in
+        parallel. The output is identical to the serial path.
+    incremental : bool
+        If True (default), skip commits recorded in the manifest.
+        If False, the processed repo is removed and every commit is
+        extracted again.
+    deduplicate : bool
+        If True (default), update the index of duplicate commits.
+    near_duplicates : bool
+        If True, also group commits with similar diffs, see
+        `dashm.data.dedup.dedup`. Pass it on every run, a run without
+        it only keeps the exact duplicate groups.
+    merges : bool
+        If True, merge commits are diffed against their first parent,
+        otherwise (default) they are skipped.
+    exclude, keep_binary, strip_context : see `filter_diff`
+    max_diff_bytes : int
+        Diffs are cut to at most this many bytes, negative to keep
+        them whole. See `filter_diff`.
+
+    The filters only apply to the commits extracted by this run, use
+    `incremental=False` to apply new filters to every commit.
     """
     repo_path = Path(repo_path)
     if not repo_path.is_absolute():
@@ -43,17 +476,27 @@ def process(repo_path: Union[str, Path]) -> None:
     dst_path /= repo_path.parts[-1]
     dst_path.mkdir(parents=True, exist_ok=True)
 
-    commits = sp.check_output(['git', 'log', '--pretty=%H'], cwd=repo_path)
-    commits = commits.decode('ascii').split()
+    if not incremental or manifest_format(dst_path) != MANIFEST_FORMAT:
+        _start_over(dst_path)
+    done, last_head = read_manifest(dst_path)
+    head = sp.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_path)
+    head = head.decode('ascii').strip()
 
-    message_command = ['git', 'log', '--pretty=%B', '-n', '1']
-    diff_command = ['git', 'diff', '-n', '1']
-    for commit0, commit1 in zip(commits[:-1], commits[1:]):
-        with open(dst_path / (commit1 + '.msg'), 'w') as f:
-            sp.check_call(message_command + [commit1], stdout=f, cwd=repo_path)
-        with open(dst_path / (commit1 + '.diff'), 'w') as f:
-            sp.check_call(diff_command + [commit1, commit0],
-                          stdout=f, cwd=repo_path)
+    if head != last_head:
+        filters = {'exclude': exclude, 'keep_binary': keep_binary,
+                   'max_bytes': max_diff_bytes,
+                   'strip_context': strip_context}
+        n = _process_pairs(repo_path, dst_path, done, jobs, merges,
+                           filters)
+        if deduplicate:
+            with profiling.timer('process.dedup'):
+                dedup(dst_path, near_duplicates=near_duplicates)
+        if n and (dst_path / PACKED / 'index.npz').exists():
+            # the pack is preferred when loading, add the new commits
+            with profiling.timer('process.pack'):
+                pack(dst_path)
+        with open(dst_path / MANIFEST, 'a') as manifest:
+            manifest.write('HEAD {}\n'.format(head))
 
     # create the .dashm file if it does not already exist
     with open(str(dst_path) + '.dashm', 'a'):
@@ -69,13 +512,48 @@ def cli():
                          ' that exists in "<project path>/data/raw-repos/".'
                          ' Alternatively, can be a git repo where we will'
                          ' use the human-ish portion of the git repo.'))
+    p.add_argument('--jobs', type=int, default=1,
+                   help=('Number of worker processes used to extract'
+                         ' commits in parallel.'))
+    p.add_argument('--full', action='store_true',
+                   help=('Remove the processed commits and extract every'
+                         ' commit again, instead of only the ones missing'
+                         ' from the manifest.'))
+    p.add_argument('--merges', action='store_true',
+                   help=('Also extract merge commits, diffed against their'
+                         ' first parent.'))
+    p.add_argument('--exclude', action='append', default=[],
+                   help=('Glob pattern of files left out of the diffs, on'
+                         ' top of the lockfiles and generated files left'
+                         ' out by default. Can be repeated.'))
+    p.add_argument('--keep-binary', dest='keep_binary', action='store_true',
+                   help='Keep the changes to binary files in the diffs.')
+    p.add_argument('--max-diff-bytes', dest='max_diff_bytes', type=int,
+                   default=1 << 16,
+                   help=('Cut the diffs to at most this many bytes. Use -1'
+                         ' to keep them whole.'))
+    p.add_argument('--strip-context', dest='strip_context',
+                   action='store_true',
+                   help='Remove the unchanged context lines of the diffs.')
+    p.add_argument('--no-dedup', dest='deduplicate', action='store_false',
+                   help='Do not look for duplicate commits.')
+    p.add_argument('--near-duplicates', dest='near_duplicates',
+                   action='store_true',
+                   help=('Also group commits with similar diffs, found'
+                         ' by MinHash.'))
 
     args = p.parse_args()
 
     repo = args.repo
     if ':' in repo:
         repo = humanify(repo)
-    process(repo)
+    process(repo, jobs=args.jobs, incremental=not args.full,
+            deduplicate=args.deduplicate,
+            near_duplicates=args.near_duplicates, merges=args.merges,
+            exclude=DEFAULT_EXCLUDE + args.exclude,
+            keep_binary=args.keep_binary,
+            max_diff_bytes=args.max_diff_bytes,
+            strip_context=args.strip_context)
 
 
 if __name__ == '__main__':
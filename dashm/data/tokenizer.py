@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""
+A byte-pair encoding (BPE) tokenizer, so that sequences are made of
+frequent chunks of text instead of single characters, several times
+shorter than the character encodings of `dashm.data.encode`.
+
+The token ids extend those of the characters:
+
+    0, 1     : MSG_BEGIN and DIFF_END/MSG_END, as in `encode`
+    2..127   : the (clipped) characters, as in `encode`
+    128      : PAD, never produced by `encode`
+    129..    : one token per merge, in the order they were learned
+
+so the markers and padding mean the same with and without a tokenizer.
+The text is split into words (runs of letters, of digits, of other
+symbols, and whitespace) and merges never cross word boundaries.
+
+Only depends on numpy, so that inference does not need to import keras.
+"""
+
+import re
+import json
+import heapq
+import argparse
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Union, Optional, List, Tuple, Dict, Iterable
+
+import numpy as np
+
+from .encode import DIFF_END, MSG_BEGIN, MSG_END, PAD
+
+TOKENIZER_FILE = 'tokenizer.json'
+
+# Id of the token made by the first merge.
+FIRST_MERGE = PAD + 1
+
+_WORDS = re.compile(rb' ?[A-Za-z_]+| ?[0-9]+| ?[^\sA-Za-z0-9_]+'
+                    rb'|\s+(?!\S)|\s+')
+_CLIP = bytes(min(max(b, 2), 127) for b in range(256))
+
+_DIFF_END = DIFF_END[0]
+_MSG_BEGIN = MSG_BEGIN[0]
+_MSG_END = MSG_END[0]
+
+
+def _words(text: bytes) -> List[bytes]:
+    """
+    Clip the bytes as `encode.encode_diff` does, and split them into
+    the words merges are learned within.
+    """
+    return _WORDS.findall(bytes(text).translate(_CLIP))
+
+
+def _merge(ids: List[int], pair: Tuple[int, int], new_id: int) -> List[int]:
+    merged = []
+    i = 0
+    while i < len(ids):
+        if i + 1 < len(ids) and (ids[i], ids[i + 1]) == pair:
+            merged.append(new_id)
+            i += 2
+        else:
+            merged.append(ids[i])
+            i += 1
+    return merged
+
+
+class Tokenizer():
+    """
+    Encode text into token ids by applying learned merges, see `fit`.
+    """
+
+    # Encodings of words already seen are kept, up to this many.
+    cache_size = 1 << 16
+
+    def __init__(self, merges: List[Tuple[int, int]]):
+        """
+        Inputs
+        ------
+        merges : List of (int, int)
+            The pairs of ids merged into the ids `FIRST_MERGE`,
+            `FIRST_MERGE + 1`, ... in order.
+        """
+        self.merges = [(int(a), int(b)) for a, b in merges]
+        self.ranks = {pair: i for i, pair in enumerate(self.merges)}
+        self.vocab = [bytes([i]) for i in range(PAD)] + [b'']
+        for a, b in self.merges:
+            self.vocab.append(self.vocab[a] + self.vocab[b])
+        self._cache = {}  # type: Dict[bytes, List[int]]
+
+    @property
+    def vocab_size(self) -> int:
+        """
+        Number of token ids, including PAD.
+        """
+        return len(self.vocab)
+
+    @property
+    def max_token_len(self) -> int:
+        """
+        Number of bytes of the longest token.
+        """
+        return max(len(v) for v in self.vocab)
+
+    def _encode_word(self, word: bytes) -> List[int]:
+        ids = self._cache.get(word)
+        if ids is not None:
+            return ids
+        ids = list(word)
+        while len(ids) > 1:
+            pair = min(zip(ids, ids[1:]),
+                       key=lambda p: self.ranks.get(p, len(self.ranks)))
+            rank = self.ranks.get(pair)
+            if rank is None:
+                break
+            ids = _merge(ids, pair, FIRST_MERGE + rank)
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[word] = ids
+        return ids
+
+    def encode(self, text: bytes) -> np.ndarray:
+        """
+        Encode the given bytes into a 1D uint16 array of token ids,
+        without any markers.
+        """
+        ids = [i for word in _words(text) for i in self._encode_word(word)]
+        return np.array(ids, dtype=np.uint16)
+
+    def encode_diff(self, text: bytes, max_len: int=-1) -> np.ndarray:
+        """
+        Same as `encode.encode_diff`, with token ids.
+
+        Inputs
+        ------
+        text : bytes-like
+            The diff to be encoded.
+        max_len : int
+            If not negative, only keep the first `max_len` tokens,
+            before the DIFF_END marker.
+
+        Returns
+        -------
+        x : 1D uint16 numpy array of values in [0, vocab_size)
+        """
+        ids = self.encode(text)
+        if max_len >= 0:
+            ids = ids[:max_len]
+        return np.concatenate([ids, np.array([_DIFF_END], np.uint16)])
+
+    def encode_msg(self, text: bytes, max_len: int=-1) -> np.ndarray:
+        """
+        Same as `encode.encode_msg`, with token ids.
+
+        Inputs
+        ------
+        text : bytes-like
+            The commit message to be encoded.
+        max_len : int
+            If not negative, only keep the first `max_len` tokens,
+            between the MSG_BEGIN and MSG_END markers.
+
+        Returns
+        -------
+        x : 1D uint16 numpy array of values in [0, vocab_size)
+        """
+        ids = self.encode(text)
+        if max_len >= 0:
+            ids = ids[:max_len]
+        return np.concatenate([np.array([_MSG_BEGIN], np.uint16), ids,
+                               np.array([_MSG_END], np.uint16)])
+
+    def decode(self, ids: Iterable[int]) -> bytes:
+        """
+        The bytes of the given token ids. PAD is dropped.
+        """
+        return b''.join(self.vocab[int(i)] for i in ids)
+
+    def save(self, path: Union[str, Path]) -> None:
+        with open(path, 'w') as f:
+            json.dump({'merges': self.merges}, f)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'Tokenizer':
+        with open(path) as f:
+            return cls(json.load(f)['merges'])
+
+
+def fit(texts: Iterable[bytes], vocab_size: int=1024) -> Tokenizer:
+    """
+    Learn the merges of a tokenizer from the given texts: the most
+    frequent pair of adjacent ids is repeatedly merged into a new id,
+    until there are `vocab_size` ids or no pair appears twice.
+
+    Inputs
+    ------
+    texts : iterable of bytes-like
+        e.g. the diffs and messages of the training commits.
+    vocab_size : int
+        Number of token ids, between `FIRST_MERGE` and 65536.
+
+    Returns
+    -------
+    tokenizer : Tokenizer
+    """
+    if not FIRST_MERGE <= vocab_size <= 1 << 16:
+        raise ValueError('`vocab_size` must be in [{}, 65536]'
+                         .format(FIRST_MERGE))
+    counts = Counter()  # type: Counter
+    for text in texts:
+        counts.update(_words(text))
+
+    words = [list(w) for w in counts]
+    freqs = list(counts.values())
+    pair_counts = Counter()  # type: Counter
+    where = defaultdict(set)  # type: Dict[Tuple[int, int], set]
+    for i, (word, freq) in enumerate(zip(words, freqs)):
+        for pair in zip(word, word[1:]):
+            pair_counts[pair] += freq
+            where[pair].add(i)
+    # max-heap of the pair counts, entries are outdated once the
+    # count of their pair changes
+    heap = [(-c, pair) for pair, c in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges = []  # type: List[Tuple[int, int]]
+    while FIRST_MERGE + len(merges) < vocab_size and heap:
+        c, pair = heapq.heappop(heap)
+        if pair_counts.get(pair) != -c:
+            continue
+        if -c < 2:
+            break
+        new_id = FIRST_MERGE + len(merges)
+        merges.append(pair)
+        changed = set()
+        for i in where.pop(pair):
+            word, freq = words[i], freqs[i]
+            for p in zip(word, word[1:]):
+                pair_counts[p] -= freq
+                changed.add(p)
+            word = words[i] = _merge(word, pair, new_id)
+            for p in zip(word, word[1:]):
+                pair_counts[p] += freq
+                where[p].add(i)
+                changed.add(p)
+        for p in changed:
+            if pair_counts[p] > 0:
+                heapq.heappush(heap, (-pair_counts[p], p))
+            else:
+                del pair_counts[p]
+                where.pop(p, None)
+    return Tokenizer(merges)
+
+
+def fit_corpus(repo_path: Union[str, Path], cv_train_split: float,
+               vocab_size: int=1024, max_bytes: int=1 << 24) -> Tokenizer:
+    """
+    `fit` a tokenizer on the training commits of a processed repo.
+
+    Inputs
+    ------
+    repo_path : str or Path-like
+        A folder relative to `<project path>/data/processed-repos`
+    cv_train_split : float
+        Only the training portion of the data is used, see
+        `dashm.data.load.load`.
+    vocab_size : int
+        See `fit`.
+    max_bytes : int
+        At most about this many bytes are read, split evenly between
+        the commits.
+
+    Returns
+    -------
+    tokenizer : Tokenizer
+    """
+    from .load import open_corpus, split_indices  # imports keras
+
+    corpus = open_corpus(repo_path)
+    train = split_indices(corpus, cv_train_split, 'train')
+    per_commit = max(max_bytes // max(len(train), 1) // 2, 1)
+
+    def texts():
+        for i in train:
+            yield corpus.diff(i, per_commit)
+            yield corpus.msg(i, per_commit)
+
+    return fit(texts(), vocab_size)
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description='Fit a byte-pair tokenizer on a processed repo'
+    )
+    p.add_argument('repo', type=str,
+                   help=('Folder name of a folder that exists in'
+                         ' "<project path>/data/processed-repos/".'))
+    p.add_argument('cross_validation_split', type=float,
+                   help=('Number between 0 and 1 indicating amount of'
+                         ' data used for training vs. validation.'))
+    p.add_argument('--vocab-size', dest='vocab_size', type=int,
+                   default=1024, help='Number of token ids.')
+    p.add_argument('--output', type=str, default=None,
+                   help='Save the tokenizer to this file.')
+
+    args = p.parse_args()
+
+    tokenizer = fit_corpus(args.repo, args.cross_validation_split,
+                           args.vocab_size)
+    if args.output is not None:
+        tokenizer.save(args.output)
+
+    from .load import open_corpus, split_indices  # imports keras
+    corpus = open_corpus(args.repo)
+    n_bytes = n_tokens = 0
+    for i in split_indices(corpus, args.cross_validation_split, 'val'):
+        for text in [corpus.diff(i), corpus.msg(i)]:
+            n_bytes += len(text)
+            n_tokens += len(tokenizer.encode(text))
+    print('{} tokens, {:.2f} bytes per token on the validation data'
+          .format(tokenizer.vocab_size, n_bytes / max(n_tokens, 1)))
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
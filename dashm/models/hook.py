@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+"""
+Git hooks to pre-fill commit messages with predictions.
+
+`install` sets up two hooks in a git repo:
+
+    prepare-commit-msg : writes the predicted message of the staged
+                         changes into the commit message, if it can be
+                         had within a hard time budget.
+    post-index-change  : runs after e.g. `git add`, and starts a
+                         background process predicting the message of
+                         the newly staged changes. The shell script
+                         first checks that the staged tree changed,
+                         so that index refreshes, e.g. by `git status`,
+                         do not start Python.
+
+Predictions are cached in `<git dir>/dashm-cache/<tree>.msg`, where
+`<tree>` is the hash of the staged tree (`git write-tree`), so they
+are ready by the time of `git commit`. The hook itself only reads the
+cache or asks a running `dashm.models.serve` server, it never loads a
+model. Only the background process falls back to loading one.
+"""
+
+import os
+import sys
+import time
+import fcntl
+import stat
+import subprocess as sp
+from pathlib import Path
+import argparse
+from typing import Union, Optional, List
+
+from . import serve
+
+CACHE_DIR = 'dashm-cache'
+CACHE_SIZE = 256
+HOOKS = ['prepare-commit-msg', 'post-index-change']
+MARKER = '# installed by dashm'
+WARMING = 'DASHM_WARMING'  # set in the environment of `warm` processes
+WARM_TREE = 'warm.tree'  # the staged tree last seen by `warm`
+
+# Ends the post-index-change hook before Python starts if the staged
+# tree is cached, or was already seen by `warm`.
+_TREE_CHANGED = (
+    '[ -z "${warming}" ] || exit 0\n'
+    'tree=$({warming}=1 git write-tree 2>/dev/null) || exit 0\n'
+    'cache="$(git rev-parse --absolute-git-dir)/{cache}"\n'
+    '[ ! -f "$cache/$tree.msg" ] || exit 0\n'
+    '[ "$(cat "$cache/{warm_tree}" 2>/dev/null)" != "$tree" ] || exit 0\n'
+).format(warming=WARMING, cache=CACHE_DIR, warm_tree=WARM_TREE)
+
+
+def _git(args: List[str], repo: Union[str, Path]) -> bytes:
+    return sp.check_output(['git'] + args, cwd=str(repo),
+                           stderr=sp.DEVNULL)
+
+
+def staged_tree(repo: Union[str, Path]='.') -> str:
+    """
+    Hash of the tree of the staged changes.
+    """
+    return _git(['write-tree'], repo).decode('ascii').strip()
+
+
+def staged_diff(repo: Union[str, Path]='.') -> bytes:
+    """
+    The diff of the staged changes against HEAD.
+    """
+    return _git(['diff', '--cached', '-M'], repo)
+
+
+def cache_dir(repo: Union[str, Path]='.') -> Path:
+    git_dir = _git(['rev-parse', '--absolute-git-dir'], repo)
+    return Path(git_dir.decode().strip()) / CACHE_DIR
+
+
+def read_cache(repo: Union[str, Path], tree: str) -> Optional[bytes]:
+    """
+    The message cached for the staged tree `tree`, or None.
+    """
+    try:
+        with open(cache_dir(repo) / (tree + '.msg'), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_cache(repo: Union[str, Path], tree: str, msg: bytes) -> None:
+    """
+    Cache the message of the staged tree `tree`, keeping the
+    `CACHE_SIZE` most recent messages.
+    """
+    path = cache_dir(repo)
+    path.mkdir(exist_ok=True)
+    tmp = path / '{}.{}.tmp'.format(tree, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(msg)
+    os.replace(str(tmp), str(path / (tree + '.msg')))
+
+    cached = sorted(path.glob('*.msg'), key=lambda f: f.stat().st_mtime)
+    for old in cached[:-CACHE_SIZE]:
+        try:
+            old.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _predict(diff: bytes, socket_path: Optional[str]=None) -> bytes:
+    """
+    Ask the server, or else load the model here, which is slow.
+    """
+    try:
+        return serve.request(diff, socket_path=socket_path)
+    except OSError:
+        from .predict import Predictor
+        return Predictor().predict(diff)
+
+
+def warm(repo: Union[str, Path]='.', socket_path: Optional[str]=None,
+         delay: float=0.0) -> None:
+    """
+    Predict and cache the message of the staged changes, unless
+    already cached. Only one process warms a repo at a time; it keeps
+    going until the message of the current staged tree is cached, so
+    that changes staged meanwhile are not missed. The tree is recorded
+    in `WARM_TREE`, and the post-index-change hook does not start
+    another process for it.
+
+    Inputs
+    ------
+    repo : str or Path-like
+        The git repo.
+    socket_path : str
+        Socket of the prediction server, see `serve.request`. If no
+        server answers, the model is loaded in this process.
+    delay : float
+        Seconds to wait first, so that a burst of `git add`s is
+        handled once.
+    """
+    time.sleep(delay)
+    path = cache_dir(repo)
+    path.mkdir(exist_ok=True)
+    with open(path / 'warm.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # the process holding the lock will see our changes
+        while True:
+            tree = staged_tree(repo)
+            (path / WARM_TREE).write_text(tree)
+            if read_cache(repo, tree) is not None:
+                return
+            diff = staged_diff(repo)
+            if not diff:
+                return
+            write_cache(repo, tree, _predict(diff, socket_path))
+
+
+def warm_in_background(repo: Union[str, Path]='.',
+                       socket_path: Optional[str]=None,
+                       delay: float=0.2) -> None:
+    """
+    Run `warm` in a detached process, and return immediately.
+    """
+    env = dict(os.environ)
+    env[WARMING] = '1'
+    root = str(Path(__file__).parents[2])
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in [root, env.get('PYTHONPATH')] if p
+    )
+    args = [sys.executable, '-m', 'dashm.models.hook', 'warm',
+            '--delay', str(delay)]
+    if socket_path is not None:
+        args += ['--socket', socket_path]
+    sp.Popen(args, cwd=str(repo), env=env, stdin=sp.DEVNULL,
+             stdout=sp.DEVNULL, stderr=sp.DEVNULL, start_new_session=True)
+
+
+def prepare_commit_msg(msg_file: Union[str, Path], source: str='',
+                       repo: Union[str, Path]='.', budget: float=1.0,
+                       socket_path: Optional[str]=None,
+                       warm_on_miss: bool=True) -> bool:
+    """
+    The prepare-commit-msg hook. Writes the predicted message at the
+    top of `msg_file`, if it is cached or a server predicts it within
+    `budget` seconds. Otherwise the message is left empty.
+
+    Inputs
+    ------
+    msg_file : str or Path-like
+        The file holding the commit message, given to the hook by git.
+    source : str
+        The source of the message, given to the hook by git. Nothing
+        is predicted unless it is empty (a plain `git commit`) or
+        "template".
+    repo : str or Path-like
+        The git repo.
+    budget : float
+        Seconds after which to give up.
+    socket_path : str
+        Socket of the prediction server, see `serve.request`.
+    warm_on_miss : bool
+        If the message was not cached, start a background `warm`, so
+        that it is the next time, e.g. after an aborted commit.
+
+    Returns
+    -------
+    filled : bool
+        True if a predicted message was written.
+    """
+    deadline = time.monotonic() + budget
+    if source not in ['', 'template']:
+        return False
+
+    tree = staged_tree(repo)
+    msg = read_cache(repo, tree)
+    if msg is None:
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            try:
+                msg = serve.request(staged_diff(repo), socket_path=socket_path,
+                                    timeout=remaining)
+            except (OSError, RuntimeError):
+                msg = None
+            else:
+                write_cache(repo, tree, msg)
+        if msg is None and warm_on_miss:
+            warm_in_background(repo, socket_path)
+    if not msg:
+        return False
+
+    with open(msg_file, 'rb') as f:
+        existing = f.read()
+    with open(msg_file, 'wb') as f:
+        f.write(msg.rstrip(b'\n') + b'\n' + existing)
+    return True
+
+
+def install(repo: Union[str, Path]='.', budget: float=1.0,
+            socket_path: Optional[str]=None, force: bool=False) -> List[Path]:
+    """
+    Install the hooks in the git repo `repo`. Hooks not installed by
+    dashm are only replaced if `force` is True.
+
+    Returns
+    -------
+    hooks : list of Path
+        The installed hook scripts.
+    """
+    hooks_dir = _git(['rev-parse', '--git-path', 'hooks'], repo)
+    hooks_dir = Path(repo) / hooks_dir.decode().strip()
+    hooks_dir.mkdir(parents=True, exist_ok=True)
+
+    options = ''
+    if socket_path is not None:
+        options = " --socket '{}'".format(socket_path)
+    root = Path(__file__).parents[2]
+
+    installed = []
+    for hook in HOOKS:
+        hook_options = options
+        check = ''
+        if hook == 'prepare-commit-msg':
+            hook_options += ' --budget {}'.format(budget)
+        else:
+            check = _TREE_CHANGED
+        script = hooks_dir / hook
+        if script.exists() and MARKER not in script.read_text() and not force:
+            raise FileExistsError('{} exists, use force to replace it'
+                                  .format(script))
+        script.write_text(
+            '#!/bin/sh\n'
+            '{marker}\n'
+            '{check}'
+            'PYTHONPATH="{root}${{PYTHONPATH:+:$PYTHONPATH}}" \\\n'
+            '    exec "{python}" -m dashm.models.hook {hook}{options} "$@"\n'
+            .format(marker=MARKER, check=check, root=root,
+                    python=sys.executable, hook=hook, options=hook_options)
+        )
+        script.chmod(script.stat().st_mode
+                     | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        installed.append(script)
+    return installed
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description='Git hooks pre-filling commit messages'
+    )
+    sub = p.add_subparsers(dest='command')
+    sub.required = True
+
+    def add(name, help):
+        command = sub.add_parser(name, help=help)
+        command.add_argument('--socket', type=str, default=None,
+                             help='Unix socket of the prediction server.')
+        return command
+
+    install_p = add('install', 'Install the hooks in the current repo.')
+    install_p.add_argument('--force', action='store_true',
+                           help='Replace existing hooks.')
+    for command in [install_p,
+                    add('prepare-commit-msg', 'The prepare-commit-msg hook.')]:
+        command.add_argument('--budget', type=float, default=1.0,
+                             help=('Seconds the hook may take before giving'
+                                   ' up on the prediction.'))
+    sub.choices['prepare-commit-msg'].add_argument('msg_file', type=str)
+    sub.choices['prepare-commit-msg'].add_argument('source', nargs='?',
+                                                   default='')
+    sub.choices['prepare-commit-msg'].add_argument('sha', nargs='?')
+    add('post-index-change', 'The post-index-change hook.').add_argument(
+        'flags', nargs='*'
+    )
+    add('warm', 'Cache the message of the staged changes.').add_argument(
+        '--delay', type=float, default=0.0,
+        help='Seconds to wait before starting.'
+    )
+
+    args = p.parse_args()
+
+    if args.command == 'install':
+        for script in install(budget=args.budget, socket_path=args.socket,
+                              force=args.force):
+            print('Installed', script)
+    elif args.command == 'prepare-commit-msg':
+        try:
+            prepare_commit_msg(args.msg_file, args.source,
+                               budget=args.budget, socket_path=args.socket)
+        except Exception:
+            pass  # never stop the commit
+    elif args.command == 'post-index-change':
+        # the git commands of `warm` itself can write the index
+        if not os.environ.get(WARMING):
+            warm_in_background(socket_path=args.socket)
+    else:
+        warm(socket_path=args.socket, delay=args.delay)
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+"""
+A NumPy-only implementation of the encoder and decoder models, so
+that predictions can be made without importing keras.
+
+`export` dumps the weights of a saved model to `inference.npz` in the
+model folder, and `load_numpy_models` reads them back into objects
+with the same `predict` interface as the keras encoder/decoder.
+"""
+
+import json
+import struct
+import zipfile
+from pathlib import Path
+import argparse
+from typing import Union, List, Tuple, Dict, Optional
+
+import numpy as np
+
+INFERENCE_FILE = 'inference.npz'
+
+ENCODER_LAYERS = ['encoder_embedding', 'encoder_1', 'encoder_2', 'encoded']
+DECODER_LAYERS = ['decoder_embedding', 'decoder_1', 'decoder_2', 'decoded',
+                  'hidden_1', 'hidden_2', 'probs']
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+
+def _relu(x):
+    return np.maximum(x, 0.0)
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def _linear(x):
+    return x
+
+
+ACTIVATIONS = {
+    'sigmoid': _sigmoid,
+    'hard_sigmoid': _hard_sigmoid,
+    'relu': _relu,
+    'softmax': _softmax,
+    'tanh': np.tanh,
+    'linear': _linear,
+}
+
+
+def export(model_dir: Union[str, Path]) -> Path:
+    """
+    Export the encoder and decoder weights of a saved model to
+    `<model_dir>/inference.npz`.
+
+    Inputs
+    ------
+    model_dir : str or Path-like
+        Folder holding the saved model, see `predict.load_models`.
+
+    Returns
+    -------
+    path : Path
+        The exported file.
+    """
+    from .predict import load_models  # imports keras
+
+    _, encoder, decoder = load_models(model_dir)
+    path = Path(model_dir) / INFERENCE_FILE
+    export_models(encoder, decoder, path)
+    return path
+
+
+def export_models(encoder, decoder, path: Union[str, Path]) -> None:
+    """
+    Export the weights of keras encoder and decoder models, as made
+    by `make_models`, to the `.npz` file `path`.
+    """
+    arrays = {}  # type: Dict[str, np.ndarray]
+    config = {}
+    for prefix, model, names in [('encoder', encoder, ENCODER_LAYERS),
+                                 ('decoder', decoder, DECODER_LAYERS)]:
+        layers = []
+        for name in names:
+            try:
+                layer = model.get_layer(name)
+            except ValueError:
+                continue  # e.g. no embedding
+            layer_config = layer.get_config()
+            kind = type(layer).__name__
+            entry = {'name': name, 'kind': kind}
+            if kind == 'GRU':
+                entry.update({
+                    'activation': layer_config['activation'],
+                    'recurrent_activation':
+                        layer_config['recurrent_activation'],
+                    'reset_after': layer_config.get('reset_after', False),
+                    'return_sequences': layer_config['return_sequences'],
+                })
+            elif kind == 'Dense':
+                entry['activation'] = layer_config['activation']
+            weight_names = {'Embedding': ['embeddings'],
+                            'GRU': ['kernel', 'recurrent_kernel', 'bias'],
+                            'Dense': ['kernel', 'bias']}[kind]
+            for weight_name, w in zip(weight_names, layer.get_weights()):
+                arrays['{}/{}/{}'.format(prefix, name, weight_name)] = w
+            layers.append(entry)
+        config[prefix] = layers
+
+    with open(path, 'wb') as f:
+        np.savez(f, config=np.array(json.dumps(config)), **arrays)
+
+
+class _NumpyModel():
+    def __init__(self, layers: List[dict], weights: Dict[str, np.ndarray]):
+        self.layers = layers
+        self.weights = weights
+
+    def _embed(self, name: str, x: np.ndarray) -> np.ndarray:
+        return self.weights[name + '/embeddings'][x]
+
+    def _dense(self, layer: dict, x: np.ndarray) -> np.ndarray:
+        name = layer['name']
+        y = x @ self.weights[name + '/kernel'] + self.weights[name + '/bias']
+        return ACTIVATIONS[layer['activation']](y)
+
+    def _gru(self, layer: dict, x: np.ndarray,
+             h: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Run a GRU over `x` of shape (batch, time, features) starting from
+        state `h` of shape (batch, units). Returns the outputs, of shape
+        (batch, time, units) or (batch, units), and the final state.
+        """
+        name = layer['name']
+        kernel = self.weights[name + '/kernel']
+        recurrent = self.weights[name + '/recurrent_kernel']
+        bias = self.weights[name + '/bias']
+        act = ACTIVATIONS[layer['activation']]
+        rec_act = ACTIVATIONS[layer['recurrent_activation']]
+        units = recurrent.shape[0]
+
+        if layer['reset_after']:
+            input_bias, recurrent_bias = bias[0], bias[1]
+        else:
+            input_bias, recurrent_bias = bias, np.zeros_like(bias)
+
+        # the input projections of every step at once
+        xs = x @ kernel + input_bias
+        outputs = np.empty(x.shape[:2] + (units,), dtype=xs.dtype)
+        for t in range(x.shape[1]):
+            x_z = xs[:, t, :units]
+            x_r = xs[:, t, units:2 * units]
+            x_h = xs[:, t, 2 * units:]
+            if layer['reset_after']:
+                rec = h @ recurrent + recurrent_bias
+                z = rec_act(x_z + rec[:, :units])
+                r = rec_act(x_r + rec[:, units:2 * units])
+                hh = act(x_h + r * rec[:, 2 * units:])
+            else:
+                rec = h @ recurrent[:, :2 * units]
+                z = rec_act(x_z + rec[:, :units])
+                r = rec_act(x_r + rec[:, units:])
+                hh = act(x_h + (r * h) @ recurrent[:, 2 * units:])
+            h = z * h + (1 - z) * hh
+            outputs[:, t] = h
+
+        if layer['return_sequences']:
+            return outputs, h
+        return h, h
+
+    def _zeros(self, layer: dict, batch: int) -> np.ndarray:
+        units = self.weights[layer['name'] + '/recurrent_kernel'].shape[0]
+        return np.zeros((batch, units), dtype=np.float32)
+
+
+class NumpyEncoder(_NumpyModel):
+    """
+    NumPy equivalent of the keras encoder model.
+    """
+
+    def predict(self, x: np.ndarray, **_) -> np.ndarray:
+        return self.step(x)[-1]
+
+    def step(self, x: np.ndarray, states: Optional[List[np.ndarray]]=None
+             ) -> List[np.ndarray]:
+        """
+        Run the encoder over `x`, with every GRU starting from its
+        state in `states` (default: zeros), and return the final state
+        of every GRU. Feeding a diff chunk by chunk, each time with the
+        states returned for the previous chunk, gives the same final
+        state as `predict` on the whole diff.
+        """
+        out = []
+        for layer in self.layers:
+            if layer['kind'] == 'Embedding':
+                x = self._embed(layer['name'], x)
+            else:
+                h = (self._zeros(layer, len(x)) if states is None
+                     else states[len(out)])
+                x, state = self._gru(layer, x, h)
+                out.append(state)
+        return out
+
+
+class NumpyDecoder(_NumpyModel):
+    """
+    NumPy equivalent of the keras decoder model.
+    """
+
+    def predict(self, inputs: List[np.ndarray],
+                **_) -> List[np.ndarray]:
+        x, state = inputs
+        first = True
+        for layer in self.layers:
+            if layer['kind'] == 'Embedding':
+                x = self._embed(layer['name'], x)
+            elif layer['kind'] == 'GRU':
+                # only the first GRU starts from the given state
+                h = state if first else self._zeros(layer, len(x))
+                first = False
+                x, state = self._gru(layer, x, h)
+            else:
+                x = self._dense(layer, x)
+        return [x, state]
+
+
+def inference_file(checkpoint: Optional[str]=None) -> str:
+    """
+    Name of the exported file of a checkpoint, see `train.train`.
+    DEFAULT: the latest one.
+    """
+    if checkpoint is None:
+        return INFERENCE_FILE
+    return 'inference-{}.npz'.format(checkpoint)
+
+
+def _read_npz(path: Union[str, Path]) -> Dict[str, np.ndarray]:
+    """
+    Read the arrays of a `.npz` file written by `np.savez`. The arrays
+    stored uncompressed are memory-mapped read-only instead of copied,
+    so the weights only take up (shared, reclaimable) page cache.
+    """
+    arrays = {}
+    with zipfile.ZipFile(str(path)) as zf, open(str(path), 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type == zipfile.ZIP_STORED:
+                # skip the local file header to the start of the .npy
+                f.seek(info.header_offset + 26)
+                name_len, extra_len = struct.unpack('<HH', f.read(4))
+                f.seek(name_len + extra_len, 1)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(f)
+                else:
+                    header = np.lib.format.read_array_header_2_0(f)
+                shape, fortran, dtype = header
+                if shape and np.prod(shape) and not dtype.hasobject:
+                    arrays[name] = np.memmap(
+                        f, dtype=dtype, mode='r', offset=f.tell(),
+                        shape=shape, order='F' if fortran else 'C'
+                    ).view(np.ndarray)
+                    continue
+            with zf.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member)
+    return arrays
+
+
+def load_numpy_models(model_dir: Union[str, Path],
+                      checkpoint: Optional[str]=None
+                      ) -> Tuple[NumpyEncoder, NumpyDecoder]:
+    """
+    Load the models exported by `export` from `model_dir`, or those
+    of the given checkpoint. The weights are memory-mapped.
+    """
+    weights = _read_npz(Path(model_dir) / inference_file(checkpoint))
+    config = json.loads(str(weights.pop('config')))
+
+    def prefixed(prefix):
+        return {k[len(prefix) + 1:]: v for k, v in weights.items()
+                if k.startswith(prefix + '/')}
+
+    return (NumpyEncoder(config['encoder'], prefixed('encoder')),
+            NumpyDecoder(config['decoder'], prefixed('decoder')))
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description='Export a saved model for NumPy-only inference'
+    )
+    p.add_argument('model_dir', type=str,
+                   help=('Folder of the saved model, relative to'
+                         ' "<project path>/models/saved/".'))
+
+    args = p.parse_args()
+
+    export(Path(__file__).parent / 'saved' / args.model_dir)
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
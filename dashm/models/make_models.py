@@ -3,17 +3,25 @@
 import os
 import io
 import contextlib
-from typing import Union, Tuple
+from typing import Union, Tuple, List
 
 f = io.StringIO()
 with contextlib.redirect_stderr(f):
-    from keras.layers import GRU, Input, Dense
+    from keras.layers import GRU, Input, Dense, Embedding
     from keras.models import Model
+    from keras import backend as K
+
+from ..data.encode import PAD
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 
-def make_models(summary: Union[bool, int]=True) -> Tuple[Model, Model, Model]:
+ENCODER_GRUS = ['encoder_1', 'encoder_2', 'encoded']
+
+
+def make_models(summary: Union[bool, int]=True, embedding_dim: int=0,
+                bptt_steps: int=0, vocab_size: int=0
+                ) -> Tuple[Model, Model, Model]:
     """
     Create the three models necessary for a seq2seq translation
     model, namely a model that can train the weights, a model
@@ -26,6 +34,21 @@ def make_models(summary: Union[bool, int]=True) -> Tuple[Model, Model, Model]:
         Whether a summary of the models should be printed to stdout.
         If True, use the line length of 80, otherwise if summary
         is an int > 0, it is used as the line length.
+    embedding_dim : int
+        If 0 (default), the inputs are (batch, time, 128) one-hot
+        encodings. Otherwise the inputs are (batch, time) integer
+        ids (see `dashm.data.load.encode_diff` and `PAD`), looked up
+        in an embedding of this size.
+    bptt_steps : int
+        If > 0, the trainer only backpropagates through the last
+        `bptt_steps` steps of the encoder, so that it can be trained
+        on long diffs (truncated backpropagation through time). The
+        diffs given to the trainer must then be longer than this.
+        The encoder and decoder models are the same either way.
+    vocab_size : int
+        If > 0, the ids are the tokens of a `dashm.data.tokenizer`
+        with this many ids instead of the 128 characters, and the
+        models predict tokens. Requires `embedding_dim`.
 
     Returns
     -------
@@ -37,28 +60,64 @@ def make_models(summary: Union[bool, int]=True) -> Tuple[Model, Model, Model]:
         Model repeatedly called to create the output during inference.
     """
 
+    if vocab_size and not embedding_dim:
+        raise ValueError('`vocab_size` requires `embedding_dim`')
+    # the embeddings have one extra id for padding
+    n_inputs, n_outputs = (vocab_size, vocab_size) if vocab_size else (
+        PAD + 1, 128
+    )
+
     hidden_params = {
         'return_sequences': True, 'return_state': False, 'activation': 'relu'
     }
     latent = 32
 
-    # Create the model that will train the weights
-    encoder_inp = Input(shape=(None, 128), name='encoder_input')
-
-    def encoder(x):
-        x = GRU(8, name='encoder_1', **hidden_params)(x)
-        x = GRU(16, name='encoder_2', **hidden_params)(x)
-        _, encoder_state = GRU(
-            latent, name='encoded', return_sequences=False,
-            return_state=True, activation='tanh'
-        )(x)
-        return encoder_state
+    if embedding_dim:
+        inp_shape = (None,)  # type: Tuple
+        inp_dtype = 'int32'
+        encoder_embedding = Embedding(n_inputs, embedding_dim,
+                                      name='encoder_embedding')
+        decoder_embedding = Embedding(n_inputs, embedding_dim,
+                                      name='decoder_embedding')
+    else:
+        inp_shape = (None, 128)
+        inp_dtype = 'float32'
 
-    encoder_state = encoder(encoder_inp)
+    # Create the model that will train the weights
+    encoder_inp = Input(shape=inp_shape, dtype=inp_dtype,
+                        name='encoder_input')
+
+    encoder_grus = [
+        GRU(8, name='encoder_1', **hidden_params),
+        GRU(16, name='encoder_2', **hidden_params),
+        GRU(latent, name='encoded', return_sequences=False,
+            return_state=True, activation='tanh'),
+    ]
 
-    decoder_inp = Input(shape=(None, 128), name='decoder_input')
+    def encoder(x, initial_states=None):
+        """
+        Returns the final state of every encoder GRU.
+        """
+        if embedding_dim:
+            x = encoder_embedding(x)
+        return _run_grus(encoder_grus, x, initial_states)
+
+    if bptt_steps:
+        # Run the start of the diffs forward only, and backpropagate
+        # through the rest starting from the states it ends in.
+        prefix_states = [K.stop_gradient(state) for state in
+                         encoder(encoder_inp[:, :-bptt_steps])]
+        encoder_state = encoder(encoder_inp[:, -bptt_steps:],
+                                prefix_states)[-1]
+    else:
+        encoder_state = encoder(encoder_inp)[-1]
+
+    decoder_inp = Input(shape=inp_shape, dtype=inp_dtype,
+                        name='decoder_input')
 
     def decoder(x, init_state):
+        if embedding_dim:
+            x = decoder_embedding(x)
         x = GRU(latent, name='decoder_1', **hidden_params)(
             x, initial_state=init_state
         )
@@ -73,7 +132,7 @@ def make_models(summary: Union[bool, int]=True) -> Tuple[Model, Model, Model]:
     hidden_layers = [
         Dense(32, activation='relu', name='hidden_1'),
         Dense(64, activation='relu', name='hidden_2'),
-        Dense(128, activation='softmax', name='probs')
+        Dense(n_outputs, activation='softmax', name='probs')
     ]
 
     def predictor(x):
@@ -86,6 +145,8 @@ def make_models(summary: Union[bool, int]=True) -> Tuple[Model, Model, Model]:
     training_model = Model([encoder_inp, decoder_inp], preds)
 
     # Create the model used to get encoding vector from input
+    if bptt_steps:
+        encoder_state = encoder(encoder_inp)[-1]
     encoder_model = Model(encoder_inp, encoder_state)
 
     # Create the model called repeatedly to build up the output stream
@@ -108,3 +169,55 @@ def make_models(summary: Union[bool, int]=True) -> Tuple[Model, Model, Model]:
         decoder_model.summary(line_length=line_length)
 
     return training_model, encoder_model, decoder_model
+
+
+def _run_grus(grus: List[GRU], x, initial_states=None) -> List:
+    """
+    Run the stacked `grus` over `x`, each starting from its initial
+    state (default: zeros), and return the final state of each.
+    """
+    states = []
+    for i, gru in enumerate(grus):
+        initial_state = None if initial_states is None else initial_states[i]
+        out = gru(x, initial_state=initial_state)
+        if gru.return_state:
+            x, state = out
+        else:
+            x = out
+            state = x[:, -1]  # the output of a GRU is its state
+        states.append(state)
+    return states
+
+
+def make_chunk_encoder(encoder_model: Model) -> Model:
+    """
+    Create a model running the encoder over a chunk of a diff, starting
+    from the states it ended in on the previous chunk. Running it over
+    consecutive chunks gives the same final state as running the
+    encoder over the whole diff, with memory bounded by the chunk size.
+
+    Inputs
+    ------
+    encoder_model : Model
+        The encoder made by `make_models`, whose layers are shared.
+
+    Returns
+    -------
+    chunk_encoder : Model
+        Takes the inputs `[x, state_1, state_2, state_3]`, with the
+        states of the GRUs in `ENCODER_GRUS`, and outputs their
+        states at the end of the chunk `x`.
+    """
+    inp = encoder_model.inputs[0]
+    x_inp = Input(shape=tuple(inp.shape[1:]), dtype=inp.dtype,
+                  name='chunk_input')
+    x = x_inp
+    try:
+        x = encoder_model.get_layer('encoder_embedding')(x)
+    except ValueError:
+        pass  # one-hot inputs
+    grus = [encoder_model.get_layer(name) for name in ENCODER_GRUS]
+    state_inps = [Input(shape=(gru.units,), name=gru.name + '_state')
+                  for gru in grus]
+    states = _run_grus(grus, x, state_inps)
+    return Model([x_inp] + state_inps, states)
@@ -1,32 +1,212 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
+import json
 import sys
+import argparse
+import asyncio
+import threading
+import time
 import unicodedata
-from typing import Union, Generator
+from typing import (Union, Generator, List, Tuple, Optional, Dict,
+                    AsyncIterator)
 
 import numpy as np
 
-from .make_models import make_models
-from ..data.load import one_hot_encode_diff, one_hot_encode_msg, MSG_END
+from .inference import load_numpy_models, inference_file
+from .state_cache import StateCache, fingerprint, diff_key, CACHE_DIR
+from .registry import Registry, Watcher
+from ..data.encode import (one_hot_encode_diff, one_hot_encode_msg, MSG_END,
+                           encode_diff, encode_diff_chunks, encode_msg,
+                           one_hot)
+from ..data.tokenizer import Tokenizer, TOKENIZER_FILE
+from .. import profiling
 
 
-def load_models(model_dir):
-    trainer, encoder, decoder = make_models(summary=False)
+def load_config(model_dir) -> dict:
+    """
+    Read the `config.json` saved next to the weights by `train`.
+    Models saved before it existed get the defaults.
+    """
+    config = {'embedding_dim': 0, 'bptt_steps': 0, 'vocab_size': 0}
+    try:
+        with open(Path(model_dir) / 'config.json') as f:
+            config.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    return config
+
+
+def weights_file(name: str, checkpoint: Optional[str]=None) -> str:
+    """
+    Name of the weights file of model `name` ("trainer", "encoder" or
+    "decoder") of a checkpoint, see `train.train`.
+    DEFAULT: the latest one.
+    """
+    if checkpoint is None:
+        return name + '.h5'
+    return '{}-{}.h5'.format(name, checkpoint)
 
-    trainer.load_weights(Path(model_dir) / 'trainer.h5')
-    encoder.load_weights(Path(model_dir) / 'encoder.h5')
-    decoder.load_weights(Path(model_dir) / 'decoder.h5')
+
+def load_models(model_dir, checkpoint: Optional[str]=None):
+    from .make_models import make_models  # imports keras, which is slow
+
+    config = load_config(model_dir)
+    trainer, encoder, decoder = make_models(
+        summary=False, embedding_dim=config['embedding_dim'],
+        bptt_steps=config['bptt_steps'], vocab_size=config['vocab_size']
+    )
+
+    for model, name in [(trainer, 'trainer'), (encoder, 'encoder'),
+                        (decoder, 'decoder')]:
+        model.load_weights(Path(model_dir) / weights_file(name, checkpoint))
 
     return trainer, encoder, decoder
 
 
+def _find_model_dir(model_dir=None) -> Tuple[Path, Optional[str]]:
+    """
+    Resolve the `model_dir` given to `Predictor` to a run folder and
+    checkpoint. Without `model_dir`, the checkpoint promoted in the
+    registry is used, or else the latest checkpoint of the most
+    recent run.
+    """
+    saved = Path(__file__).parent / 'saved'
+    if model_dir is None:
+        promoted = Registry(saved).promoted()
+        if promoted is not None:
+            return saved / promoted['run'], promoted['checkpoint']
+        model_dir = '*'
+    if Path(model_dir).is_absolute():
+        model_dirs = [Path(model_dir)] if Path(model_dir).is_dir() else []
+    else:
+        model_dirs = [d for d in saved.glob(str(model_dir)) if d.is_dir()]
+    if not model_dirs:
+        raise RuntimeError('No saved models found.')
+    return max(model_dirs), None
+
+
+class _Model():
+    """
+    Everything a `Predictor` loads from a checkpoint. Replaced as a
+    whole by `Predictor.swap`, so that a prediction which started with
+    one model finishes with it.
+    """
+
+    def __init__(self, model_dir: Path, checkpoint: Optional[str],
+                 engine: str, cache_size: int, disk_cache: bool,
+                 chunk_size: int):
+        if engine == 'auto':
+            exported = (model_dir / inference_file(checkpoint)).exists()
+            engine = 'numpy' if exported else 'keras'
+        if engine == 'numpy':
+            encoder, decoder = load_numpy_models(model_dir, checkpoint)
+            weight_files = [model_dir / inference_file(checkpoint)]
+        else:
+            _, encoder, decoder = load_models(model_dir, checkpoint)
+            weight_files = [model_dir / weights_file('encoder', checkpoint)]
+        self.model_dir = model_dir
+        self.checkpoint = checkpoint
+        self.engine = engine
+        self.encoder = encoder
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+        self._chunk_encoder = encoder if engine == 'numpy' else None
+
+        # Models with an embedding take integer ids instead of one-hot
+        # encodings, and are fed the id of the most likely character.
+        config = load_config(model_dir)
+        self.sparse = bool(config['embedding_dim'])
+        # ... or token, if trained with a tokenizer
+        self.tokenizer = None  # type: Optional[Tokenizer]
+        if config['vocab_size']:
+            self.tokenizer = Tokenizer.load(model_dir / TOKENIZER_FILE)
+        if self.sparse:
+            self.init_probs = encode_msg(b'')[None, 0:1].astype(np.int32)
+        else:
+            self.init_probs = np.expand_dims(one_hot_encode_msg(b'')[0:1], 0)
+
+        # the states depend on the weights used, keep them apart
+        self.cache = None  # type: Optional[StateCache]
+        if cache_size > 0 or disk_cache:
+            self.cache = StateCache(
+                '{}-{}'.format(engine, fingerprint(weight_files)),
+                maxsize=cache_size,
+                path=model_dir / CACHE_DIR if disk_cache else None
+            )
+
+    def encode_diff(self, diff: bytes) -> np.ndarray:
+        """
+        The compact encoding of the diff, see `encode.encode_diff`.
+        """
+        if self.tokenizer is None:
+            return encode_diff(diff)
+        return self.tokenizer.encode_diff(diff)
+
+    def decode(self, ids: Union[List[int], np.ndarray]) -> bytes:
+        """
+        The text of the predicted character, or token, ids.
+        """
+        if self.tokenizer is None:
+            return np.asarray(ids, dtype=np.uint8).tobytes()
+        return self.tokenizer.decode(ids)
+
+    def encode_chunks(self, diff: bytes) -> np.ndarray:
+        """
+        Encode the diff `chunk_size` bytes (or tokens) at a time,
+        carrying the states of the encoder GRUs from one chunk to the
+        next. Same as running the encoder on the whole diff, but the
+        memory used does not grow with its length.
+        """
+        if self._chunk_encoder is None:
+            self._chunk_encoder = _KerasChunkEncoder(self.encoder)
+        if self.tokenizer is None:
+            chunks = encode_diff_chunks(diff, self.chunk_size)
+        else:
+            ids = self.tokenizer.encode_diff(diff)
+            chunks = (ids[i:i + self.chunk_size]
+                      for i in range(0, len(ids), self.chunk_size))
+        states = None
+        for chunk in chunks:
+            if self.sparse:
+                x = chunk[None].astype(np.int32)
+            else:
+                x = one_hot(chunk[None])
+            states = self._chunk_encoder.step(x, states)
+        return states[-1]
+
+
+class _KerasChunkEncoder():
+    """
+    `inference.NumpyEncoder.step` for keras encoders,
+    see `make_models.make_chunk_encoder`.
+    """
+
+    def __init__(self, encoder):
+        from .make_models import make_chunk_encoder  # imports keras
+        self.model = make_chunk_encoder(encoder)
+
+    def step(self, x: np.ndarray, states: Optional[List[np.ndarray]]=None
+             ) -> List[np.ndarray]:
+        if states is None:
+            states = [np.zeros((len(x), int(inp.shape[-1])), np.float32)
+                      for inp in self.model.inputs[1:]]
+        return [np.asarray(state) for state in
+                self.model.predict_on_batch([x] + list(states))]
+
+
 class Predictor():
     """
     Make predictions using a model saved to disk.
+
+    Models trained with a tokenizer (see `data.tokenizer`) predict one
+    token per step instead of one character. The lengths and steps
+    below then count tokens, and the messages are the decoded text.
     """
 
-    def __init__(self, model_dir=None):
+    def __init__(self, model_dir=None, engine: str='auto',
+                 cache_size: int=256, disk_cache: bool=False,
+                 chunk_size: int=4096):
         """
         Inputs
         ------
@@ -34,52 +214,451 @@ class Predictor():
             Path to the folder containing the saved model, relative
             to `<project path>/models/saved/`. Should contain files
             "trainer.h5", "encoder.h5", and "decoder.h5".
-            DEFAULT: None, takes the most recent model.
+            DEFAULT: None, takes the checkpoint promoted in the
+            registry (see `registry.Registry`), or else the most
+            recent model.
+        engine : str
+            'numpy' to run the models with NumPy only from the
+            exported "inference.npz" (see `inference.export`),
+            'keras' to load the keras models, or 'auto' (default)
+            to use 'numpy' if "inference.npz" exists.
+        cache_size : int
+            Number of encoder states kept in memory by
+            `state_from_diff`, keyed by the diff contents.
+            0 disables the cache.
+        disk_cache : bool
+            If True, also store the encoder states on disk in
+            "<model_dir>/state-cache/", so they survive between runs.
+        chunk_size : int
+            Diffs at least this long are encoded in chunks of this
+            many bytes, so that long diffs do not take up memory in
+            proportion to their length. 0 disables chunking.
 
         See also
         --------
-            `load_models`
+            `load_models`, `state_cache.StateCache`, `swap`
         """
-        if model_dir is None:
-            model_dir = '*'
-        model_dir = str(model_dir)
-        model_dirs = list((Path(__file__).parent / 'saved').glob(model_dir))
-        if not model_dirs:
-            raise RuntimeError('No saved models found.')
-        model_dir = max(model_dirs)
+        if engine not in ['auto', 'numpy', 'keras']:
+            raise ValueError('`engine` must be one of'
+                             ' ["auto", "numpy", "keras"]')
+        self._options = {'engine': engine, 'cache_size': cache_size,
+                         'disk_cache': disk_cache, 'chunk_size': chunk_size}
+        self._model = _Model(*_find_model_dir(model_dir), **self._options)
+        self._swap_lock = threading.Lock()
+        self._watcher = None  # type: Optional[Watcher]
 
-        _, encoder, decoder = load_models(model_dir)
-        self.encoder = encoder
-        self.decoder = decoder
+    # The attributes of the current model, for convenience. Predictions
+    # take `self._model` once and use it throughout.
+    model_dir = property(lambda self: self._model.model_dir)
+    checkpoint = property(lambda self: self._model.checkpoint)
+    engine = property(lambda self: self._model.engine)
+    encoder = property(lambda self: self._model.encoder)
+    decoder = property(lambda self: self._model.decoder)
+    sparse = property(lambda self: self._model.sparse)
+    cache = property(lambda self: self._model.cache)
+
+    def swap(self, model_dir=None, checkpoint: Optional[str]=None) -> bool:
+        """
+        Load another model and switch to it. Predictions keep running
+        on the current model meanwhile, and those already started
+        finish with it. With the 'numpy' engine the weights are
+        memory-mapped, so the two models do not both take up memory.
 
-        self._init_probs = np.expand_dims(one_hot_encode_msg(b'')[0:1], 0)
+        Inputs
+        ------
+        model_dir : str or Path-like
+            As for `Predictor`. If given, `checkpoint` selects the
+            checkpoint of that run. DEFAULT: the promoted checkpoint.
+        checkpoint : str
+            e.g. "003" for the weights saved after the 4th epoch.
+
+        Returns
+        -------
+        swapped : bool
+            False if the model was already in use.
+        """
+        with self._swap_lock:
+            found_dir, found_checkpoint = _find_model_dir(model_dir)
+            if model_dir is not None:
+                found_checkpoint = checkpoint
+            current = self._model
+            if (found_dir, found_checkpoint) == (current.model_dir,
+                                                 current.checkpoint):
+                return False
+            model = _Model(found_dir, found_checkpoint, **self._options)
+            self._model = model  # a single, atomic assignment
+            return True
+
+    def follow_registry(self, interval: float=5.0,
+                        registry: Optional[Registry]=None) -> Watcher:
+        """
+        Swap to the promoted checkpoint of the registry in a background
+        thread whenever it changes. Call `.stop()` on the returned
+        watcher to stop following.
+        """
+        if self._watcher is not None:
+            self._watcher.stop()
+        registry = registry or Registry()
+
+        def swap(promoted):
+            self.swap(registry.saved_path / promoted['run'],
+                      promoted['checkpoint'])
+
+        self._watcher = Watcher(swap, registry, interval)
+        self._watcher.check()
+        self._watcher.start()
+        return self._watcher
 
     def state_from_diff(self, diff: Union[str, bytes]) -> np.ndarray:
         """
-        Get the state encoded from the given diff.
+        Get the state encoded from the given diff. States are looked
+        up in, and added to, the cache of the predictor.
 
         Inputs
         ------
         diff : str or bytes-like
             The git-diff to encode into a state passed to the decoder.
+
+        Returns
+        -------
+        state : numpy.ndarray
+            (1, state_size)-shaped array. Read-only if cached.
+        """
+        return self._state(self._model, diff)
+
+    @staticmethod
+    def _lookup(m: _Model, diff: bytes) -> Optional[np.ndarray]:
+        """
+        The cached state of the diff, or None.
         """
-        if isinstance(diff, str):
-            diff = unicodedata.normalize('NFKD', diff)
-            diff = diff.encode('ascii', 'ignore')
+        if m.cache is None:
+            return None
+        state = m.cache.get(diff_key(diff))
+        if state is not None:
+            profiling.count('predict.cache_hits')
         else:
-            # diff already given in bytes
-            pass
+            profiling.count('predict.cache_misses')
+        return state
+
+    @staticmethod
+    def _state(m: _Model, diff: Union[str, bytes]) -> np.ndarray:
+        diff = _to_bytes(diff)
+
+        state = Predictor._lookup(m, diff)
+        if state is not None:
+            return state
+
+        with profiling.timer('predict.encode'):
+            if m.chunk_size and len(diff) >= m.chunk_size:
+                state = m.encode_chunks(diff)
+            else:
+                if m.sparse:
+                    x = m.encode_diff(diff)[None].astype(np.int32)
+                else:
+                    x = np.expand_dims(one_hot_encode_diff(diff), 0)
+                state = m.encoder.predict(x)
+
+        if m.cache is not None:
+            state = m.cache.put(diff_key(diff), state)
+        return state
+
+    def states_from_diffs(self, diffs: List[Union[str, bytes]]
+                          ) -> np.ndarray:
+        """
+        Get the states encoded from the given diffs, the same as
+        `state_from_diff` gives them one at a time. States are looked
+        up in, and added to, the cache of the predictor, and diffs at
+        least `chunk_size` long are encoded in chunks.
+
+        The encoder does not mask padding, so the other diffs are not
+        padded to a common length: those of the same encoded length are
+        encoded together, in one call to the encoder per length.
+
+        Inputs
+        ------
+        diffs : List of str or bytes-like
+            The git-diffs to encode into states passed to the decoder.
+
+        Returns
+        -------
+        states : numpy.ndarray
+            (len(diffs), state_size)-shaped array
+        """
+        return self._states(self._model, diffs)
+
+    @staticmethod
+    def _states(m: _Model, diffs: List[Union[str, bytes]]) -> np.ndarray:
+        diffs = [_to_bytes(diff) for diff in diffs]
+        states = [None] * len(diffs)  # type: List
+        todo = []  # type: List[int]
+        for i, diff in enumerate(diffs):
+            if m.chunk_size and len(diff) >= m.chunk_size:
+                states[i] = Predictor._state(m, diff)
+            else:
+                states[i] = Predictor._lookup(m, diff)
+                if states[i] is None:
+                    todo.append(i)
+
+        if todo:
+            with profiling.timer('predict.encode'):
+                encoded = Predictor._encode_batch(m, [diffs[i]
+                                                      for i in todo])
+            for i, state in zip(todo, encoded):
+                states[i] = state[None]
+                if m.cache is not None:
+                    states[i] = m.cache.put(diff_key(diffs[i]), states[i])
+        return np.concatenate(states)
+
+    @staticmethod
+    def _encode_batch(m: _Model, diffs: List[bytes]) -> np.ndarray:
+        encoded = [m.encode_diff(diff) for diff in diffs]
+        groups = {}  # type: Dict[int, List[int]]
+        for i, e in enumerate(encoded):
+            groups.setdefault(len(e), []).append(i)
+        states = [None] * len(encoded)  # type: List
+        for group in groups.values():
+            x = np.stack([encoded[i] for i in group])
+            x = x.astype(np.int32) if m.sparse else one_hot(x)
+            for i, state in zip(group, m.encoder.predict(x)):
+                states[i] = state
+        return np.stack(states)
+
+    @staticmethod
+    def _decoder_step(m: _Model, inp: np.ndarray, states: np.ndarray
+                      ) -> Tuple[np.ndarray, np.ndarray]:
+        with profiling.timer('predict.decoder_step'):
+            return m.decoder.predict([inp, states])
+
+    @staticmethod
+    def _next_input(m: _Model, probs: np.ndarray) -> np.ndarray:
+        if m.sparse:
+            return probs.argmax(axis=-1).astype(np.int32)
+        return probs
+
+    def predict_proba_batch(self, diffs: List[Union[str, bytes]],
+                            n: int=300) -> np.ndarray:
+        """
+        Batched version of `predict_proba`. The diffs are encoded as
+        by `states_from_diffs` and all decoder states are advanced
+        together.
+
+        Inputs
+        ------
+        diffs : List of str or bytes-like
+            The git-diffs that we will try to summarize into messages.
+        n : int
+            Number of steps to predict.
+
+        Returns
+        -------
+        out_probs : numpy.ndarray
+            (len(diffs), n, num_characters)-shaped array
+        """
+        m = self._model
+        states = self._states(m, diffs)
+        inp = np.repeat(m.init_probs, len(states), axis=0)
+        out_probs = []
+        for _ in range(n):
+            probs, states = self._decoder_step(m, inp, states)
+            inp = self._next_input(m, probs)
+            out_probs.append(probs[:, -1])
+        return np.stack(out_probs, axis=1)
+
+    def predict_batch(self, diffs: List[Union[str, bytes]],
+                      max_len: int=300) -> List[bytes]:
+        """
+        Batched version of `predict`, giving the same messages. The
+        diffs are encoded as by `states_from_diffs` and all decoder
+        states are advanced together. Messages which
+        have emitted `dashm.data.load.MSG_END` drop out of the batch,
+        and decoding stops once every message is finished.
+
+        Inputs
+        ------
+        diffs : List of str or bytes-like
+            The git-diffs that we will try to summarize into messages.
+        max_len : int
+            Cut a message off if we get this many characters
+            without seeing the `dashm.data.load.MSG_END` character.
+
+        Returns
+        -------
+        msgs : List of bytes
+            The estimated commit messages, in the same order.
+        """
+        m = self._model
+        msg_end = ord(MSG_END)
+        states = self._states(m, diffs)
+        inp = np.repeat(m.init_probs, len(states), axis=0)
+        active = np.arange(len(states))
+        out = [[] for _ in active]  # type: List[List[int]]
+        for _ in range(max_len):
+            probs, states = self._decoder_step(m, inp, states)
+            chars = probs[:, -1].argmax(axis=-1)
+            for i, c in zip(active, chars):
+                out[i].append(int(c))
+            running = chars != msg_end
+            if not running.any():
+                break
+            active = active[running]
+            states = states[running]
+            inp = self._next_input(m, probs[running])
+        # 1:-1 to cut out MSG_BEGIN/MSG_END
+        return [m.decode(chars[1:-1]) for chars in out]
 
-        x = np.expand_dims(one_hot_encode_diff(diff), 0)
-        return self.encoder.predict(x)
+    @staticmethod
+    def _hard_input(m: _Model, chars: np.ndarray) -> np.ndarray:
+        """
+        Decoder input feeding back the chosen characters `chars`.
+        """
+        if m.sparse:
+            return chars[:, None].astype(np.int32)
+        return one_hot(chars[:, None])
 
-    def _proba_generator(self, state) -> Generator[np.ndarray, None, None]:
+    def predict_beam(self, diff: Union[str, bytes], k: int=5,
+                     max_len: int=300) -> List[Tuple[bytes, float]]:
+        """
+        Predict the `k` most likely commit messages for the given diff
+        with beam search. All beams are advanced together in a single
+        decoder call per step.
+
+        Unlike `predict`, which feeds the decoder its own probabilities,
+        the decoder is fed the character chosen for each beam. The first
+        decoded character is the start of the message, only MSG_END is
+        cut.
+
+        Inputs
+        ------
+        diff : str or bytes-like
+            The git-diff that we will try to summarize into a message.
+        k : int
+            The beam width, and the number of candidates returned.
+        max_len : int
+            Stop a beam if we get this many characters without seeing
+            the `dashm.data.load.MSG_END` character.
+
+        Returns
+        -------
+        candidates : List of (bytes, float)
+            Up to `k` messages and their log-probabilities, most
+            likely first.
+        """
+        m = self._model
+        msg_end = ord(MSG_END)
+        states = self._state(m, diff)
+        inp = m.init_probs
+        tokens = np.zeros((1, 0), dtype=np.int64)
+        scores = np.zeros(1)
+        finished = []  # type: List[Tuple[bytes, float]]
+
+        for _ in range(max_len):
+            probs, states = self._decoder_step(m, inp, states)
+            logp = np.log(np.maximum(probs[:, -1], 1e-30))
+            total = (scores[:, None] + logp).ravel()
+            best = np.argsort(-total)[:k]
+            parents, chars = np.divmod(best, logp.shape[1])
+
+            ended = chars == msg_end
+            for parent, score in zip(parents[ended], total[best][ended]):
+                finished.append((m.decode(tokens[parent]), score))
+
+            running = ~ended
+            tokens = np.concatenate([tokens[parents[running]],
+                                     chars[running, None]], axis=1)
+            scores = total[best][running]
+            states = states[parents[running]]
+            inp = self._hard_input(m, chars[running])
+
+            finished.sort(key=lambda c: -c[1])
+            finished = finished[:k]
+            # scores only decrease, so no running beam can catch up
+            if not scores.size or (len(finished) == k
+                                   and finished[-1][1] >= scores.max()):
+                break
+
+        candidates = finished + [(m.decode(t), score)
+                                 for t, score in zip(tokens, scores)]
+        candidates.sort(key=lambda c: -c[1])
+        return [(msg, float(score)) for msg, score in candidates[:k]]
+
+    def predict_sample(self, diff: Union[str, bytes], n: int=5,
+                       temperature: float=1.0, top_k: int=0,
+                       max_len: int=300, seed: Optional[int]=None
+                       ) -> List[Tuple[bytes, float]]:
+        """
+        Sample `n` commit messages for the given diff. All samples are
+        advanced together in a single decoder call per step, and drop
+        out once they emit `dashm.data.load.MSG_END`.
+
+        As in `predict_beam`, the decoder is fed the sampled characters
+        and only MSG_END is cut from the messages.
+
+        Inputs
+        ------
+        diff : str or bytes-like
+            The git-diff that we will try to summarize into a message.
+        n : int
+            Number of messages to sample.
+        temperature : float > 0
+            Probabilities are raised to the power `1 / temperature`
+            before sampling. Lower is closer to greedy decoding.
+        top_k : int
+            If > 0, only sample among the `top_k` most likely
+            characters at every step.
+        max_len : int
+            Cut a message off if we get this many characters
+            without seeing the `dashm.data.load.MSG_END` character.
+        seed : int
+            Optional seed of the random number generator.
+
+        Returns
+        -------
+        samples : List of (bytes, float)
+            The `n` messages and their log-probabilities under the
+            model, most likely first.
+        """
+        m = self._model
+        msg_end = ord(MSG_END)
+        rng = np.random.RandomState(seed)
+        states = np.repeat(self._state(m, diff), n, axis=0)
+        inp = np.repeat(m.init_probs, n, axis=0)
+        active = np.arange(n)
+        out = [[] for _ in active]  # type: List[List[int]]
+        scores = np.zeros(n)
+
+        for _ in range(max_len):
+            probs, states = self._decoder_step(m, inp, states)
+            logp = np.log(np.maximum(probs[:, -1], 1e-30))
+            logits = logp / temperature
+            if 0 < top_k < logits.shape[1]:
+                kth = np.partition(logits, -top_k, axis=1)[:, -top_k, None]
+                logits = np.where(logits >= kth, logits, -np.inf)
+            # Gumbel-max trick: one vectorized draw for every sample
+            chars = (logits + rng.gumbel(size=logits.shape)).argmax(axis=1)
+            scores[active] += logp[np.arange(len(chars)), chars]
+
+            running = chars != msg_end
+            for i, c in zip(active[running], chars[running]):
+                out[i].append(int(c))
+            if not running.any():
+                break
+            active = active[running]
+            states = states[running]
+            inp = self._hard_input(m, chars[running])
+
+        order = np.argsort(-scores, kind='stable')
+        return [(m.decode(out[i]), float(scores[i])) for i in order]
+
+    @staticmethod
+    def _proba_generator(m: _Model, state
+                         ) -> Generator[np.ndarray, None, None]:
         """
         Generator to output probabilities.
         """
-        probs = self._init_probs
+        inp = m.init_probs
         while True:
-            probs, state = self.decoder.predict([probs, state])
+            probs, state = Predictor._decoder_step(m, inp, state)
+            inp = Predictor._next_input(m, probs)
             yield probs
 
     def predict_proba(self, diff: Union[str, bytes], n: int=300) -> np.ndarray:
@@ -100,9 +679,9 @@ class Predictor():
         out_probs : numpy.ndarray
             (n, num_characters)-shaped array
         """
-        state = self.state_from_diff(diff)
-        gen = self._proba_generator(state)
-        self._proba_generator(self.state_from_diff(diff))
+        m = self._model
+        state = self._state(m, diff)
+        gen = self._proba_generator(m, state)
         out_probs = np.array([next(gen) for i in range(n)])
 
         return out_probs
@@ -125,22 +704,131 @@ class Predictor():
         msg : bytes
             The estimated commit message.
         """
-        state = self.state_from_diff(diff)
-        gen = self._proba_generator(state)
-        out = []
+        m = self._model
+        msg_end = ord(MSG_END)
+        state = self._state(m, diff)
+        gen = self._proba_generator(m, state)
+        out = []  # type: List[int]
         while max_len > 0:
             probs = next(gen)
-            out.append(chr(probs.argmax()).encode('ascii'))
-            if out[-1] == MSG_END:
+            out.append(int(probs.argmax()))
+            if out[-1] == msg_end:
                 break
             max_len -= 1
-        return b''.join(out[1:-1]) # 1:-1 to cut out MSG_BEGIN/MSG_END
+        return m.decode(out[1:-1]) # 1:-1 to cut out MSG_BEGIN/MSG_END
+
+    def predict_stream(self, diff: Union[str, bytes], max_len: int=300,
+                       timeout: Optional[float]=None,
+                       cancel: Optional[threading.Event]=None
+                       ) -> Generator[bytes, None, None]:
+        """
+        Predict the commit message for the given diff one character at
+        a time, yielding each as soon as the decoder produces it.
+        Joined together, the characters are the message `predict`
+        returns, unless decoding is stopped early.
+
+        Decoding stops, without raising, once the deadline passes or
+        `cancel` is set. Closing the generator also stops it.
+
+        Inputs
+        ------
+        diff : str or bytes-like
+            The git-diff that we will try to summarize into a message.
+        max_len : int
+            See `predict`.
+        timeout : float
+            Seconds after the call at which to stop decoding. The
+            encoder always runs to completion first.
+        cancel : threading.Event
+            Stop decoding once set, e.g. from another thread.
+
+        Returns
+        -------
+        generator yielding
+            char : bytes
+                The next character (or token) of the message.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        msg_end = ord(MSG_END)
+        m = self._model
+        state = self._state(m, diff)
+        gen = self._proba_generator(m, state)
+        for step in range(1, max_len + 1):
+            if cancel is not None and cancel.is_set():
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            char = int(next(gen).argmax())
+            if char == msg_end:
+                return
+            # same cuts as `predict`: the first character, and the
+            # last one if the message is cut off
+            if 1 < step < max_len:
+                yield m.decode([char])
+
+    async def apredict_stream(self, diff: Union[str, bytes],
+                              max_len: int=300,
+                              timeout: Optional[float]=None
+                              ) -> AsyncIterator[bytes]:
+        """
+        Asynchronous version of `predict_stream`. The decoder steps run
+        in the default executor of the event loop, and cancelling the
+        consuming task stops decoding.
+        """
+        loop = asyncio.get_event_loop()  # the running loop
+        cancel = threading.Event()
+        gen = self.predict_stream(diff, max_len, timeout, cancel)
+        try:
+            while True:
+                char = await loop.run_in_executor(None, next, gen, None)
+                if char is None:
+                    return
+                yield char
+        finally:
+            # a step may still be running in the executor, so the
+            # generator cannot be closed from here
+            cancel.set()
+
+
+def _to_bytes(diff: Union[str, bytes]) -> bytes:
+    if isinstance(diff, str):
+        diff = unicodedata.normalize('NFKD', diff)
+        diff = diff.encode('ascii', 'ignore')
+    else:
+        # diff already given in bytes
+        pass
+    return diff
 
 
 def cli():
-    predictor = Predictor()
+    p = argparse.ArgumentParser(
+        description=('Predict the commit message of the diff read from'
+                     ' stdin, asking a running `dashm.models.serve`'
+                     ' server if there is one.')
+    )
+    p.add_argument('--socket', type=str, default=None,
+                   help='Unix socket of the server.')
+    p.add_argument('--port', type=int, default=None,
+                   help='Localhost HTTP port of the server.')
+    p.add_argument('--max-len', type=int, default=300,
+                   help='Maximum length of the message.')
+    p.add_argument('--local', action='store_true',
+                   help='Load the model in this process, without a server.')
+
+    args = p.parse_args()
+
     s = sys.stdin.read()
-    print(predictor.predict(s).decode('ascii'))
+    msg = None
+    if not args.local:
+        from .serve import request
+        try:
+            msg = request(s, args.max_len, socket_path=args.socket,
+                          port=args.port)
+        except (OSError, RuntimeError):
+            pass  # no server, or it failed: load the model here
+    if msg is None:
+        msg = Predictor().predict(s, args.max_len)
+    print(msg.decode('ascii'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""
+An index of the saved training runs, their checkpoints and metrics,
+and of the checkpoint promoted for use by `Predictor`.
+
+The index is the JSON file `<project path>/models/saved/registry.json`:
+
+    {
+        "runs": {
+            "<run folder>": {
+                "config": {...},
+                "checkpoints": {
+                    "<epoch>": {"metrics": {"loss": ..., ...},
+                                "time": "<iso time>"},
+                    ...
+                }
+            },
+            ...
+        },
+        "promoted": {"run": "<run folder>", "checkpoint": "<epoch>",
+                     "time": "<iso time>"}
+    }
+
+The files of checkpoint `<epoch>` of a run are
+`<run folder>/{trainer,encoder,decoder}-<epoch>.h5` and
+`<run folder>/inference-<epoch>.npz`. The index is replaced atomically
+on every change, so readers never see a partial file.
+"""
+
+import os
+import json
+import fcntl
+import threading
+import warnings
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import argparse
+from typing import Union, Optional, Callable, Iterator
+
+SAVED = Path(__file__).parent / 'saved'
+REGISTRY_FILE = 'registry.json'
+
+
+class Registry():
+    """
+    Read and update the index of saved runs.
+    """
+
+    def __init__(self, saved_path: Optional[Union[str, Path]]=None):
+        """
+        Inputs
+        ------
+        saved_path : str or Path-like
+            Folder holding the runs and the index.
+            DEFAULT: `<project path>/models/saved/`.
+        """
+        self.saved_path = Path(saved_path or SAVED)
+        self.path = self.saved_path / REGISTRY_FILE
+
+    def read(self) -> dict:
+        """
+        The index, without runs whose folder has been deleted.
+        """
+        try:
+            with open(self.path) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = {}
+        runs = {name: run for name, run in index.get('runs', {}).items()
+                if (self.saved_path / name).is_dir()}
+        promoted = index.get('promoted')
+        if promoted is not None and promoted['run'] not in runs:
+            promoted = None
+        return {'runs': runs, 'promoted': promoted}
+
+    @contextmanager
+    def _update(self) -> Iterator[dict]:
+        self.saved_path.mkdir(parents=True, exist_ok=True)
+        with open(str(self.path) + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.read()
+            yield index
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+            os.replace(tmp, str(self.path))
+
+    def register(self, run: str, checkpoint: str, metrics: dict=None,
+                 config: dict=None) -> None:
+        """
+        Add, or update, the checkpoint `checkpoint` of the run in the
+        folder `<saved_path>/<run>`.
+        """
+        with self._update() as index:
+            entry = index['runs'].setdefault(run, {'config': {},
+                                                   'checkpoints': {}})
+            if config is not None:
+                entry['config'] = config
+            entry['checkpoints'][checkpoint] = {
+                'metrics': {k: float(v) for k, v in (metrics or {}).items()},
+                'time': datetime.now().isoformat(),
+            }
+
+    def promote(self, run: str, checkpoint: Optional[str]=None) -> dict:
+        """
+        Mark a checkpoint of `run` as the one to predict with.
+        DEFAULT: its latest checkpoint.
+
+        Returns
+        -------
+        promoted : dict
+            The "promoted" entry of the index.
+        """
+        with self._update() as index:
+            try:
+                checkpoints = index['runs'][run]['checkpoints']
+            except KeyError:
+                raise KeyError('Unknown run {!r}'.format(run)) from None
+            if checkpoint is None:
+                checkpoint = max(checkpoints, key=_checkpoint_order)
+            elif checkpoint not in checkpoints:
+                raise KeyError('Unknown checkpoint {!r} of run {!r}'
+                               .format(checkpoint, run))
+            index['promoted'] = {'run': run, 'checkpoint': checkpoint,
+                                 'time': datetime.now().isoformat()}
+            return index['promoted']
+
+    def best(self, metric: str='val_loss', mode: str='min'
+             ) -> Optional[dict]:
+        """
+        The checkpoint with the lowest (`mode='min'`) or highest
+        (`mode='max'`) value of `metric`, as a dict with keys
+        "run", "checkpoint" and "metrics". None if no checkpoint
+        has that metric.
+        """
+        if mode not in ['min', 'max']:
+            raise ValueError('`mode` must be one of ["min", "max"]')
+        candidates = [{'run': name, 'checkpoint': checkpoint,
+                       'metrics': entry['metrics']}
+                      for name, run in self.read()['runs'].items()
+                      for checkpoint, entry in run['checkpoints'].items()
+                      if metric in entry['metrics']]
+        if not candidates:
+            return None
+        pick = min if mode == 'min' else max
+        return pick(candidates, key=lambda c: c['metrics'][metric])
+
+    def promoted(self) -> Optional[dict]:
+        """
+        The "promoted" entry of the index, or None.
+        """
+        return self.read()['promoted']
+
+
+def _checkpoint_order(checkpoint: str):
+    # numbered epochs in order, named ones (e.g. "interrupted") last
+    return (not checkpoint.isdigit(), checkpoint)
+
+
+class Watcher(threading.Thread):
+    """
+    Background thread calling `callback(promoted)` whenever the
+    promoted checkpoint of a registry changes. The first check calls
+    it with the checkpoint promoted at that time, if any.
+    """
+
+    def __init__(self, callback: Callable[[dict], None],
+                 registry: Optional[Registry]=None, interval: float=5.0):
+        super().__init__(daemon=True)
+        self.callback = callback
+        self.registry = registry or Registry()
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._mtime = None  # type: Optional[int]
+        self._current = None  # type: Optional[tuple]
+
+    @staticmethod
+    def _key(promoted: Optional[dict]):
+        if promoted is None:
+            return None
+        return promoted['run'], promoted['checkpoint']
+
+    def check(self) -> bool:
+        """
+        Call the callback if the promoted checkpoint changed since the
+        last check. Returns True if it did.
+        """
+        try:
+            mtime = os.stat(str(self.registry.path)).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._mtime:
+            return False
+        promoted = self.registry.promoted()
+        key = self._key(promoted)
+        changed = key is not None and key != self._current
+        if changed:
+            # if it raises, e.g. on a half-written checkpoint, the
+            # next check tries again
+            self.callback(promoted)
+            self._current = key
+        self._mtime = mtime
+        return changed
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:  # keep watching, e.g. a partial run
+                warnings.warn('Could not follow the registry: {}'.format(e))
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description='List and promote saved models'
+    )
+    sub = p.add_subparsers(dest='command')
+    sub.required = True
+    sub.add_parser('list', help='Print the registry.')
+    promote = sub.add_parser('promote',
+                             help='Promote a checkpoint for predictions.')
+    promote.add_argument('run', type=str, nargs='?', default=None,
+                         help=('Run folder in "<project path>/models/saved/".'
+                               ' Required unless --best is given.'))
+    promote.add_argument('--checkpoint', type=str, default=None,
+                         help='Checkpoint of the run. DEFAULT: the latest.')
+    promote.add_argument('--best', type=str, default=None,
+                         metavar='METRIC',
+                         help=('Promote the checkpoint with the lowest value'
+                               ' of METRIC, e.g. val_loss, over all runs.'))
+
+    args = p.parse_args()
+
+    registry = Registry()
+    if args.command == 'list':
+        print(json.dumps(registry.read(), indent=2, sort_keys=True))
+        return
+    if args.best is not None:
+        best = registry.best(args.best)
+        if best is None:
+            raise SystemExit('No checkpoint has the metric ' + args.best)
+        promoted = registry.promote(best['run'], best['checkpoint'])
+    elif args.run is None:
+        raise SystemExit('Give a run, or --best METRIC')
+    else:
+        promoted = registry.promote(args.run, args.checkpoint)
+    print('Promoted {run} checkpoint {checkpoint}'.format(**promoted))
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+"""
+A long-running prediction server, so that the models are loaded once
+and shared by every client instead of once per call.
+
+The server listens on a Unix socket (default) or on a localhost HTTP
+port. Requests arriving within `max_wait` seconds of each other are
+coalesced into a single call to `Predictor.predict_batch`.
+
+The default socket is in a folder private to the user, and clients
+only send diffs to sockets created by the same user.
+
+Unix socket protocol: the client sends a line holding the maximum
+message length, then the diff, and shuts down its side of the
+connection. The server answers `ok\\n<message>` or `error\\n<reason>`.
+
+HTTP protocol: `POST /predict?max_len=<int>` with the diff as body,
+answered with the message as body.
+"""
+
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import queue
+import time
+import argparse
+import http.client
+import http.server
+import urllib.parse
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Union, Optional, List, Dict
+
+
+def _default_socket() -> Path:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return Path(runtime_dir) / 'dashm.sock'
+    return (Path(tempfile.gettempdir()) / 'dashm-{}'.format(os.getuid())
+            / 'dashm.sock')
+
+
+# A per-user location, so that other users can neither listen on it
+# nor receive the diffs sent to it.
+DEFAULT_SOCKET = _default_socket()
+
+
+class MicroBatcher():
+    """
+    Coalesce concurrent prediction requests into batches.
+
+    A single worker thread takes the first waiting request, waits up
+    to `max_wait` seconds for at most `max_batch_size - 1` more, and
+    predicts all of them with one `predict_batch` call per distinct
+    `max_len`. `predict_batch` gives every diff the message `predict`
+    would, so an answer does not depend on the other requests of its
+    batch.
+    """
+
+    def __init__(self, predictor, max_batch_size: int=16,
+                 max_wait: float=0.005):
+        """
+        Inputs
+        ------
+        predictor : Predictor
+            Used for every batch. Can be replaced at any time by
+            assigning the attribute, the next batch uses the new one.
+        max_batch_size : int
+            Maximum number of requests predicted together.
+        max_wait : float
+            Seconds to wait for more requests after the first one.
+        """
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()  # type: queue.Queue
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, diff: Union[str, bytes], max_len: int=300) -> Future:
+        """
+        Queue the diff for prediction. The returned future resolves to
+        the message, as `Predictor.predict_batch` would give it.
+        """
+        future = Future()  # type: Future
+        self._queue.put((diff, max_len, future))
+        return future
+
+    def _next_batch(self) -> List[tuple]:
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # stop after this batch
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            groups = {}  # type: Dict[int, List[tuple]]
+            for item in batch:
+                groups.setdefault(item[1], []).append(item)
+            predictor = self.predictor
+            for max_len, items in groups.items():
+                try:
+                    msgs = predictor.predict_batch([d for d, _, _ in items],
+                                                   max_len)
+                except Exception as e:
+                    for _, _, future in items:
+                        future.set_exception(e)
+                else:
+                    for (_, _, future), msg in zip(items, msgs):
+                        future.set_result(msg)
+
+    def close(self) -> None:
+        """
+        Finish the queued requests and stop the worker thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+
+class _SocketHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            max_len = int(self.rfile.readline())
+            diff = self.rfile.read()
+            msg = self.server.batcher.submit(diff, max_len).result()
+        except Exception as e:
+            self.wfile.write(b'error\n' + str(e).encode('utf-8', 'replace'))
+        else:
+            self.wfile.write(b'ok\n' + msg)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+class _HTTPHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/predict':
+            self.send_error(404)
+            return
+        try:
+            query = urllib.parse.parse_qs(url.query)
+            max_len = int(query.get('max_len', ['300'])[0])
+            length = int(self.headers.get('Content-Length', 0))
+            diff = self.rfile.read(length)
+            msg = self.server.batcher.submit(diff, max_len).result()
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(msg)))
+        self.end_headers()
+        self.wfile.write(msg)
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def _private_dir(path: Path) -> None:
+    """
+    Create the folder `path` accessible to the current user only, or
+    check that it is.
+    """
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    st = path.stat()
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError('{} must belong to the current user and be'
+                           ' private to them'.format(path))
+
+
+def _check_owner(socket_path: Path) -> None:
+    """
+    Refuse to send diffs to a socket created by another user.
+    """
+    if socket_path.stat().st_uid != os.getuid():
+        raise PermissionError('{} belongs to another user'
+                              .format(socket_path))
+
+
+def _claim_socket(socket_path: Path) -> None:
+    """
+    Remove a socket file left behind by a server that is gone.
+    """
+    if not socket_path.exists():
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(str(socket_path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            socket_path.unlink()
+            return
+    raise RuntimeError('A server is already listening on {}'
+                       .format(socket_path))
+
+
+def make_server(predictor, socket_path: Optional[Union[str, Path]]=None,
+                port: Optional[int]=None, host: str='127.0.0.1',
+                max_batch_size: int=16, max_wait: float=0.005):
+    """
+    Create, without starting, a prediction server.
+
+    Inputs
+    ------
+    predictor : Predictor
+        The predictor shared by every request.
+    socket_path : str or Path-like
+        Path of the Unix socket to listen on.
+        DEFAULT: `DEFAULT_SOCKET`, unless `port` is given.
+    port : int
+        If given, listen for HTTP on `host:port` instead.
+    host : str
+        Address to bind the HTTP server to. DEFAULT: localhost only.
+    max_batch_size, max_wait :
+        See `MicroBatcher`.
+
+    Returns
+    -------
+    server : socketserver.BaseServer
+        Call `serve_forever()` to start it, and `shutdown()` then
+        `server_close()` to stop it. The `batcher` attribute holds
+        its `MicroBatcher`.
+    """
+    if port is not None:
+        server = _HTTPServer((host, port), _HTTPHandler)
+    else:
+        if socket_path is None:
+            socket_path = DEFAULT_SOCKET
+            _private_dir(socket_path.parent)
+        socket_path = Path(socket_path)
+        _claim_socket(socket_path)
+        server = _UnixServer(str(socket_path), _SocketHandler)
+    server.batcher = MicroBatcher(predictor, max_batch_size, max_wait)
+    return server
+
+
+def request(diff: Union[str, bytes], max_len: int=300,
+            socket_path: Optional[Union[str, Path]]=None,
+            port: Optional[int]=None, host: str='127.0.0.1',
+            timeout: float=60.0) -> bytes:
+    """
+    Ask a running server for the commit message of the given diff.
+
+    Inputs
+    ------
+    diff : str or bytes-like
+        The git-diff that we will try to summarize into a message.
+    max_len : int
+        See `Predictor.predict`.
+    socket_path, port, host :
+        Where the server listens, see `make_server`.
+    timeout : float
+        Seconds to wait for the answer.
+
+    Returns
+    -------
+    msg : bytes
+        The estimated commit message.
+
+    Raises
+    ------
+    OSError
+        If no server can be reached, or the socket belongs to another
+        user.
+    RuntimeError
+        If the server failed to make the prediction.
+    """
+    if isinstance(diff, str):
+        from .predict import _to_bytes
+        diff = _to_bytes(diff)
+
+    if port is not None:
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        try:
+            conn.request('POST', '/predict?max_len={}'.format(max_len),
+                         body=diff)
+            response = conn.getresponse()
+            body = response.read()
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError('Prediction failed: {} {}'
+                               .format(response.status, response.reason))
+        return body
+
+    socket_path = Path(socket_path or DEFAULT_SOCKET)
+    _check_owner(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(str(socket_path))
+        s.sendall('{}\n'.format(max_len).encode('ascii') + diff)
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = s.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    status, _, body = b''.join(chunks).partition(b'\n')
+    if status != b'ok':
+        raise RuntimeError('Prediction failed: '
+                           + body.decode('utf-8', 'replace'))
+    return body
+
+
+def serve(model_dir=None, engine: str='auto',
+          follow_registry: Optional[float]=None, **kwargs) -> None:
+    """
+    Load a `Predictor` and serve it until interrupted.
+
+    Inputs
+    ------
+    model_dir, engine :
+        See `Predictor`.
+    follow_registry : float
+        If given, check the registry every `follow_registry` seconds
+        and swap to newly promoted checkpoints without stopping,
+        see `Predictor.follow_registry`.
+    **kwargs :
+        Passed to `make_server`.
+    """
+    from .predict import Predictor
+
+    predictor = Predictor(model_dir, engine=engine)
+    if follow_registry is not None:
+        predictor.follow_registry(follow_registry)
+    server = make_server(predictor, **kwargs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+
+
+def cli():
+    p = argparse.ArgumentParser(
+        description='Serve commit message predictions from a resident model'
+    )
+    p.add_argument('model_dir', type=str, nargs='?', default=None,
+                   help=('Folder of the saved model, relative to'
+                         ' "<project path>/models/saved/".'
+                         ' DEFAULT: the most recent model.'))
+    p.add_argument('--socket', type=str, default=None,
+                   help=('Unix socket to listen on.'
+                         ' DEFAULT: {}'.format(DEFAULT_SOCKET)))
+    p.add_argument('--port', type=int, default=None,
+                   help='Listen for HTTP on this localhost port instead.')
+    p.add_argument('--max-batch-size', type=int, default=16,
+                   help='Maximum number of requests predicted together.')
+    p.add_argument('--max-wait', type=float, default=0.005,
+                   help=('Seconds to wait for more requests to batch'
+                         ' after the first one.'))
+    p.add_argument('--engine', type=str, default='auto',
+                   choices=['auto', 'numpy', 'keras'],
+                   help='See `Predictor`.')
+
+    p.add_argument('--follow-registry', dest='follow_registry', type=float,
+                   default=None, metavar='SECONDS',
+                   help=('Swap to the checkpoint promoted in the registry'
+                         ' whenever it changes, checking this often.'))
+
+    args = p.parse_args()
+
+    serve(args.model_dir, engine=args.engine,
+          follow_registry=args.follow_registry, socket_path=args.socket,
+          port=args.port, max_batch_size=args.max_batch_size,
+          max_wait=args.max_wait)
+
+
+if __name__ == '__main__':
+    cli() # pragma: no cover
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+A content-addressed cache of the states the encoder computes from
+diffs, so that encoding the same diff again is a lookup.
+
+States are keyed by the SHA-1 of the diff bytes, and every cache is
+bound to a fingerprint of the weights that produced its states. Using
+the cache with different weights invalidates it.
+"""
+
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Union, Optional, List
+
+import numpy as np
+
+CACHE_DIR = 'state-cache'
+
+
+def fingerprint(files: List[Union[str, Path]]) -> str:
+    """
+    SHA-1 of the contents of the weight `files`, in order.
+    """
+    h = hashlib.sha1()
+    for filename in files:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def diff_key(diff: bytes) -> str:
+    return hashlib.sha1(diff).hexdigest()
+
+
+class StateCache():
+    """
+    LRU cache of encoder states with an optional on-disk store.
+
+    States on disk are kept in `<path>/<weights fingerprint>/<key>.npy`.
+    The stores of other fingerprints are kept, as other checkpoints of
+    the same run may still be in use, until `prune` is called.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, weights: str, maxsize: int=256,
+                 path: Optional[Union[str, Path]]=None):
+        """
+        Inputs
+        ------
+        weights : str
+            Fingerprint of the weights of the encoder, see `fingerprint`.
+        maxsize : int
+            Number of states kept in memory. 0 disables the
+            in-memory cache.
+        path : str or Path-like
+            Folder of the on-disk store. DEFAULT: None, states are
+            only kept in memory.
+        """
+        self.weights = weights
+        self.maxsize = maxsize
+        self._states = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.path = None  # type: Optional[Path]
+        if path is not None:
+            self.path = Path(path) / weights
+            self.path.mkdir(parents=True, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        The state stored under `key`, or None.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+        if state is None and self.path is not None:
+            try:
+                state = np.load(str(self.path / (key + '.npy')))
+            except (FileNotFoundError, ValueError, OSError):
+                state = None  # missing, or a partial file
+            if state is not None:
+                self._remember(key, state)
+        with self._lock:
+            if state is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return state
+
+    def put(self, key: str, state: np.ndarray) -> np.ndarray:
+        """
+        Store `state` under `key`. Returns the stored, read-only state.
+        """
+        state = np.array(state)
+        state.flags.writeable = False
+        self._remember(key, state)
+        if self.path is not None:
+            tmp = self.path / '{}.{}.{}.tmp'.format(key, os.getpid(),
+                                                    threading.get_ident())
+            try:
+                with open(tmp, 'wb') as f:
+                    np.save(f, state)
+                os.replace(str(tmp), str(self.path / (key + '.npy')))
+            except OSError:
+                pass  # e.g. the store was pruned, keep the state in memory
+        return state
+
+    def _remember(self, key: str, state: np.ndarray) -> None:
+        if self.maxsize <= 0:
+            return
+        state.flags.writeable = False
+        with self._lock:
+            self._states[key] = state
+            self._states.move_to_end(key)
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Empty the in-memory cache and the on-disk store.
+        """
+        with self._lock:
+            self._states.clear()
+        if self.path is not None:
+            for f in self.path.glob('*.npy'):
+                try:
+                    f.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def prune(self) -> None:
+        """
+        Remove the on-disk stores of other weights fingerprints. Only
+        call it when no other model uses the same folder, their states
+        are then only kept in memory.
+        """
+        if self.path is None:
+            return
+        for stale in self.path.parent.iterdir():
+            if stale.name != self.weights:
+                shutil.rmtree(str(stale), ignore_errors=True)
+
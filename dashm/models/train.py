@@ -1,71 +1,242 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import time
 from pathlib import Path
 from datetime import datetime
 import argparse
-from typing import Union, Tuple
+from typing import Union, Tuple, Iterator, Optional
 
-from keras.callbacks import TensorBoard, LambdaCallback
+import numpy as np
+from keras.callbacks import TensorBoard, LambdaCallback, Callback
 from keras.models import Model
 
-from ..data.load import load_train_generator, load, format_batch
+from .. import profiling
+from ..data.load import (load_train_generator, load, format_batch,
+                         encode_batch, BucketSampler, CommitSequence)
+from ..data.tokenizer import fit_corpus, TOKENIZER_FILE
+from ..data.multi import is_manifest
 from .make_models import make_models
+from .inference import export_models, INFERENCE_FILE
+from .registry import Registry, SAVED
 
 SAVE_TIME_STRING = '%Y-%m-%d_%H-%M-%S'
 
 
+class _ProfileCallback(Callback):
+    """
+    Times every training batch, counts the batches the data generator
+    had not produced yet when the batch started (the model was starved
+    of data), and writes the profile to TensorBoard after every epoch.
+    """
+
+    def __init__(self, profiler: profiling.Profiler,
+                 log_dir: Union[str, Path], watch_generator: bool=True):
+        super().__init__()
+        self.profiler = profiler
+        self.log_dir = log_dir
+        self.watch_generator = watch_generator
+        self._started = 0
+        self._start = 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._started += 1
+        self.profiler.count('train.batches')
+        if (self.watch_generator and
+                self.profiler.counter('datagen.batches') < self._started):
+            self.profiler.count('train.starved_batches')
+        self._start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.profiler.add_time('train.batch',
+                               time.perf_counter() - self._start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.profiler.write_tensorboard(self.log_dir, epoch)
+
+
+def _profiled(batches: Iterator, profiler: profiling.Profiler) -> Iterator:
+    """
+    Time the production of every batch, and count them.
+    """
+    while True:
+        with profiler.timer('datagen.batch'):
+            batch = next(batches)
+        profiler.count('datagen.batches')
+        yield batch
+
+
 def train(repo_path: Union[str, Path], cv_train_split: float,
-          summary: bool=False, in_memory: bool=False, **kwargs
-          ) -> Tuple[Model, Model, Model]:
+          summary: bool=False, in_memory: bool=False, embedding_dim: int=0,
+          bucketed: bool=False, shard: int=0, num_shards: int=1,
+          max_diff_len: int=200, bptt_steps: int=0, vocab_size: int=0,
+          profile: bool=False, val_size: int=1024,
+          saved_path: Optional[Union[str, Path]]=None,
+          **kwargs) -> Tuple[Model, Model, Model]:
     """
     Trains the models against the diff/message data in
     `<project path>/data/processed-repos/<repo_path>`.
 
+    The weights are saved after every epoch to a new folder in
+    `saved_path`, and each checkpoint is recorded with its metrics
+    in the registry there, see `registry.Registry`.
+
     Inputs
     ------
     repo_path : str or Path-like
         Folder in `<project path>/data/processed-repos/` to
-        train against.
+        train against, or the path of a multi-repo manifest to train
+        against the commits of many repos, sampled by their weights
+        (see `dashm.data.multi`).
     cv_train_split : float
         Number between 0 and 1 inclusive. See `data.load.load`.
     summary : bool or int > 0
         Print model summary? passed to make_models()
+    in_memory : bool
+        Keep the compact training data in memory instead of reading
+        it from disk for every batch. One epoch then covers every
+        training commit once. `batch_size` may be given in kwargs.
+    embedding_dim : int
+        If > 0, train the integer id variant of the models with an
+        embedding of this size, see make_models(). The choice is saved
+        to `config.json` next to the weights.
+    bucketed : bool
+        Form batches of commits with similar lengths, padded only as
+        much as needed, and see every training commit once per epoch.
+        See `data.load.BucketSampler`. Ignored if `in_memory`.
+    shard, num_shards : int
+        Only train on shard `shard` of `num_shards` disjoint shards of
+        the training data. Only used if `workers` > 1.
+    max_diff_len : int
+        Only the first `max_diff_len` bytes of every diff, ending with
+        DIFF_END, are trained on. They are tokens if `vocab_size`.
+    bptt_steps : int
+        If > 0, only backpropagate through the last `bptt_steps` steps
+        of the encoder, so that long diffs (see `max_diff_len`) can be
+        trained on cheaply. See make_models(). Must be less than
+        `max_diff_len`.
+    vocab_size : int
+        If > 0, fit a byte-pair tokenizer with this many token ids on
+        the training data and train on its tokens instead of single
+        characters, see `data.tokenizer`. The tokenizer is saved to
+        `tokenizer.json` next to the weights, and `max_diff_len` then
+        counts tokens. Requires `embedding_dim`, and cannot be used
+        with `bucketed`.
+    profile : bool
+        If True, record the time spent in the data loading, batch
+        formatting and training steps, see `dashm.profiling`, and the
+        number of training batches started before the data generator
+        had produced them. The profile is written to TensorBoard in
+        `logs/profile` after every epoch, and to `profile.json` next
+        to the weights at the end. With `workers` > 1 the data is read
+        in other processes and only the training steps are recorded.
+    val_size : int
+        Number of validation commits of a multi-repo corpus, drawn once
+        by their weights (see `dashm.data.multi.MultiCorpus.sample`),
+        so that only the repos drawn are opened. The whole validation
+        split of a single repo is used.
+    saved_path : str or Path-like
+        Folder of the saved runs and of their registry.
+        DEFAULT: `<project path>/models/saved/`.
     **kwargs
-        Passed through to model.fit_generator()
+        Passed through to model.fit_generator(). If `workers` > 1, the
+        data is read by a `data.load.CommitSequence` in that many
+        processes, and an epoch covers the training data once.
 
     Returns
     -------
     trainer, encoder, decoder : same as make_models()
     """
+    if bptt_steps and not 0 < bptt_steps < max_diff_len:
+        raise ValueError('`bptt_steps` must be less than `max_diff_len`')
+    if vocab_size and not embedding_dim:
+        raise ValueError('`vocab_size` requires `embedding_dim`')
+    if vocab_size and bucketed and not in_memory:
+        raise ValueError('`vocab_size` cannot be used with `bucketed`')
+
+    profiler = None
+    was_active = profiling.active() is not None
+    if profile:
+        profiler = profiling.enable()
+
+    tokenizer = None
+    if vocab_size:
+        tokenizer = fit_corpus(repo_path, cv_train_split, vocab_size)
+        # fewer if the data has run out of pairs to merge
+        vocab_size = tokenizer.vocab_size
+
     # Get the model architectures
-    trainer, encoder, decoder = make_models(summary=summary)
+    trainer, encoder, decoder = make_models(summary=summary,
+                                            embedding_dim=embedding_dim,
+                                            bptt_steps=bptt_steps,
+                                            vocab_size=vocab_size)
+    sparse = bool(embedding_dim)
 
     # Compile the model we'll be training
     trainer.compile('adadelta',
-                    loss='categorical_crossentropy',
+                    loss=('sparse_categorical_crossentropy' if sparse
+                          else 'categorical_crossentropy'),
                     metrics=['accuracy'])
 
     # Get the data ready
-    def datagen(batch_size, max_diff_len=200, max_msg_len=200):
+    def datagen(batch_size, max_msg_len=200):
+        if tokenizer is not None:
+            compact_datagen = load_train_generator(
+                repo_path, cv_train_split, max_diff_len, max_msg_len,
+                encoding='compact', tokenizer=tokenizer
+            )
+            while True:
+                batch = [next(compact_datagen) for _ in range(batch_size)]
+                yield format_batch(batch, max_diff_len, max_msg_len, sparse)
         raw_datagen = load_train_generator(repo_path, cv_train_split,
-                                           max_diff_len, max_msg_len)
+                                           max_diff_len, max_msg_len,
+                                           encoding='raw')
+        while True:
+            diffs, msgs = zip(*[next(raw_datagen) for _ in range(batch_size)])
+            with profiling.timer('datagen.encode_batch'):
+                batch = encode_batch(diffs, msgs, max_diff_len, max_msg_len,
+                                     sparse)
+            yield batch
+
+    # The compact data is one-hot expanded one batch at a time,
+    # shuffled once per epoch.
+    def in_memory_datagen(x, y, batch_size, max_msg_len=200):
         while True:
-            batch = [next(raw_datagen) for _ in range(batch_size)]
-            yield format_batch(batch, max_diff_len, max_msg_len)
+            order = np.random.permutation(len(x))
+            for i in range(0, len(order), batch_size):
+                batch = [(x[j], y[j]) for j in order[i:i + batch_size]]
+                yield format_batch(batch, max_diff_len, max_msg_len, sparse)
 
-    val_diff_len = 400
+    val_diff_len = max(400, max_diff_len)
     val_msg_len = 200
-    val = load(repo_path, cv_train_split, 'val', max_diff_len=val_diff_len,
-               max_msg_len=val_msg_len)
-    val = format_batch(list(zip(*val)), val_diff_len, val_msg_len)
+    if is_manifest(repo_path):
+        # the same sample every epoch, for comparable metrics
+        val_datagen = load_train_generator(
+            repo_path, cv_train_split, val_diff_len, val_msg_len,
+            encoding='compact', tokenizer=tokenizer, which='val'
+        )
+        val = [next(val_datagen) for _ in range(val_size)]
+    else:
+        val = list(zip(*load(repo_path, cv_train_split, 'val',
+                             max_diff_len=val_diff_len,
+                             max_msg_len=val_msg_len, tokenizer=tokenizer)))
+    val = format_batch(val, val_diff_len, val_msg_len, sparse)
 
     # Prep the output folder
-    now = datetime.now().strftime(SAVE_TIME_STRING) + '_' + str(repo_path)
-    save_path = Path(__file__).parent / 'saved' / now
+    name = Path(repo_path).stem if is_manifest(repo_path) else str(repo_path)
+    now = datetime.now().strftime(SAVE_TIME_STRING) + '_' + name
+    save_path = Path(saved_path or SAVED) / now
     os.makedirs(save_path, exist_ok=False)
+    config = {'embedding_dim': embedding_dim, 'bptt_steps': bptt_steps,
+              'vocab_size': vocab_size}
+    with open(save_path / 'config.json', 'w') as f:
+        json.dump(config, f)
+    if tokenizer is not None:
+        tokenizer.save(save_path / TOKENIZER_FILE)
+    registry = Registry(save_path.parent)
 
-    def save_weights(epoch, _):
+    def save_weights(epoch, logs):
         try:
             epoch_str = '{:0>3d}'.format(epoch)
         except ValueError:
@@ -82,33 +253,102 @@ def train(repo_path: Union[str, Path], cv_train_split: float,
                 pass
             symlink_source.symlink_to(destination)
 
+        # NumPy-only copy of the encoder/decoder for fast inference
+        destination = save_path / 'inference-{}.npz'.format(epoch_str)
+        export_models(encoder, decoder, destination)
+        symlink_source = save_path / INFERENCE_FILE
+        try:
+            symlink_source.unlink()
+        except FileNotFoundError:
+            pass
+        symlink_source.symlink_to(destination)
+
+        registry.register(save_path.name, epoch_str,
+                          logs if isinstance(logs, dict) else {}, config)
+
+    callbacks = [TensorBoard(log_dir=str(save_path / 'logs')),
+                 LambdaCallback(on_epoch_end=save_weights)]
+    if profiler is not None:
+        # With several workers the batches are produced in other
+        # processes, where they cannot be counted.
+        callbacks.append(_ProfileCallback(
+            profiler, save_path / 'logs' / 'profile',
+            watch_generator=(in_memory or bucketed
+                             or kwargs.get('workers', 1) <= 1)
+        ))
+
+    def profiled(batches):
+        if profiler is None:
+            return batches
+        return _profiled(batches, profiler)
+
     # Fit the model
 
     try:
         if in_memory:
+            batch_size = kwargs.pop('batch_size', 64)
+            x, y = load(repo_path, cv_train_split, 'train', max_diff_len, 200,
+                        tokenizer=tokenizer)
             defaults = {
-                'batch_size': 64,
+                'steps_per_epoch': int(np.ceil(len(x) / batch_size)),
                 'epochs': 100,
-                'callbacks': [TensorBoard(log_dir=str(save_path / 'logs')),
-                              LambdaCallback(on_epoch_end=save_weights)]
+                'callbacks': callbacks
             }
             defaults.update(kwargs)
-            train_data = load(repo_path, cv_train_split, 'train', 200, 200)
-            x, y = format_batch(list(zip(*train_data)), 200, 200)
-            trainer.fit(x, y, validation_data=val, **defaults)
+            trainer.fit_generator(
+                profiled(in_memory_datagen(x, y, batch_size)),
+                validation_data=val, **defaults
+            )
+        elif bucketed:
+            diff_bounds = None
+            if bptt_steps:
+                # every bucket must be longer than the truncated steps
+                diff_bounds = [int(b) for b in 2 ** np.arange(4, 32)
+                               if bptt_steps < b < max_diff_len]
+            sampler = BucketSampler(repo_path, cv_train_split, 64,
+                                    max_diff_len, 200, replace=False,
+                                    sparse=sparse, diff_bounds=diff_bounds)
+            defaults = {
+                'steps_per_epoch': sampler.batches_per_epoch,
+                'epochs': 100,
+                'max_queue_size': 50,
+                'workers': 1,
+                'callbacks': callbacks
+            }
+            defaults.update(kwargs)
+            trainer.fit_generator(profiled(iter(sampler)),
+                                  validation_data=val, **defaults)
+        elif kwargs.get('workers', 1) > 1:
+            sequence = CommitSequence(repo_path, cv_train_split, 64,
+                                      max_diff_len, 200, sparse=sparse,
+                                      shard=shard, num_shards=num_shards,
+                                      tokenizer=tokenizer)
+            defaults = {
+                'epochs': 100,
+                'max_queue_size': 50,
+                'use_multiprocessing': True,
+                'callbacks': callbacks
+            }
+            defaults.update(kwargs)
+            trainer.fit_generator(sequence, validation_data=val, **defaults)
         else:
             defaults = {
                 'steps_per_epoch': 1000,
                 'epochs': 100,
                 'max_queue_size': 50,
                 'workers': 1,
-                'callbacks': [TensorBoard(log_dir=str(save_path / 'logs')),
-                              LambdaCallback(on_epoch_end=save_weights)]
+                'callbacks': callbacks
             }
             defaults.update(kwargs)
-            trainer.fit_generator(datagen(64), validation_data=val, **defaults)
+            trainer.fit_generator(profiled(datagen(64)),
+                                  validation_data=val, **defaults)
     except KeyboardInterrupt:
-        save_weights('interrupted', '__unused__')
+        save_weights('interrupted', None)
+    finally:
+        if profiler is not None:
+            profiler.write_json(save_path / 'profile.json')
+            if not was_active:
+                profiling.disable()
 
     return trainer, encoder, decoder
 
@@ -120,7 +360,9 @@ def cli():
     p.add_argument('repo', type=str,
                    help=('Absolute path to repo, or folder name of a folder'
                          ' that exists in'
-                         ' "<project path>/data/processed-repos/".'))
+                         ' "<project path>/data/processed-repos/", or the'
+                         ' .json manifest of a multi-repo corpus written'
+                         ' by dashm.data.multi.'))
     p.add_argument('cross_validation_split', type=float,
                    help=('Number between 0 and 1 indicating amount of'
                          ' data used for training vs. validation.'))
@@ -134,15 +376,59 @@ def cli():
                    help=('Number of epochs to train for.'))
     p.add_argument('--in-memory', dest='in_memory', action='store_true',
                    help=('Load all data in memory during training.'))
+    p.add_argument('--workers', type=int, default=1,
+                   help=('Number of processes reading the training data.'
+                         ' If > 1, an epoch covers the data once and'
+                         ' --steps_per_epoch is ignored.'))
+    p.add_argument('--shard', type=int, default=0,
+                   help=('Index of the shard of the training data to use'
+                         ' when --workers > 1.'))
+    p.add_argument('--num-shards', dest='num_shards', type=int, default=1,
+                   help=('Number of disjoint shards the training data is'
+                         ' split into, one per training process.'))
+    p.add_argument('--bucketed', action='store_true',
+                   help=('Batch commits of similar lengths together and'
+                         ' see every commit once per epoch. Ignores'
+                         ' --steps_per_epoch.'))
+    p.add_argument('--embedding-dim', dest='embedding_dim', type=int,
+                   default=0,
+                   help=('Feed integer ids through an embedding of this'
+                         ' size instead of one-hot encodings.'))
+
+    p.add_argument('--max-diff-len', dest='max_diff_len', type=int,
+                   default=200,
+                   help=('Number of bytes (tokens with --vocab-size) of'
+                         ' each diff trained on.'))
+    p.add_argument('--bptt-steps', dest='bptt_steps', type=int, default=0,
+                   help=('Only backpropagate through this many steps at the'
+                         ' end of the diffs. Must be less than'
+                         ' --max-diff-len.'))
+    p.add_argument('--vocab-size', dest='vocab_size', type=int, default=0,
+                   help=('Train on the tokens of a byte-pair tokenizer with'
+                         ' this many ids, fit on the training data.'
+                         ' Requires --embedding-dim.'))
+    p.add_argument('--profile', action='store_true',
+                   help=('Record the time spent loading data and training,'
+                         ' written to TensorBoard and to profile.json next'
+                         ' to the weights.'))
 
     args = p.parse_args()
 
     kwargs = {
         'summary': args.summary,
         'epochs': args.epochs,
-        'in_memory': args.in_memory
+        'in_memory': args.in_memory,
+        'embedding_dim': args.embedding_dim,
+        'bucketed': args.bucketed,
+        'workers': args.workers,
+        'shard': args.shard,
+        'num_shards': args.num_shards,
+        'max_diff_len': args.max_diff_len,
+        'bptt_steps': args.bptt_steps,
+        'vocab_size': args.vocab_size,
+        'profile': args.profile
     }
-    if not args.in_memory:
+    if not (args.in_memory or args.bucketed or args.workers > 1):
         kwargs['steps_per_epoch'] = args.steps_per_epoch
     train(args.repo, args.cross_validation_split, **kwargs)
 
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in timers and counters around the hot paths of dashm.
+
+Nothing is recorded until `enable` is called, or the environment
+variable `DASHM_PROFILE` is set to the path of a JSON file, in which
+case profiling starts on import and the summary is written to that
+file at exit. While disabled, `timer` returns a shared do-nothing
+context manager and `count` returns at once.
+
+    from dashm import profiling
+    profiler = profiling.enable()
+    ...
+    profiler.write_json('profile.json')
+
+Timers are named `<stage>.<step>`, e.g. "load.read" or
+"predict.decoder_step". Their summary holds the number of calls and
+the total, mean and max durations. Work done in other processes, e.g.
+by `process_data.process` with several jobs, is not recorded.
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+from pathlib import Path
+from typing import Union, Optional, Dict, List
+
+ENV_VAR = 'DASHM_PROFILE'
+
+
+class _NullTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullTimer()
+
+
+class _Timer():
+    __slots__ = ('_profiler', '_name', '_start')
+
+    def __init__(self, profiler: 'Profiler', name: str):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._profiler.add_time(self._name,
+                                time.perf_counter() - self._start)
+        return False
+
+
+class Profiler():
+    """
+    Named timers and counters, safe to update from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timers = {}  # type: Dict[str, List[float]]
+        self._counters = {}  # type: Dict[str, int]
+        self._writers = {}  # type: Dict[str, object]
+
+    def timer(self, name: str) -> _Timer:
+        """
+        Context manager adding the time spent in it to timer `name`.
+        """
+        return _Timer(self, name)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self._lock:
+            stats = self._timers.get(name)
+            if stats is None:
+                self._timers[name] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+
+    def count(self, name: str, n: int=1) -> None:
+        """
+        Add `n` to counter `name`.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def counter(self, name: str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def summary(self) -> dict:
+        """
+        The timers and counters, as
+
+            {"timers": {name: {"count": int, "total_sec": float,
+                               "mean_ms": float, "max_ms": float}},
+             "counters": {name: int}}
+        """
+        with self._lock:
+            timers = {
+                name: {'count': int(n), 'total_sec': total,
+                       'mean_ms': 1000 * total / n, 'max_ms': 1000 * top}
+                for name, (n, total, top) in self._timers.items()
+            }
+            return {'timers': timers, 'counters': dict(self._counters)}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+
+    def write_json(self, path: Union[str, Path]) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def write_tensorboard(self, log_dir: Union[str, Path],
+                          step: int) -> None:
+        """
+        Write the total and mean time of every timer, and every
+        counter, as TensorBoard scalars at `step`. Every `log_dir`
+        gets a single writer, reused by the later calls. Works with
+        the summary API of TensorFlow 1 and 2.
+        """
+        import tensorflow as tf  # slow, and only needed here
+
+        summary = self.summary()
+        scalars = []
+        for name, stats in summary['timers'].items():
+            scalars.append(('timers/{}/total_sec'.format(name),
+                            stats['total_sec']))
+            scalars.append(('timers/{}/mean_ms'.format(name),
+                            stats['mean_ms']))
+        for name, value in summary['counters'].items():
+            scalars.append(('counters/' + name, value))
+
+        tf2 = hasattr(tf.summary, 'create_file_writer')
+        with self._lock:
+            writer = self._writers.get(str(log_dir))
+            if writer is None:
+                if tf2:
+                    writer = tf.summary.create_file_writer(str(log_dir))
+                else:
+                    writer = tf.summary.FileWriter(str(log_dir))
+                self._writers[str(log_dir)] = writer
+        if tf2:
+            with writer.as_default():
+                for tag, value in scalars:
+                    tf.summary.scalar(tag, value, step=step)
+        else:
+            writer.add_summary(tf.Summary(value=[
+                tf.Summary.Value(tag=tag, simple_value=value)
+                for tag, value in scalars
+            ]), step)
+        writer.flush()
+
+_profiler = None  # type: Optional[Profiler]
+
+
+def enable() -> Profiler:
+    """
+    Start recording, if not already, and return the profiler.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+
+def disable() -> Optional[Profiler]:
+    """
+    Stop recording. Returns the profiler that was recording, if any.
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def active() -> Optional[Profiler]:
+    """
+    The profiler recording, or None if disabled.
+    """
+    return _profiler
+
+
+def timer(name: str):
+    """
+    Context manager timing its body under `name`, if enabled.
+    """
+    profiler = _profiler
+    if profiler is None:
+        return _NULL
+    return profiler.timer(name)
+
+
+def count(name: str, n: int=1) -> None:
+    """
+    Add `n` to the counter `name`, if enabled.
+    """
+    profiler = _profiler
+    if profiler is not None:
+        profiler.count(name, n)
+
+
+def _write_at_exit(path: str) -> None:
+    profiler = _profiler
+    if profiler is not None:
+        profiler.write_json(path)
+
+
+if os.environ.get(ENV_VAR):
+    enable()
+    atexit.register(_write_at_exit, os.environ[ENV_VAR])
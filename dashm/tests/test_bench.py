@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import json
+from pathlib import Path
+import subprocess as sp
+import sys
+
+import pytest
+
+from dashm import bench
+
+
+class Test_Bench():
+    @classmethod
+    def setup_method(cls):
+        cls.__old_sys_argv = sys.argv
+
+    @classmethod
+    def teardown_method(cls):
+        sys.argv = cls.__old_sys_argv
+
+    @staticmethod
+    def test_make_repo(tmpdir):
+        path = bench.make_repo(tmpdir.join('repo'), n_commits=12,
+                               diff_size=300)
+        count = sp.check_output(['git', 'rev-list', '--count', 'HEAD'],
+                                cwd=str(path))
+        assert int(count) == 12
+        diff = sp.check_output(['git', 'show', '--format=', 'HEAD'],
+                               cwd=str(path))
+        assert diff.count(b'\n+') > 2
+
+        # reproducible
+        again = bench.make_repo(tmpdir.join('again'), n_commits=12,
+                                diff_size=300)
+        assert (sp.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(path))
+                == sp.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=str(again)))
+
+    @staticmethod
+    def test_run_data_stages(tmpdir):
+        report = bench.run(n_commits=20, diff_size=300,
+                           stages=['process', 'load'],
+                           workdir=str(tmpdir))
+        assert set(report['results']) == {
+            'process_commits_per_sec', 'load_samples_per_sec',
+            'load_train_generator_samples_per_sec',
+            'format_batch_samples_per_sec', 'encode_batch_samples_per_sec',
+        }
+        assert all(v > 0 for v in report['results'].values())
+        saved = Path(bench.__file__).parent / 'models/saved'
+        assert not bench._saved_runs(saved, bench.REPO_NAME)
+
+        with pytest.raises(ValueError):
+            bench.run(stages=['non-existent'])
+
+    @staticmethod
+    def test_compare():
+        config = {'n_commits': 1}
+        baseline = {'config': config,
+                    'results': {'load_samples_per_sec': 100.0,
+                                'predict_cold_start_sec': 1.0}}
+        report = {'config': config,
+                  'results': {'load_samples_per_sec': 80.0,
+                              'predict_cold_start_sec': 1.2,
+                              'train_steps_per_sec': 1.0}}
+        assert bench.compare(report, baseline, tolerance=0.3) == []
+
+        report['results']['load_samples_per_sec'] = 60.0
+        report['results']['predict_cold_start_sec'] = 1.5
+        regressions = bench.compare(report, baseline, tolerance=0.3)
+        assert len(regressions) == 2
+        assert regressions[0].startswith('load_samples_per_sec')
+
+        with pytest.raises(ValueError):
+            bench.compare({'config': {}, 'results': {}}, baseline)
+
+        # not comparable across machines
+        baseline['machine'] = {'cpus': 64}
+        with pytest.warns(UserWarning):
+            assert bench.compare(report, baseline, tolerance=0.3) == []
+
+    @staticmethod
+    def test_baseline():
+        with open(bench.BASELINE) as f:
+            baseline = json.load(f)
+        assert set(baseline['results']) == set(bench.METRICS)
+
+    @staticmethod
+    def test_cli(tmpdir):
+        output = str(tmpdir.join('results.json'))
+        baseline = str(tmpdir.join('baseline.json'))
+        sys.argv = ['bench.py', '--commits', '20', '--diff-size', '300',
+                    '--stages', 'load', '--output', output,
+                    '--baseline', baseline, '--save-baseline']
+        bench.cli()
+        with open(output) as f:
+            report = json.load(f)
+        assert 'load_samples_per_sec' in report['results']
+
+        # impossibly fast baseline
+        report['results'] = {k: v * 100 for k, v in report['results'].items()}
+        with open(baseline, 'w') as f:
+            json.dump(report, f)
+        sys.argv = sys.argv[:-1]
+        with pytest.raises(SystemExit):
+            bench.cli()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+import numpy as np
+import pytest
+
+from dashm.data import dedup
+from dashm.data import load
+
+DIFF = (b'diff --git a/dashm/data/load.py b/dashm/data/load.py\n'
+        b'index 3f2a1b0..9c8d7e6 100644\n'
+        b'--- a/dashm/data/load.py\n'
+        b'+++ b/dashm/data/load.py\n'
+        b'@@ -10,3 +10,4 @@ def load():\n'
+        b'-    return encode_diff(x)\n'
+        b'+    return encode_diff(x, tokenizer)\n')
+# the same change, cherry-picked onto another branch
+PICKED = (DIFF.replace(b'3f2a1b0..9c8d7e6', b'1111111..2222222')
+          .replace(b'-10,3 +10,4', b'-52,3 +52,4') + b'\n')
+LINES = b''.join(b'+line %d\n' % i for i in range(40))
+
+
+def _write(path, sha, diff, msg):
+    path.join(sha + '.diff').write_binary(diff)
+    path.join(sha + '.msg').write_binary(msg)
+
+
+class Test_Dedup():
+    @classmethod
+    def setup_method(cls):
+        cls.__old_sys_argv = sys.argv
+
+    @classmethod
+    def teardown_method(cls):
+        sys.argv = cls.__old_sys_argv
+
+    @staticmethod
+    def test_content_hash():
+        msg = b'Pass the tokenizer\n'
+        picked_msg = msg + b'\n(cherry picked from commit abc123)\n'
+        assert (dedup.content_hash(DIFF, msg)
+                == dedup.content_hash(PICKED, picked_msg))
+        assert (dedup.content_hash(DIFF, msg)
+                != dedup.content_hash(DIFF, b'Another message'))
+        assert (dedup.content_hash(DIFF, msg)
+                != dedup.content_hash(DIFF.replace(b'x, ', b'y, '), msg))
+
+    @staticmethod
+    def test_minhash():
+        a = dedup.minhash(LINES)
+        assert a.shape == (64,) and a.dtype == np.uint64
+        assert (dedup.minhash(LINES) == a).all()
+        similar = dedup.minhash(LINES + b'+one more line\n')
+        other = dedup.minhash(LINES.replace(b'line', b'row'))
+        assert (a == similar).mean() > 0.7
+        assert (a == other).mean() < 0.3
+
+    @staticmethod
+    def test_dedup(tmpdir):
+        sha = ['{:040x}'.format(i) for i in range(5)]
+        _write(tmpdir, sha[3], DIFF, b'Pass the tokenizer')
+        _write(tmpdir, sha[1], PICKED, b'Pass the tokenizer')
+        _write(tmpdir, sha[2], LINES, b'Add lines')
+        _write(tmpdir, sha[4], LINES + b'+one more line\n', b'More lines')
+
+        assert dedup.dedup(str(tmpdir)) == 1
+        index = dedup.read_index(str(tmpdir))
+        assert index[sha[3]] == (index[sha[1]][0], sha[1])
+        assert index[sha[2]][1] == sha[2] and index[sha[4]][1] == sha[4]
+
+        corpus = load.open_corpus(str(tmpdir))
+        assert corpus.shas == [sha[1], sha[2], sha[4]]
+        assert corpus.split_keys[0] == index[sha[1]][0]
+
+        # new commits are added to the groups of the existing ones
+        _write(tmpdir, sha[0], DIFF, b'Pass the tokenizer')
+        assert dedup.dedup(str(tmpdir), near_duplicates=True) == 3
+        index = dedup.read_index(str(tmpdir))
+        assert index[sha[0]][1] == sha[1]
+        assert index[sha[4]][1] == sha[2]
+
+        with pytest.raises(ValueError):
+            dedup.dedup(str(tmpdir), num_perm=10)
+
+    @staticmethod
+    def test_cli(tmpdir, capsys):
+        _write(tmpdir, 'a' * 40, DIFF, b'Pass the tokenizer')
+        _write(tmpdir, 'b' * 40, DIFF, b'Pass the tokenizer')
+        sys.argv = ['dedup.py', str(tmpdir), '--near-duplicates']
+        dedup.cli()
+        assert '1 duplicate commits' in capsys.readouterr().out
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import os
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+from dashm.models import hook
+from dashm.models import serve
+
+
+class _LengthPredictor():
+    """
+    Stands in for `Predictor`, "predicting" the length of the diff.
+    """
+
+    delay = 0.0
+
+    def predict_batch(self, diffs, max_len=300):
+        time.sleep(self.delay)
+        return [b'Change ' + str(len(d)).encode('ascii') for d in diffs]
+
+
+class Test_Hook():
+    @classmethod
+    def setup_method(cls):
+        cls.__old_sys_argv = sys.argv
+        cls.__old_environ = dict(os.environ)
+        # no background warming from the hooks during the tests
+        os.environ[hook.WARMING] = '1'
+
+        cls.repo = Path(tempfile.mkdtemp())
+        cls._git('init', '-q')
+        cls._git('config', 'user.email', 'dashm@example.com')
+        cls._git('config', 'user.name', 'dashm')
+        (cls.repo / 'README').write_text('hello\n')
+        cls._git('add', 'README')
+        cls._git('commit', '-q', '-m', 'Initial commit')
+        (cls.repo / 'README').write_text('hello\nworld\n')
+        cls._git('add', 'README')
+
+        cls.predictor = _LengthPredictor()
+        cls.socket_path = str(cls.repo / 'dashm.sock')
+        cls.server = serve.make_server(cls.predictor,
+                                       socket_path=cls.socket_path)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def teardown_method(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.server.batcher.close()
+        shutil.rmtree(cls.repo)
+        os.environ.clear()
+        os.environ.update(cls.__old_environ)
+        sys.argv = cls.__old_sys_argv
+
+    @classmethod
+    def _git(cls, *args):
+        return sp.check_output(['git'] + list(args), cwd=str(cls.repo))
+
+    def _msg_file(self, contents=b'\n# comments\n'):
+        msg_file = self.repo / 'COMMIT_MSG'
+        msg_file.write_bytes(contents)
+        return msg_file
+
+    def _expected(self):
+        return 'Change {}'.format(len(hook.staged_diff(self.repo))).encode()
+
+    def test_cache(self):
+        tree = hook.staged_tree(self.repo)
+        assert hook.read_cache(self.repo, tree) is None
+
+        hook.warm(self.repo, socket_path=self.socket_path)
+        assert hook.read_cache(self.repo, tree) == self._expected()
+
+        # a cached message needs no server
+        self.predictor.delay = 10.0
+        msg_file = self._msg_file()
+        assert hook.prepare_commit_msg(msg_file, repo=self.repo, budget=0.5,
+                                       socket_path=self.socket_path,
+                                       warm_on_miss=False)
+        assert msg_file.read_bytes() == self._expected() + b'\n\n# comments\n'
+
+        # staging something else changes the tree
+        (self.repo / 'README').write_text('bye\n')
+        self._git('add', 'README')
+        assert hook.staged_tree(self.repo) != tree
+
+        hook.CACHE_SIZE, old_size = 1, hook.CACHE_SIZE
+        try:
+            hook.write_cache(self.repo, 'abc', b'msg')
+        finally:
+            hook.CACHE_SIZE = old_size
+        assert [f.name for f in hook.cache_dir(self.repo).glob('*.msg')] \
+            == ['abc.msg']
+
+    def test_budget(self):
+        msg_file = self._msg_file()
+        self.predictor.delay = 2.0
+        start = time.monotonic()
+        assert not hook.prepare_commit_msg(msg_file, repo=self.repo,
+                                           budget=0.2,
+                                           socket_path=self.socket_path,
+                                           warm_on_miss=False)
+        assert time.monotonic() - start < 1.5
+        assert msg_file.read_bytes() == b'\n# comments\n'
+
+        # no server, no message
+        assert not hook.prepare_commit_msg(msg_file, repo=self.repo,
+                                           socket_path='/nonexistent.sock',
+                                           warm_on_miss=False)
+        assert msg_file.read_bytes() == b'\n# comments\n'
+
+        # messages given with -m and the like are left alone
+        msg_file = self._msg_file(b'mine\n')
+        assert not hook.prepare_commit_msg(msg_file, 'message',
+                                           repo=self.repo,
+                                           socket_path=self.socket_path)
+        assert msg_file.read_bytes() == b'mine\n'
+
+    def test_install(self):
+        hooks = hook.install(self.repo, budget=5.0,
+                             socket_path=self.socket_path)
+        assert [h.name for h in hooks] == hook.HOOKS
+        assert all(os.access(str(h), os.X_OK) for h in hooks)
+        hook.install(self.repo)  # replacing our own hooks is fine
+
+        (self.repo / '.git/hooks/post-index-change').write_text('#!/bin/sh\n')
+        with pytest.raises(FileExistsError):
+            hook.install(self.repo)
+        hook.install(self.repo, budget=5.0, socket_path=self.socket_path,
+                     force=True)
+
+        expected = self._expected()
+        sp.check_call(['git', 'commit', '-q'], cwd=str(self.repo),
+                      env=dict(os.environ, GIT_EDITOR='true'))
+        assert self._git('log', '-1', '--format=%B').strip() == expected
+
+    def test_post_index_change(self, monkeypatch):
+        # stands in for Python, recording that the hook started it
+        launched = self.repo / 'launched'
+        fake_python = self.repo / 'python'
+        fake_python.write_text('#!/bin/sh\ntouch "{}"\n'.format(launched))
+        fake_python.chmod(0o755)
+        monkeypatch.setattr(hook.sys, 'executable', str(fake_python))
+        script = hook.install(self.repo)[1]
+        env = dict(os.environ)
+        del env[hook.WARMING]
+
+        def run():
+            if launched.exists():
+                launched.unlink()
+            sp.check_call([str(script)], cwd=str(self.repo), env=env)
+            return launched.exists()
+
+        assert run()  # nothing cached yet
+        hook.warm(self.repo, socket_path=self.socket_path)
+        assert not run()  # cached
+        self._git('status')
+        assert not run()
+
+        (self.repo / 'README').write_text('hello\nagain\n')
+        self._git('add', 'README')
+        (hook.cache_dir(self.repo) / hook.WARM_TREE).write_text(
+            hook.staged_tree(self.repo)
+        )
+        assert not run()  # already being warmed
+        (self.repo / 'README').write_text('hello\nagain and again\n')
+        self._git('add', 'README')
+        assert run()
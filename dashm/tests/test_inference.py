@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import os
+from pathlib import Path
+import shutil
+import sys
+
+import numpy as np
+import pytest
+
+from dashm.data import get_data
+from dashm.data import process_data
+from dashm.models import train
+from dashm.models import predict
+from dashm.models import inference
+
+TEST_STRING = b'''diff --git a/README.md b/README.md
+index 7d7ceb2..075a5c7 100644
+--- a/README.md
++++ b/README.md
+@@ -2,3 +2,5 @@
+ Repo that `dashm` can develop against.
+
+ This needs some commits that we can use.
++
++So we'll make some edits to the README.
+'''
+
+
+class Test_Inference():
+    @classmethod
+    def _clean(cls):
+        data_path = Path(__file__).parents[2] / 'data/'
+        for interim in ['raw-repos', 'processed-repos']:
+            dst = data_path / interim / 'dashm-testing'
+            try:
+                shutil.rmtree(dst)
+            except FileNotFoundError:
+                pass
+            try:
+                os.remove(str(dst) + '.dashm')
+            except FileNotFoundError:
+                pass
+
+        cls.models_path = Path(__file__).parents[1] / 'models/saved'
+        dashm_testing_folders = cls.models_path.glob('*dashm-testing')
+        for dashm_testing_folder in dashm_testing_folders:
+            shutil.rmtree(dashm_testing_folder)
+
+    @classmethod
+    def setup_class(cls):
+        cls._clean()
+        get_data.clone('https://github.com/kbrose/dashm-testing.git')
+        process_data.process('dashm-testing')
+
+    @classmethod
+    def teardown_class(cls):
+        cls._clean()
+
+    @classmethod
+    def setup_method(cls):
+        cls.__old_sys_argv = sys.argv
+
+    @classmethod
+    def teardown_method(cls):
+        sys.argv = cls.__old_sys_argv
+        dashm_testing_folders = cls.models_path.glob('*dashm-testing')
+        for dashm_testing_folder in dashm_testing_folders:
+            shutil.rmtree(dashm_testing_folder)
+
+    @pytest.mark.parametrize('embedding_dim', [0, 8])
+    def test_numpy_matches_keras(self, embedding_dim):
+        train.train('dashm-testing', 0.5, steps_per_epoch=3, epochs=1,
+                    embedding_dim=embedding_dim)
+        folder = list(self.models_path.glob('*dashm-testing'))[0]
+        assert (folder / inference.INFERENCE_FILE).exists()
+
+        numpy_predictor = predict.Predictor('*dashm-testing')
+        keras_predictor = predict.Predictor('*dashm-testing', engine='keras')
+        assert numpy_predictor.engine == 'numpy'
+        assert keras_predictor.engine == 'keras'
+
+        np.testing.assert_allclose(
+            numpy_predictor.state_from_diff(TEST_STRING),
+            keras_predictor.state_from_diff(TEST_STRING),
+            rtol=1e-4, atol=1e-5
+        )
+        np.testing.assert_allclose(
+            numpy_predictor.predict_proba(TEST_STRING, 20),
+            keras_predictor.predict_proba(TEST_STRING, 20),
+            rtol=1e-4, atol=1e-5
+        )
+
+    def test_export_cli(self):
+        train.train('dashm-testing', 0.5, steps_per_epoch=3, epochs=1)
+        folder = list(self.models_path.glob('*dashm-testing'))[0]
+        (folder / inference.INFERENCE_FILE).unlink()
+
+        with pytest.raises(FileNotFoundError):
+            predict.Predictor('*dashm-testing', engine='numpy')
+        assert predict.Predictor('*dashm-testing').engine == 'keras'
+
+        sys.argv = ['unused', folder.name]
+        inference.cli()
+        assert predict.Predictor('*dashm-testing').engine == 'numpy'
+
+        with pytest.raises(ValueError):
+            predict.Predictor('*dashm-testing', engine='non-existent')
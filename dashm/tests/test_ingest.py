@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import os
+from pathlib import Path
+import shutil
+import subprocess as sp
+import sys
+
+import pytest
+
+from dashm.data import ingest
+from dashm.data import process_data
+
+NAMES = ['dashm-ingest-a', 'dashm-ingest-b']
+
+
+def _git(cwd, *args):
+    return sp.check_output(['git', '-c', 'user.name=dashm',
+                            '-c', 'user.email=dashm@example.com']
+                           + list(args), cwd=str(cwd))
+
+
+def _commit(work, n):
+    work.join('file.py').write('\n'.join(str(i) for i in range(n)) + '\n')
+    _git(work, 'add', '-A')
+    _git(work, 'commit', '-q', '-m', 'Commit {}'.format(n))
+
+
+def _bare_repo(tmpdir, name, n_commits):
+    """
+    A local bare repo `<tmpdir>/<name>.git`, and a clone to push from.
+    """
+    work = tmpdir.join(name + '-work')
+    work.mkdir()
+    _git(work, 'init', '-q')
+    for n in range(1, n_commits + 1):
+        _commit(work, n)
+    bare = str(tmpdir.join(name + '.git'))
+    sp.check_call(['git', 'clone', '-q', '--bare', str(work), bare])
+    _git(work, 'remote', 'add', 'origin', bare)
+    return bare, work
+
+
+class Test_Ingest():
+    @classmethod
+    def _clean(cls):
+        cls.data_path = Path(__file__).parents[2] / 'data/'
+        for interim in ['raw-repos', 'processed-repos']:
+            for name in NAMES:
+                dst = cls.data_path / interim / name
+                shutil.rmtree(dst, ignore_errors=True)
+                try:
+                    os.remove(str(dst) + '.dashm')
+                except FileNotFoundError:
+                    pass
+
+    @classmethod
+    def setup_method(cls):
+        cls.__old_sys_argv = sys.argv
+        cls._clean()
+
+    @classmethod
+    def teardown_method(cls):
+        cls._clean()
+        sys.argv = cls.__old_sys_argv
+
+    def test_ingest(self, tmpdir):
+        a, work = _bare_repo(tmpdir, NAMES[0], 3)
+        b, _ = _bare_repo(tmpdir, NAMES[1], 2)
+        missing = str(tmpdir.join('missing.git'))
+        tmpdir.mkdir('elsewhere')
+        same_name, _ = _bare_repo(tmpdir.join('elsewhere'), NAMES[0], 1)
+        reports = []
+
+        errors = ingest.run(
+            [a, b, missing, a, same_name], max_fetches=2, max_processes=1,
+            progress=lambda *r: reports.append(r)
+        )
+        assert list(errors) == [a, b, missing, same_name]
+        assert errors[a] is None and errors[b] is None
+        assert errors[missing]
+        assert 'same name' in errors[same_name]
+
+        processed = self.data_path / 'processed-repos'
+        assert len(list((processed / NAMES[0]).glob('*.diff'))) == 2
+        assert len(list((processed / NAMES[1]).glob('*.diff'))) == 1
+        assert (self.data_path / 'raw-repos' / (NAMES[0] + '.dashm')).exists()
+        steps = [step for repo, step, _, _ in reports if repo == a]
+        assert steps[:2] == ['clone', 'process']
+        assert steps[-1].startswith('done')
+        assert reports[-1][2:] == (4, 4)
+
+        # only the new commit is fetched and processed
+        _commit(work, 4)
+        _git(work, 'push', '-q', 'origin', 'HEAD')
+        reports = []
+        errors = ingest.run([a], progress=lambda *r: reports.append(r))
+        assert errors == {a: None}
+        assert reports[0][1] == 'fetch'
+        assert len(list((processed / NAMES[0]).glob('*.diff'))) == 3
+
+    def test_cli(self, tmpdir, capsys):
+        a, _ = _bare_repo(tmpdir, NAMES[0], 2)
+        b, _ = _bare_repo(tmpdir, NAMES[1], 2)
+        repo_list = tmpdir.join('repos.txt')
+        repo_list.write('# repos to train on\n{}\n\n'.format(b))
+
+        sys.argv = ['ingest.py', a, '--file', str(repo_list),
+                    '--processes', '2']
+        ingest.cli()
+        out = capsys.readouterr().out
+        assert '[2/2]' in out
+        for name in NAMES:
+            done, head = process_data.read_manifest(
+                self.data_path / 'processed-repos' / name
+            )
+            assert head and len(done) == 1
+
+        sys.argv = ['ingest.py', str(tmpdir.join('missing.git'))]
+        with pytest.raises(SystemExit):
+            ingest.cli()
@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import os
+import pickle
 from pathlib import Path
 import shutil
 
+import numpy as np
 import pytest
 
 from dashm.data import get_data
 from dashm.data import process_data
 from dashm.data import load
+from dashm.data import tokenizer
 
 class Test_Load():
     @classmethod
@@ -35,17 +38,35 @@ class Test_Load():
         x_train, y_train = load.load('dashm-testing', 0.5, 'train')
         assert len(x_train) == len(y_train)
         for x, y in zip(x_train, y_train):
-            assert (x.sum(axis=1) == 1).all()
-            assert (y.sum(axis=1) == 1).all()
+            assert x.dtype == np.uint8 and y.dtype == np.uint8
+            assert x[-1] == 1 and (x[:-1] >= 2).all()
+            assert y[0] == 0 and y[-1] == 1 and (y[1:-1] >= 2).all()
 
         x_val, y_val = load.load('dashm-testing', 0.5, 'val')
         assert len(x_val) == len(y_val)
         for x, y in zip(x_val, y_val):
-            assert (x.sum(axis=1) == 1).all()
-            assert (y.sum(axis=1) == 1).all()
+            assert x.dtype == np.uint8 and y.dtype == np.uint8
+            assert x[-1] == 1 and (x[:-1] >= 2).all()
+            assert y[0] == 0 and y[-1] == 1 and (y[1:-1] >= 2).all()
 
-        assert abs(len(x_val) - len(x_train)) <= 1
-        assert abs(len(y_val) - len(y_train)) <= 1
+        # split by content hash, not by position
+        assert x_train and x_val
+        assert len(x_train) + len(x_val) == len(load.open_corpus(
+            'dashm-testing'
+        ))
+
+    @staticmethod
+    def test_split_indices():
+        corpus = load.open_corpus('dashm-testing')
+        train = load.split_indices(corpus, 0.5, 'train')
+        val = load.split_indices(corpus, 0.5, 'val')
+        assert sorted(np.concatenate([train, val])) == list(range(len(corpus)))
+        # a larger split only moves validation commits into training
+        assert set(train) <= set(load.split_indices(corpus, 0.8, 'train'))
+        assert not len(load.split_indices(corpus, 0.0, 'train'))
+        assert not len(load.split_indices(corpus, 1.0, 'val'))
+        with pytest.raises(ValueError):
+            load.split_indices(corpus, 0.5, 'non-existent')
 
     @staticmethod
     def test_load_bad_which():
@@ -86,6 +107,158 @@ class Test_Load():
             assert x.shape == x2.shape
             assert (x.flatten() == x2.flatten()).all()
 
+    @staticmethod
+    def test_ragged():
+        arrays = [np.arange(3), np.arange(0), np.arange(5)]
+        r = load.Ragged.from_arrays(arrays)
+        assert len(r) == 3
+        assert r.values.dtype == np.uint8
+        assert list(r.lengths) == [3, 0, 5]
+        for a, b in zip(arrays, r):
+            assert (a == b).all()
+        assert (r[-1] == arrays[-1]).all()
+        with pytest.raises(IndexError):
+            r[3]
+
+    @staticmethod
+    def test_one_hot():
+        x = np.array([[0, 5, -1], [127, -1, -1]])
+        y = load.one_hot(x)
+        assert y.shape == (2, 3, 128)
+        assert (y.sum(axis=2) == (x >= 0)).all()
+        assert y[0, 1, 5] == 1 and y[1, 0, 127] == 1
+
+        msg = b'a message\x00\xff'
+        assert (load.one_hot_encode_msg(msg)
+                == load.one_hot(load.encode_msg(msg))).all()
+
+    @staticmethod
+    def test_format_batch_compact():
+        x, y = load.load('dashm-testing', 1.0, 'train')
+        compact = load.format_batch(list(zip(x, y)), 50, 20)
+        dense = load.format_batch(
+            [(load.one_hot(a), load.one_hot(b)) for a, b in zip(x, y)],
+            50, 20
+        )
+        for a, b in zip(compact[0] + [compact[1]], dense[0] + [dense[1]]):
+            assert a.dtype == b.dtype
+            assert (a == b).all()
+
+    @staticmethod
+    def test_format_batch_sparse():
+        x, y = load.load('dashm-testing', 1.0, 'train')
+        (xs, y0), y1, w = load.format_batch(list(zip(x, y)), 50, 20,
+                                            sparse=True)
+        (dxs, dy0), dy1 = load.format_batch(list(zip(x, y)), 50, 20)
+
+        assert xs.shape == dxs.shape[:2] and xs.dtype == np.int32
+        assert (load.one_hot(np.where(xs == load.PAD, -1, xs)) == dxs).all()
+        assert (load.one_hot(np.where(y0 == load.PAD, -1, y0)) == dy0).all()
+        assert (w == dy1.sum(axis=2)).all()
+        assert (load.one_hot(y1) * w[..., None] == dy1).all()
+
+    @staticmethod
+    def test_encode_batch():
+        rng = np.random.RandomState(0)
+        diffs = [rng.randint(0, 256, size=n).astype(np.uint8).tobytes()
+                 for n in [0, 1, 5, 48, 49, 50, 51, 300]]
+        msgs = [rng.randint(0, 256, size=n).astype(np.uint8).tobytes()
+                for n in [17, 18, 19, 20, 0, 1, 3, 100]]
+        batch = [(load.encode_diff(d), load.encode_msg(m))
+                 for d, m in zip(diffs, msgs)]
+
+        for sparse in [False, True]:
+            expected = load.format_batch(batch, 50, 20, sparse)
+            actual = load.encode_batch(diffs, msgs, 50, 20, sparse)
+            assert len(expected) == len(actual)
+            for a, b in zip(actual[0] + list(actual[1:]),
+                            expected[0] + list(expected[1:])):
+                assert a.dtype == b.dtype
+                assert a.shape == b.shape
+                assert (a == b).all()
+
+        # read straight from other buffers, e.g. memory maps
+        views = load.encode_batch([memoryview(d) for d in diffs],
+                                  [np.frombuffer(m, np.uint8) for m in msgs],
+                                  50, 20)
+        expected = load.format_batch(batch, 50, 20)
+        for a, b in zip(views[0] + [views[1]], expected[0] + [expected[1]]):
+            assert (a == b).all()
+
+    @staticmethod
+    def test_encode_diff_chunks():
+        diff = bytes(range(256)) * 3
+        for chunk_size in [1, 7, 256, 768, 769, 1000]:
+            chunks = list(load.encode_diff_chunks(diff, chunk_size))
+            assert all(len(c) == chunk_size for c in chunks[:-1])
+            assert 0 < len(chunks[-1]) <= chunk_size
+            assert (np.concatenate(chunks) == load.encode_diff(diff)).all()
+        assert [list(c) for c in load.encode_diff_chunks(b'', 4)] == [[1]]
+
+    @staticmethod
+    def test_bucket_sampler():
+        corpus = load.open_corpus('dashm-testing')
+        n = len(load.split_indices(corpus, 0.5, 'train'))
+        sampler = load.BucketSampler('dashm-testing', 0.5, 2, 400, 200,
+                                     replace=False, diff_bounds=[100, 300],
+                                     msg_bounds=[10, 20, 50])
+        assert sum(len(b[2]) for b in sampler.buckets) == n
+        for diff_len, msg_len, indices in sampler.buckets:
+            assert (corpus.diff_lengths()[indices] + 1 <= diff_len).all()
+            assert (corpus.msg_lengths()[indices] + 2 <= msg_len).all()
+
+        batches = iter(sampler)
+        seen = 0
+        for _ in range(sampler.batches_per_epoch):
+            (x, y0), y1 = next(batches)
+            assert x.shape[1] in [100, 300, 400]
+            assert y0.shape[1] + 1 in [10, 20, 50, 200]
+            # the end of every diff and the start of every message is kept
+            assert (x[:, -1, 1] == 1).all()
+            assert (y0[:, 0, 0] == 1).all()
+            seen += len(x)
+        assert seen == n
+
+        sampler = load.BucketSampler('dashm-testing', 0.5, 3, 400, 200,
+                                     sparse=True)
+        (x, y0), y1, w = next(iter(sampler))
+        assert len(x) == 3 and x.ndim == 2
+
+    @staticmethod
+    def test_commit_sequence():
+        corpus = load.open_corpus('dashm-testing')
+        n = len(load.split_indices(corpus, 1.0, 'train'))
+        assert n == len(corpus)
+        seq = load.CommitSequence('dashm-testing', 1.0, 2, 50, 20)
+        assert len(seq) == int(np.ceil(n / 2))
+
+        # random access is deterministic, and covers every commit once
+        first = [seq[i] for i in range(len(seq))]
+        again = seq[len(seq) - 1]
+        assert (again[0][0] == first[-1][0][0]).all()
+        assert sum(len(b[1]) for b in first) == n
+
+        # unpickled copies (as in worker processes) agree
+        copy = pickle.loads(pickle.dumps(seq))
+        assert (copy[0][1] == first[0][1]).all()
+
+        seq.on_epoch_end()
+        assert seq.epoch == 1
+        assert copy.epoch == 0
+        # the order is drawn once per epoch, not per batch
+        assert (seq.order == seq._order()).all()
+        assert not (seq.order == copy.order).all()
+
+        shards = [load.CommitSequence('dashm-testing', 1.0, 2, 50, 20,
+                                      shard=i, num_shards=3)
+                  for i in range(3)]
+        all_indices = np.concatenate([s.indices for s in shards])
+        assert sorted(all_indices) == list(range(n))
+
+        with pytest.raises(ValueError):
+            load.CommitSequence('dashm-testing', 1.0, 2, 50, 20,
+                                shard=3, num_shards=3)
+
     @staticmethod
     def test_load_generator():
         g = load.load_train_generator('dashm-testing', 0.5)
@@ -93,6 +266,49 @@ class Test_Load():
         assert (x.sum(axis=1) == 1).all()
         assert (y.sum(axis=1) == 1).all()
 
+        g = load.load_train_generator('dashm-testing', 0.5,
+                                      encoding='compact')
+        x, y = next(g)
+        assert x.ndim == 1 and y.ndim == 1
+
+        g = load.load_train_generator('dashm-testing', 0.5, encoding='raw')
+        x, y = next(g)
+        assert isinstance(x, bytes) and isinstance(y, bytes)
+
+        with pytest.raises(ValueError):
+            next(load.load_train_generator('dashm-testing', 0.5,
+                                           encoding='non-existent'))
+
+    @staticmethod
+    def test_load_tokenizer():
+        tok = tokenizer.fit_corpus('dashm-testing', 1.0, vocab_size=300)
+        x, y = load.load('dashm-testing', 1.0, 'train')
+        tx, ty = load.load('dashm-testing', 1.0, 'train', tokenizer=tok)
+        assert tx.values.dtype == np.uint16
+        assert (tx.values < tok.vocab_size).all()
+        assert tx.lengths.sum() * 2 < x.lengths.sum()
+        assert ty.lengths.sum() < y.lengths.sum()
+        for a, b in zip(y, ty):
+            assert tok.decode(b) == a.tobytes()
+
+        tx, ty = load.load('dashm-testing', 1.0, 'train', max_diff_len=5,
+                           max_msg_len=3, tokenizer=tok)
+        assert tx.lengths.max() <= 6 and ty.lengths.max() <= 5
+
+        g = load.load_train_generator('dashm-testing', 1.0, 50, 20,
+                                      encoding='compact', tokenizer=tok)
+        batch = load.format_batch([next(g) for _ in range(4)], 50, 20,
+                                  sparse=True)
+        assert batch[0][0].shape == (4, 50)
+        with pytest.raises(ValueError):
+            next(load.load_train_generator('dashm-testing', 1.0,
+                                           tokenizer=tok))
+
+        seq = load.CommitSequence('dashm-testing', 1.0, 2, 50, 20,
+                                  sparse=True, tokenizer=tok)
+        (xs, y0), y1, w = seq[0]
+        assert xs.shape == (2, 50) and y1.shape == (2, 19)
+
     @staticmethod
     def test_format_batch():
         g = load.load_train_generator('dashm-testing', 0.5)
@@ -3,7 +3,11 @@
 import io
 from contextlib import redirect_stdout
 
-from dashm.models.make_models import make_models
+import numpy as np
+import pytest
+
+from dashm.data.encode import encode_diff, one_hot
+from dashm.models.make_models import make_models, make_chunk_encoder
 
 
 class Test_MakeModels():
@@ -36,3 +40,56 @@ class Test_MakeModels():
         for line in s.split('\n'):
             assert len(line) < 101 # one char lee-way for windows
         assert max(len(line) for line in s.split('\n')) > 90
+
+    @staticmethod
+    def test_embedding():
+        trainer, encoder, decoder = make_models(summary=False,
+                                                embedding_dim=8)
+        assert trainer.input_shape == [(None, None), (None, None)]
+        assert encoder.input_shape == (None, None)
+        assert decoder.input_shape[0] == (None, None)
+
+    @staticmethod
+    def test_vocab_size():
+        trainer, encoder, decoder = make_models(summary=False,
+                                                embedding_dim=8,
+                                                vocab_size=300)
+        assert trainer.output_shape == (None, None, 300)
+        assert decoder.output_shape[0] == (None, None, 300)
+        assert encoder.get_layer('encoder_embedding').input_dim == 300
+
+        with pytest.raises(ValueError):
+            make_models(summary=False, vocab_size=300)
+
+    @staticmethod
+    def test_chunk_encoder():
+        ids = encode_diff(b'diff --git a/README b/README\n+hello\n' * 3)
+        for embedding_dim in [0, 8]:
+            _, encoder, _ = make_models(summary=False,
+                                        embedding_dim=embedding_dim)
+            x = (ids[None].astype(np.int32) if embedding_dim
+                 else one_hot(ids[None]))
+            chunk_encoder = make_chunk_encoder(encoder)
+            states = [np.zeros((1, int(inp.shape[-1])), np.float32)
+                      for inp in chunk_encoder.inputs[1:]]
+            for start in range(0, x.shape[1], 10):
+                states = chunk_encoder.predict_on_batch(
+                    [x[:, start:start + 10]] + states
+                )
+            np.testing.assert_allclose(states[-1],
+                                       encoder.predict_on_batch(x),
+                                       rtol=1e-5, atol=1e-6)
+
+    @staticmethod
+    def test_bptt():
+        trainer, encoder, decoder = make_models(summary=False, bptt_steps=5)
+        reference = make_models(summary=False)
+        # same weights, in the same order, as without truncation
+        for model, other in zip([trainer, encoder, decoder], reference):
+            assert ([w.shape for w in model.get_weights()]
+                    == [w.shape for w in other.get_weights()])
+
+        trainer.compile('adadelta', loss='categorical_crossentropy')
+        x = one_hot(np.random.randint(0, 128, size=(2, 12)))
+        y = one_hot(np.random.randint(0, 128, size=(2, 4)))
+        trainer.train_on_batch([x, y], y)
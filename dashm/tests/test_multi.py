@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import pickle
+from pathlib import Path
+import shutil
+import sys
+
+import numpy as np
+import pytest
+
+from dashm.data import get_data
+from dashm.data import process_data
+from dashm.data import load
+from dashm.data import multi
+
+
+class Test_Multi():
+    @classmethod
+    def setup_class(cls):
+        get_data.clone('https://github.com/kbrose/dashm-testing.git')
+        process_data.process('dashm-testing')
+
+    @classmethod
+    def teardown_class(cls):
+        cls.data_path = Path(__file__).parents[2] / 'data/'
+        for interim in ['raw-repos', 'processed-repos']:
+            dst = cls.data_path / interim / 'dashm-testing'
+            try:
+                shutil.rmtree(dst)
+            except FileNotFoundError:
+                pass
+            try:
+                os.remove(str(dst) + '.dashm')
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def setup_method(cls):
+        cls.__old_sys_argv = sys.argv
+
+    @classmethod
+    def teardown_method(cls):
+        sys.argv = cls.__old_sys_argv
+
+    @staticmethod
+    def test_corpus(tmpdir):
+        path = str(tmpdir.join('corpus.json'))
+        single = load.open_corpus('dashm-testing')
+        multi.write_manifest(path, ['dashm-testing', 'dashm-testing'],
+                             [1.0, 0.0])
+
+        corpus = load.open_corpus(path)
+        assert isinstance(corpus, multi.MultiCorpus)
+        assert len(corpus) == 2 * len(single)
+        assert not corpus._corpora  # nothing opened yet
+        n = len(single)
+        assert corpus.diff(n) == single.diff(0)
+        assert corpus.msg(n + 1, 3) == single.msg(1, 3)
+        assert corpus.shas == single.shas * 2
+        assert (corpus.diff_lengths()
+                == np.tile(single.diff_lengths(), 2)).all()
+        with pytest.raises(IndexError):
+            corpus.diff(2 * n)
+
+        # the split is that of each repo
+        train = load.split_indices(single, 0.5, 'train')
+        assert (load.split_indices(corpus, 0.5, 'train')
+                == np.concatenate([train, train + n])).all()
+
+        copy = pickle.loads(pickle.dumps(corpus))
+        assert not copy._corpora
+        assert copy.diff(0) == single.diff(0)
+
+    @staticmethod
+    def test_sample(tmpdir):
+        path = str(tmpdir.join('corpus.json'))
+        multi.write_manifest(path, ['dashm-testing', 'dashm-testing'],
+                             [0.0, 1.0])
+        corpus = multi.MultiCorpus(path)
+        n = len(corpus) // 2
+        train = load.split_indices(load.open_corpus('dashm-testing'), 0.5,
+                                   'train')
+        rng = np.random.RandomState(0)
+        drawn = {corpus.sample(0.5, rng) for _ in range(100)}
+        assert drawn == set(train + n)
+        assert list(corpus._corpora) == [1]  # only the sampled repo
+
+        shards = [{corpus.sample(0.5, rng, shard=s, num_shards=2)
+                   for _ in range(100)} for s in range(2)]
+        assert not shards[0] & shards[1]
+
+        val = load.split_indices(load.open_corpus('dashm-testing'), 0.5,
+                                 'val')
+        drawn = {corpus.sample(0.5, rng, which='val') for _ in range(100)}
+        assert drawn == set(val + n)
+
+        with pytest.raises(ValueError):
+            corpus.sample(0.0, rng)
+        with pytest.raises(ValueError):
+            corpus.sample(1.0, rng, which='val')
+
+    @staticmethod
+    def test_stale_manifest(tmpdir):
+        path = str(tmpdir.join('corpus.json'))
+        with open(path, 'w') as f:
+            json.dump({'repos': [{'name': 'dashm-testing', 'weight': 1,
+                                  'n_commits': 1000}]}, f)
+        with pytest.raises(ValueError):
+            multi.MultiCorpus(path).diff(0)
+
+        # processed again since the manifest was written
+        multi.write_manifest(path, ['dashm-testing'])
+        processed = Path(__file__).parents[2] / 'data/processed-repos'
+        dst = processed / 'dashm-testing'
+        n = len(load.open_corpus('dashm-testing'))
+        commit = sorted(dst.glob('*.diff'))[0]
+        diff, msg = commit.read_bytes(), commit.with_suffix('.msg')
+        msg_bytes = msg.read_bytes()
+        try:
+            commit.unlink()
+            msg.unlink()
+            with open(str(dst / process_data.MANIFEST), 'a') as f:
+                f.write('\n')
+            with pytest.warns(UserWarning):
+                corpus = multi.MultiCorpus(path)
+            assert len(corpus) == len(load.open_corpus('dashm-testing'))
+            assert len(corpus) < n
+            corpus.diff(len(corpus) - 1)
+        finally:
+            commit.write_bytes(diff)
+            msg.write_bytes(msg_bytes)
+
+        with pytest.raises(ValueError):
+            multi.write_manifest(str(tmpdir.join('corpus.txt')),
+                                 ['dashm-testing'])
+        with pytest.raises(ValueError):
+            multi.write_manifest(path, ['dashm-testing'], [1.0, 2.0])
+
+    @staticmethod
+    def test_load(tmpdir):
+        path = str(tmpdir.join('corpus.json'))
+        multi.write_manifest(path, ['dashm-testing', 'dashm-testing'],
+                             [1.0, 0.0])
+        x, y = load.load(path, 0.5, 'train', 20, 10)
+        x1, y1 = load.load('dashm-testing', 0.5, 'train', 20, 10)
+        assert len(x) == 2 * len(x1)
+
+        n = len(multi.MultiCorpus(path)) // 2
+        gen = load.load_train_generator(path, 0.5, 20, 10, encoding='raw')
+        single = load.open_corpus('dashm-testing')
+        diffs = {bytes(single.diff(i, 20)) for i in range(n)}
+        assert all(next(gen)[0] in diffs for _ in range(10))
+
+        seq = load.CommitSequence(path, 0.5, 2, 20, 10, sparse=True)
+        assert len(seq) == int(np.ceil(len(x) / 2))
+        # all the weight is on the first repo
+        for _ in range(3):
+            chosen = seq._order()
+            assert (chosen < n).all()
+            seq.on_epoch_end()
+
+    @staticmethod
+    def test_cli(tmpdir, capsys):
+        path = str(tmpdir.join('corpus.json'))
+        sys.argv = ['multi.py', path, 'dashm-testing=2', 'dashm-testing']
+        multi.cli()
+        with open(path) as f:
+            repos = json.load(f)['repos']
+        assert [r['weight'] for r in repos] == [2.0, 1.0]
+        assert 'commits in 2 repos' in capsys.readouterr().out
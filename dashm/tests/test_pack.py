@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+from pathlib import Path
+import shutil
+import sys
+
+from dashm.data import get_data
+from dashm.data import process_data
+from dashm.data import pack
+from dashm.data import load
+
+
+class Test_Pack():
+    @classmethod
+    def _clean(cls):
+        cls.data_path = Path(__file__).parents[2] / 'data/'
+        for interim in ['raw-repos', 'processed-repos']:
+            dst = cls.data_path / interim / 'dashm-testing'
+            try:
+                shutil.rmtree(dst)
+            except FileNotFoundError:
+                pass
+            try:
+                os.remove(str(dst) + '.dashm')
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def setup_method(cls):
+        cls.__old_sys_argv = sys.argv
+        cls._clean()
+        get_data.clone('https://github.com/kbrose/dashm-testing.git')
+        process_data.process('dashm-testing')
+
+    @classmethod
+    def teardown_method(cls):
+        cls._clean()
+        sys.argv = cls.__old_sys_argv
+
+    def test_pack(self):
+        dst = self.data_path / 'processed-repos/dashm-testing'
+        unpacked = load.open_corpus('dashm-testing')
+        assert not isinstance(unpacked, pack.PackedCorpus)
+
+        pack.pack('dashm-testing')
+        packed = load.open_corpus('dashm-testing')
+        assert isinstance(packed, pack.PackedCorpus)
+
+        assert len(packed) == len(unpacked)
+        assert packed.shas == unpacked.shas
+        assert packed.split_keys == unpacked.split_keys
+        for i in range(len(packed)):
+            assert bytes(packed.msg(i)) == unpacked.msg(i)
+            assert bytes(packed.diff(i)) == unpacked.diff(i)
+            assert bytes(packed.diff(i, 5)) == unpacked.diff(i, 5)
+            assert bytes(packed.msg(i, 0)) == b''
+        assert list(dst.glob('*.diff'))
+
+    def test_load_packed(self):
+        x0, y0 = load.load('dashm-testing', 0.5, 'train', 20, 10)
+        pack.pack('dashm-testing')
+        x1, y1 = load.load('dashm-testing', 0.5, 'train', 20, 10)
+        for a, b in zip(list(x0) + list(y0), list(x1) + list(y1)):
+            assert (a == b).all()
+
+        x, y = next(load.load_train_generator('dashm-testing', 0.5))
+        assert (x.sum(axis=1) == 1).all()
+        assert (y.sum(axis=1) == 1).all()
+
+    def test_cli_remove(self):
+        dst = self.data_path / 'processed-repos/dashm-testing'
+        n = len(list(dst.glob('*.diff')))
+
+        sys.argv = ['unused', 'dashm-testing', '--remove']
+        pack.cli()
+
+        assert not list(dst.glob('*.diff'))
+        assert not list(dst.glob('*.msg'))
+        assert len(load.open_corpus('dashm-testing')) == n
+
+    def test_repack(self):
+        dst = self.data_path / 'processed-repos/dashm-testing'
+        unpacked = load.open_corpus('dashm-testing')
+        expected = [(unpacked.msg(i), unpacked.diff(i))
+                    for i in range(len(unpacked))]
+
+        # pack all commits but one, as if it was not extracted yet
+        manifest = dst / process_data.MANIFEST
+        with open(manifest) as fp:
+            header, first, *lines = fp.readlines()
+        with open(manifest, 'w') as fp:
+            fp.writelines([header] + [line for line in lines
+                                      if not line.startswith('HEAD ')])
+        new = first.split()[0]
+        (dst / (new + '.diff')).unlink()
+        (dst / (new + '.msg')).unlink()
+        pack.pack('dashm-testing', remove=True)
+        assert len(load.open_corpus('dashm-testing')) == len(expected) - 1
+
+        # processing adds the new commit to the pack
+        process_data.process('dashm-testing')
+        assert [f.stem for f in dst.glob('*.diff')] == [new]
+        packed = load.open_corpus('dashm-testing')
+        assert isinstance(packed, pack.PackedCorpus)
+        assert [(bytes(packed.msg(i)), bytes(packed.diff(i)))
+                for i in range(len(packed))] == expected
+
+        # and packing again keeps the commits packed before
+        pack.pack('dashm-testing', remove=True)
+        assert len(load.open_corpus('dashm-testing')) == len(expected)
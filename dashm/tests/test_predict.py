@@ -5,14 +5,20 @@ from pathlib import Path
 import shutil
 import sys
 import io
+import asyncio
+import threading
 from contextlib import redirect_stdout
 
+import numpy as np
 import pytest
 
+from dashm import profiling
 from dashm.data import get_data
 from dashm.data import process_data
 from dashm.models import train
 from dashm.models import predict
+from dashm.models import registry
+from dashm.models import serve
 
 TEST_STRING = b'''diff --git a/Makefile b/Makefile
 index 9917f99..8a30d76 100644
@@ -34,6 +40,17 @@ index 9917f99..8a30d76 100644
 '''
 
 
+def _perturbed_predictor():
+    # no cache, so that `predict` encodes the diffs again
+    predictor = predict.Predictor(engine='keras', cache_size=0)
+    # barely trained GRUs keep a zero state on padding, perturb the
+    # weights so that any padding would show
+    rng = np.random.RandomState(0)
+    predictor.encoder.set_weights([w + rng.normal(0, 0.5, w.shape)
+                                   for w in predictor.encoder.get_weights()])
+    return predictor
+
+
 class Test_Predict():
     @classmethod
     def _clean(cls):
@@ -88,12 +105,225 @@ class Test_Predict():
 
         predictor_explicit.predict(TEST_STRING.decode('utf-8'), 200)
 
+    def test_predict_batch(self):
+        predictor = predict.Predictor()
+        other = TEST_STRING.replace(b'clean', b'CLEAN')
+        diffs = [TEST_STRING, other, TEST_STRING.decode('utf-8')]
+
+        preds = predictor.predict_batch(diffs, 50)
+        assert preds == [predictor.predict(d, 50) for d in diffs]
+
+        probs = predictor.predict_proba_batch(diffs, 30)
+        assert probs.shape == (3, 30, 128)
+        np.testing.assert_allclose(probs[0], probs[2])
+        np.testing.assert_allclose(
+            probs[1], predictor.predict_proba(other, 30).reshape(30, 128),
+            rtol=1e-5, atol=1e-6
+        )
+
+        preds = predictor.predict_batch([TEST_STRING, b'short'], 20)
+        assert len(preds) == 2
+        assert all(len(p) <= 20 for p in preds)
+
+    def test_predict_batch_mixed_lengths(self):
+        predictor = _perturbed_predictor()
+        diffs = [TEST_STRING, b'short', TEST_STRING[:200], b'diff',
+                 TEST_STRING[100:]]
+
+        preds = predictor.predict_batch(diffs, 50)
+        assert preds == [predictor.predict(d, 50) for d in diffs]
+
+        states = predictor.states_from_diffs(diffs)
+        for diff, state in zip(diffs, states):
+            np.testing.assert_allclose(state[None],
+                                       predictor.state_from_diff(diff),
+                                       rtol=1e-5, atol=1e-6)
+
+    def test_predict_served(self):
+        predictor = _perturbed_predictor()
+        batcher = serve.MicroBatcher(predictor, max_batch_size=2,
+                                     max_wait=10.0)
+        try:
+            # two clients, one batch
+            futures = [batcher.submit(d, 50)
+                       for d in [TEST_STRING, TEST_STRING[:150]]]
+            assert ([f.result(timeout=60) for f in futures]
+                    == [predictor.predict(TEST_STRING, 50),
+                        predictor.predict(TEST_STRING[:150], 50)])
+        finally:
+            batcher.close()
+
+    def test_predict_beam_and_sample(self):
+        predictor = predict.Predictor()
+
+        beams = predictor.predict_beam(TEST_STRING, k=3, max_len=20)
+        assert 1 <= len(beams) <= 3
+        scores = [score for _, score in beams]
+        assert scores == sorted(scores, reverse=True)
+        assert all(len(msg) <= 20 for msg, _ in beams)
+
+        samples = predictor.predict_sample(TEST_STRING, n=4, max_len=20,
+                                           seed=0)
+        assert len(samples) == 4
+        assert samples == predictor.predict_sample(TEST_STRING, n=4,
+                                                   max_len=20, seed=0)
+        scores = [score for _, score in samples]
+        assert scores == sorted(scores, reverse=True)
+
+        # only keeping the single best character is greedy decoding
+        best, score = predictor.predict_beam(TEST_STRING, k=1, max_len=20)[0]
+        greedy = predictor.predict_sample(TEST_STRING, n=2, top_k=1,
+                                          max_len=20)
+        assert greedy[0][0] == greedy[1][0] == best
+        assert abs(greedy[0][1] - score) < 1e-4
+
+    def test_predict_stream(self):
+        predictor = predict.Predictor()
+        for max_len in [1, 2, 30]:
+            chars = list(predictor.predict_stream(TEST_STRING, max_len))
+            assert all(len(c) == 1 for c in chars)
+            assert b''.join(chars) == predictor.predict(TEST_STRING, max_len)
+
+        cancel = threading.Event()
+        chars = []
+        for c in predictor.predict_stream(TEST_STRING, 30, cancel=cancel):
+            chars.append(c)
+            cancel.set()
+        assert len(chars) <= 1
+        assert list(predictor.predict_stream(TEST_STRING, 30, timeout=0)) == []
+
+        async def collect(max_len):
+            return [c async for c in predictor.apredict_stream(TEST_STRING,
+                                                                max_len)]
+
+        loop = asyncio.new_event_loop()
+        try:
+            chars = loop.run_until_complete(collect(30))
+        finally:
+            loop.close()
+        assert b''.join(chars) == predictor.predict(TEST_STRING, 30)
+
+    def test_predict_chunked(self):
+        long_diff = TEST_STRING * 20
+        for engine in ['numpy', 'keras']:
+            whole = predict.Predictor(engine=engine, cache_size=0,
+                                      chunk_size=0)
+            chunked = predict.Predictor(engine=engine, cache_size=0,
+                                        chunk_size=100)
+            for diff in [TEST_STRING, long_diff]:
+                np.testing.assert_allclose(chunked.state_from_diff(diff),
+                                           whole.state_from_diff(diff),
+                                           rtol=1e-4, atol=1e-5)
+            # batches encode their long diffs in chunks too
+            np.testing.assert_allclose(
+                chunked.states_from_diffs([TEST_STRING[:50], long_diff]),
+                whole.states_from_diffs([TEST_STRING[:50], long_diff]),
+                rtol=1e-4, atol=1e-5
+            )
+
+        # models trained with truncated backpropagation load the same way
+        train.train('dashm-testing', 0.5, steps_per_epoch=1, epochs=1,
+                    max_diff_len=300, bptt_steps=100)
+        predictor = predict.Predictor(engine='keras', chunk_size=100)
+        assert predict.load_config(predictor.model_dir)['bptt_steps'] == 100
+        assert len(predictor.predict(long_diff, 10)) <= 10
+
+    def test_predict_state_cache(self):
+        predictor = predict.Predictor(cache_size=4, disk_cache=True)
+        state = predictor.state_from_diff(TEST_STRING)
+        assert predictor.state_from_diff(TEST_STRING.decode('utf-8')) is state
+        assert (predictor.cache.hits, predictor.cache.misses) == (1, 1)
+        # batches share the cache
+        states = predictor.states_from_diffs([TEST_STRING, b'other'])
+        np.testing.assert_array_equal(states[:1], state)
+        assert (predictor.cache.hits, predictor.cache.misses) == (2, 2)
+        assert predictor.state_from_diff(b'other') is not None
+        assert predictor.cache.hits == 3
+
+        # a new predictor reads the state back from disk
+        reloaded = predict.Predictor(cache_size=4, disk_cache=True)
+        np.testing.assert_array_equal(reloaded.state_from_diff(TEST_STRING),
+                                      state)
+        assert reloaded.cache.hits == 1
+
+        uncached = predict.Predictor(cache_size=0)
+        assert uncached.cache is None
+        np.testing.assert_allclose(uncached.state_from_diff(TEST_STRING),
+                                   state, rtol=1e-5, atol=1e-6)
+
+        # a retrained model has other weights, no state is reused
+        train.train('dashm-testing', 0.5, steps_per_epoch=1, epochs=1)
+        retrained = predict.Predictor(cache_size=4, disk_cache=True)
+        retrained.state_from_diff(TEST_STRING)
+        assert retrained.cache.misses == 1
+
+    def test_predict_profile(self):
+        predictor = predict.Predictor(cache_size=4)
+        profiler = profiling.enable()
+        try:
+            predictor.predict(TEST_STRING, max_len=5)
+            predictor.predict(TEST_STRING, max_len=5)
+            predictor.predict_batch([TEST_STRING], max_len=5)
+        finally:
+            profiling.disable()
+        summary = profiler.summary()
+        assert summary['counters'] == {'predict.cache_hits': 2,
+                                       'predict.cache_misses': 1}
+        assert summary['timers']['predict.encode']['count'] == 1
+        assert summary['timers']['predict.decoder_step']['count'] >= 3
+
+    def test_predict_swap(self):
+        train.train('dashm-testing', 0.5, steps_per_epoch=1, epochs=2)
+        predictor = predict.Predictor('*dashm-testing')
+        assert predictor.checkpoint is None
+        old = predictor._model
+        run = predictor.model_dir.name
+
+        registry.Registry().promote(run, '000')
+        watcher = predictor.follow_registry(interval=60)
+        assert predictor.checkpoint == '000'
+        assert predictor.model_dir.name == run
+        watcher.stop()
+        # predictions which took the old model are unaffected
+        assert old.checkpoint is None
+
+        assert not predictor.swap(predictor.model_dir, '000')
+        assert predictor.swap(predictor.model_dir, '001')
+        assert len(predictor.predict(TEST_STRING, 10)) <= 10
+
+        # without a model_dir, the promoted checkpoint is loaded
+        assert predict.Predictor().checkpoint == '000'
+
+    def test_predict_embedding(self):
+        train.train('dashm-testing', 0.5, steps_per_epoch=3, epochs=1,
+                    embedding_dim=8)
+        predictor = predict.Predictor('*dashm-testing')
+        assert predictor.sparse
+
+        probs = predictor.predict_proba(TEST_STRING, 40)
+        preds = predictor.predict(TEST_STRING, 20)
+
+        assert probs.shape[0] == 40
+        assert len(preds) <= 20
+
+        assert len(predictor.predict_beam(TEST_STRING, k=2, max_len=10)) <= 2
+        assert len(predictor.predict_sample(TEST_STRING, n=2,
+                                            max_len=10)) == 2
+
     def test_predict_cli(self):
         sys.stdin.read = lambda: TEST_STRING
 
+        # no server is listening, the model is loaded locally
+        sys.argv = ['predict.py', '--socket', '/nonexistent/dashm.sock']
+        f = io.StringIO()
+        with redirect_stdout(f):
+            predict.cli()
+
+        sys.argv = ['predict.py', '--local', '--max-len', '20']
         f = io.StringIO()
         with redirect_stdout(f):
             predict.cli()
+        assert len(f.getvalue()) <= 21
 
     def test_predict_raises_when_not_found(self):
         with pytest.raises(RuntimeError):
@@ -4,9 +4,11 @@ import os
 from pathlib import Path
 import shutil
 import sys
+import subprocess as sp
 
 from dashm.data import get_data
 from dashm.data import process_data
+from dashm.data import dedup
 
 class Test_Process():
     @classmethod
@@ -69,3 +71,216 @@ class Test_Process():
 
         process_data.cli()
         self.assert_processed_correctly()
+
+    def test_process_jobs(self):
+        get_data.clone('https://github.com/kbrose/dashm-testing.git')
+        dst = self.data_path / 'processed-repos/dashm-testing'
+
+        process_data.process('dashm-testing')
+        serial = {f.name: f.read_bytes() for f in dst.glob('*')
+                  if f.name != process_data.MANIFEST}
+        shutil.rmtree(dst)
+
+        sys.argv = ['unused', 'dashm-testing', '--jobs', '3']
+        process_data.cli()
+        parallel = {f.name: f.read_bytes() for f in dst.glob('*')
+                    if f.name != process_data.MANIFEST}
+
+        assert serial == parallel
+
+    def test_process_incremental(self):
+        get_data.clone('https://github.com/kbrose/dashm-testing.git')
+        dst = self.data_path / 'processed-repos/dashm-testing'
+
+        process_data.process('dashm-testing')
+        expected = {f.name: f.read_bytes() for f in dst.glob('*')}
+        done, head = process_data.read_manifest(dst)
+        assert len(done) == len(list(dst.glob('*.diff')))
+        assert head
+
+        # Nothing new, so nothing is re-written.
+        for f in dst.glob('*.diff'):
+            f.unlink()
+        process_data.process('dashm-testing')
+        assert not list(dst.glob('*.diff'))
+
+        # Simulate a crash after the first commit was written.
+        manifest = dst / process_data.MANIFEST
+        with open(manifest) as fp:
+            header, first = fp.readline(), fp.readline()
+        with open(manifest, 'w') as fp:
+            fp.write(header + first)
+        process_data.process('dashm-testing')
+        actual = {f.name: f.read_bytes() for f in dst.glob('*')}
+        assert first.split()[0] + '.diff' not in actual
+        expected.pop(first.split()[0] + '.diff')
+        expected.pop(process_data.MANIFEST)
+        actual.pop(process_data.MANIFEST)
+        assert expected == actual
+
+    def test_process_old_format(self):
+        get_data.clone('https://github.com/kbrose/dashm-testing.git')
+        dst = self.data_path / 'processed-repos/dashm-testing'
+
+        process_data.process('dashm-testing')
+        expected = {f.name: f.read_bytes() for f in dst.glob('*.*')}
+        assert (process_data.manifest_format(dst)
+                == process_data.MANIFEST_FORMAT)
+
+        # A manifest without a format line, HEAD unchanged, and a
+        # commit the current format does not extract.
+        manifest = dst / process_data.MANIFEST
+        with open(manifest) as fp:
+            lines = fp.readlines()[1:]
+        with open(manifest, 'w') as fp:
+            fp.writelines(lines)
+        (dst / ('0' * 40 + '.diff')).write_bytes(b'stale')
+        (dst / ('0' * 40 + '.msg')).write_bytes(b'stale')
+        (dst / 'packed').mkdir()
+        assert process_data.manifest_format(dst) == 1
+
+        process_data.process('dashm-testing')
+        actual = {f.name: f.read_bytes() for f in dst.glob('*.*')}
+        assert not (dst / 'packed').exists()
+        assert expected == actual
+
+    def test_process_dedup(self):
+        get_data.clone('https://github.com/kbrose/dashm-testing.git')
+        dst = self.data_path / 'processed-repos/dashm-testing'
+
+        sys.argv = ['unused', 'dashm-testing', '--no-dedup']
+        process_data.cli()
+        assert not (dst / dedup.DEDUP).exists()
+        shutil.rmtree(dst)
+
+        process_data.process('dashm-testing', near_duplicates=True)
+        index = dedup.read_index(dst)
+        assert set(index) == {f.stem for f in dst.glob('*.diff')}
+
+    def test_first_parent(self, tmpdir):
+        repo = tmpdir.join('first-parent')
+        dst = self.data_path / 'processed-repos/first-parent'
+
+        def git(*args):
+            return sp.check_output(['git', '-c', 'user.name=dashm',
+                                    '-c', 'user.email=dashm@example.com']
+                                   + list(args), cwd=str(repo))
+
+        def commit(msg, **files):
+            for name, content in files.items():
+                repo.join(name).write_binary(content)
+            git('add', '-A')
+            git('commit', '-q', '-m', msg)
+            return git('rev-parse', 'HEAD').decode('ascii').strip()
+
+        repo.mkdir()
+        git('init', '-q', '-b', 'main')
+        root = commit('Root', a=b'a\n')
+        git('checkout', '-q', '-b', 'side')
+        side = commit('Side', b=b'b\n' * 100)
+        git('checkout', '-q', 'main')
+        main = commit('Main', a=b'a\nmain\n', **{'yarn.lock': b'lock\n'})
+        git('merge', '-q', '--no-ff', '-m', 'Merge', 'side')
+        merge = git('rev-parse', 'HEAD').decode('ascii').strip()
+        lock = commit('Lock only', **{'yarn.lock': b'lock 2\n'})
+        binary = commit('Binary', c=b'\0\1\2', a=b'a\nmain\nbinary\n')
+
+        try:
+            process_data.process(str(repo))
+            diffs = {f.stem: f.read_bytes() for f in dst.glob('*.diff')}
+            assert set(diffs) == {side, main, binary}
+            # against the first parent, not the neighbour in `git log`
+            assert b'+main' in diffs[main] and b'b/b' not in diffs[main]
+            assert b'b/b' in diffs[side] and b'main' not in diffs[side]
+            assert b'yarn.lock' not in diffs[main]
+            assert b'Binary' not in diffs[binary]
+            assert b'+binary' in diffs[binary]
+            assert (dst / (main + '.msg')).read_bytes().startswith(b'Main\n')
+            assert not (dst / (lock + '.msg')).exists()
+            done, _ = process_data.read_manifest(dst)
+            assert '{} {}'.format(lock, merge) in done
+
+            shutil.rmtree(dst)
+            process_data.process(str(repo), merges=True, strip_context=True,
+                                 max_diff_bytes=120, keep_binary=True)
+            diffs = {f.stem: f.read_bytes() for f in dst.glob('*.diff')}
+            assert set(diffs) == {side, main, merge, binary}
+            assert b'a/c b/c' in diffs[binary]
+            assert all(len(d) <= 120 and d.endswith(b'\n')
+                       for d in diffs.values())
+            assert root not in diffs
+        finally:
+            shutil.rmtree(dst, ignore_errors=True)
+            try:
+                os.remove(str(dst) + '.dashm')
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def test_filter_diff():
+        diff = (b'diff --git a/x.py b/x.py\n'
+                b'--- a/x.py\n+++ b/x.py\n'
+                b'@@ -1,3 +1,3 @@\n'
+                b' context\n-old\n+new\n'
+                b'diff --git a/gen.py b/gen.py\n'
+                b'new file mode 100644\n'
+                b'--- /dev/null\n+++ b/gen.py\n'
+                b'@@ -0,0 +1 @@\n'
+                b'+# Code generated by protoc. DO NOT EDIT.\n'
+                b'diff --git a/vendor/lib.js b/vendor/lib.js\n'
+                b'--- a/vendor/lib.js\n+++ b/vendor/lib.js\n'
+                b'@@ -1 +1 @@\n'
+                b'+var x;\n')
+        first = diff[:diff.index(b'diff --git a/gen.py')]
+        assert process_data.filter_diff(first) == first
+        assert process_data.filter_diff(diff) == diff[
+            :diff.index(b'diff --git a/gen.py')
+        ] + diff[diff.index(b'diff --git a/vendor'):]
+        assert process_data.filter_diff(diff, exclude=['vendor/*']) == first
+        assert b' context' not in process_data.filter_diff(
+            diff, strip_context=True
+        )
+        assert process_data.filter_diff(diff, max_bytes=40) == (
+            b'diff --git a/x.py b/x.py\n--- a/x.py\n'
+        )
+        assert process_data.filter_diff(b'') == b''
+
+        # a hard cut if there is no line ending to cut at
+        one_line = b'+' + b'x' * 100 + b'\n'
+        assert process_data.filter_diff(one_line, max_bytes=40) == (
+            one_line[:40]
+        )
+
+        # markers only count at the top of added files
+        edited = (b'diff --git a/y.py b/y.py\n'
+                  b'--- a/y.py\n+++ b/y.py\n'
+                  b'@@ -1,2 +1,2 @@\n'
+                  b' # DO NOT EDIT this block by hand\n-old\n+new\n')
+        assert process_data.filter_diff(edited) == edited
+        added = (b'diff --git a/z.py b/z.py\n'
+                 b'new file mode 100644\n'
+                 b'--- /dev/null\n+++ b/z.py\n'
+                 b'@@ -0,0 +1 @@\n'
+                 b'+# do not edit the constants below\n')
+        assert process_data.filter_diff(added) == added
+
+    def test_stream_matches_git(self):
+        get_data.clone('https://github.com/kbrose/dashm-testing.git')
+        repo = self.data_path / 'raw-repos/dashm-testing'
+
+        commits = sp.check_output(['git', 'log', '--pretty=%H'], cwd=repo)
+        commits = commits.decode('ascii').split()
+        pairs = list(zip(commits[:-1], commits[1:]))
+
+        diffs = list(process_data.stream_diffs(repo, pairs))
+        assert [sha for sha, _ in diffs] == commits[:-1]
+        for (new, old), (_, diff) in zip(pairs, diffs):
+            assert diff == sp.check_output(['git', 'diff', old, new],
+                                           cwd=repo)
+
+        msgs = list(process_data.stream_messages(repo, commits))
+        assert [sha for sha, _ in msgs] == commits
+        for sha, msg in msgs:
+            assert msg == sp.check_output(
+                ['git', 'log', '--pretty=%B', '-n', '1', sha], cwd=repo
+            )
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+
+from dashm import profiling
+
+
+class Test_Profiling():
+    @classmethod
+    def setup_method(cls):
+        cls.__old_profiler = profiling.disable()
+
+    @classmethod
+    def teardown_method(cls):
+        profiling.disable()
+        if cls.__old_profiler is not None:
+            profiling._profiler = cls.__old_profiler
+
+    @staticmethod
+    def test_disabled():
+        assert profiling.active() is None
+        assert profiling.timer('a') is profiling.timer('b')
+        with profiling.timer('a'):
+            pass
+        profiling.count('a')
+        assert profiling.active() is None
+
+    @staticmethod
+    def test_enabled():
+        profiler = profiling.enable()
+        assert profiling.enable() is profiler
+        for _ in range(3):
+            with profiling.timer('load.read'):
+                pass
+        profiling.count('process.commits', 5)
+        profiling.count('process.commits')
+
+        summary = profiler.summary()
+        read = summary['timers']['load.read']
+        assert read['count'] == 3
+        assert 0 <= read['mean_ms'] <= read['max_ms']
+        assert read['total_sec'] * 1000 >= read['max_ms']
+        assert summary['counters'] == {'process.commits': 6}
+
+        assert profiling.disable() is profiler
+        with profiling.timer('load.read'):
+            pass
+        assert profiler.summary()['timers']['load.read']['count'] == 3
+
+        profiler.reset()
+        assert profiler.summary() == {'timers': {}, 'counters': {}}
+
+    @staticmethod
+    def test_threads():
+        profiler = profiling.Profiler()
+
+        def work():
+            for _ in range(1000):
+                profiler.count('n')
+                with profiler.timer('t'):
+                    pass
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert profiler.counter('n') == 4000
+        assert profiler.summary()['timers']['t']['count'] == 4000
+
+    @staticmethod
+    def test_write(tmpdir):
+        profiler = profiling.Profiler()
+        with profiler.timer('predict.encode'):
+            pass
+        profiler.count('predict.cache_hits', 2)
+
+        path = str(tmpdir.join('profile.json'))
+        profiler.write_json(path)
+        with open(path) as f:
+            assert json.load(f) == profiler.summary()
+
+        profiler.write_tensorboard(str(tmpdir.join('logs')), step=0)
+        profiler.write_tensorboard(str(tmpdir.join('logs')), step=1)
+        # a single events file
+        assert len(tmpdir.join('logs').listdir()) == 1
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import io
+import json
+import shutil
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+import pytest
+
+from dashm.models import registry
+
+
+class Test_Registry():
+    @classmethod
+    def setup_method(cls):
+        cls.__old_sys_argv = sys.argv
+        cls.saved = Path(tempfile.mkdtemp())
+        for run in ['run-a', 'run-b']:
+            (cls.saved / run).mkdir()
+        cls.registry = registry.Registry(cls.saved)
+
+    @classmethod
+    def teardown_method(cls):
+        sys.argv = cls.__old_sys_argv
+        shutil.rmtree(cls.saved)
+
+    def test_register_and_promote(self):
+        assert self.registry.read() == {'runs': {}, 'promoted': None}
+        self.registry.register('run-a', '000', {'val_loss': 3.0},
+                               {'embedding_dim': 0})
+        self.registry.register('run-a', '001', {'val_loss': 2.0})
+        self.registry.register('run-b', '000', {'val_loss': 2.5})
+        self.registry.register('run-b', 'interrupted')
+
+        runs = self.registry.read()['runs']
+        assert sorted(runs) == ['run-a', 'run-b']
+        assert runs['run-a']['config'] == {'embedding_dim': 0}
+        assert sorted(runs['run-a']['checkpoints']) == ['000', '001']
+
+        best = self.registry.best('val_loss')
+        assert (best['run'], best['checkpoint']) == ('run-a', '001')
+        worst = self.registry.best('val_loss', mode='max')
+        assert (worst['run'], worst['checkpoint']) == ('run-a', '000')
+        assert self.registry.best('accuracy') is None
+
+        assert self.registry.promoted() is None
+        # an interrupted run is saved after its last epoch
+        promoted = self.registry.promote('run-b')
+        assert promoted['checkpoint'] == 'interrupted'
+        self.registry.promote('run-b', '000')
+        assert self.registry.promoted()['checkpoint'] == '000'
+        with pytest.raises(KeyError):
+            self.registry.promote('run-c')
+        with pytest.raises(KeyError):
+            self.registry.promote('run-a', '002')
+
+        # deleted runs disappear from the registry
+        shutil.rmtree(self.saved / 'run-b')
+        index = self.registry.read()
+        assert sorted(index['runs']) == ['run-a']
+        assert index['promoted'] is None
+
+    def test_watcher(self):
+        promotions = []
+        watcher = registry.Watcher(promotions.append, self.registry,
+                                   interval=0.01)
+        assert not watcher.check()
+
+        self.registry.register('run-a', '000')
+        self.registry.register('run-a', '001')
+        assert not watcher.check()
+
+        self.registry.promote('run-a', '000')
+        assert watcher.check()
+        assert not watcher.check()
+        self.registry.promote('run-a', '000')
+        assert not watcher.check()  # same checkpoint
+        self.registry.promote('run-a', '001')
+        assert watcher.check()
+        assert [p['checkpoint'] for p in promotions] == ['000', '001']
+
+        # a failed swap is retried by the next check
+        def fail_once(promoted):
+            if not failed:
+                failed.append(promoted)
+                raise OSError('half-written checkpoint')
+            promotions.append(promoted)
+
+        failed = []
+        watcher.callback = fail_once
+        self.registry.promote('run-a', '000')
+        with pytest.raises(OSError):
+            watcher.check()
+        assert watcher.check()
+        assert promotions[-1]['checkpoint'] == '000'
+
+        watcher.start()
+        watcher.stop()
+        assert not watcher.is_alive()
+
+    def test_cli(self, monkeypatch):
+        monkeypatch.setattr(registry, 'SAVED', self.saved)
+        self.registry.register('run-a', '000', {'val_loss': 1.0})
+        self.registry.register('run-b', '000', {'val_loss': 2.0})
+
+        sys.argv = ['registry.py', 'promote', '--best', 'val_loss']
+        with redirect_stdout(io.StringIO()):
+            registry.cli()
+        assert self.registry.promoted()['run'] == 'run-a'
+
+        sys.argv = ['registry.py', 'promote', 'run-b']
+        with redirect_stdout(io.StringIO()):
+            registry.cli()
+        assert self.registry.promoted()['run'] == 'run-b'
+
+        sys.argv = ['registry.py', 'list']
+        f = io.StringIO()
+        with redirect_stdout(f):
+            registry.cli()
+        assert json.loads(f.getvalue())['promoted']['run'] == 'run-b'
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from contextlib import redirect_stdout
+
+import pytest
+
+from dashm.models import serve
+from dashm.models import predict
+
+
+class _EchoPredictor():
+    """
+    Stands in for `Predictor`, recording the batches it is given.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def predict_batch(self, diffs, max_len=300):
+        self.release.wait()
+        diffs = [predict._to_bytes(d) for d in diffs]
+        self.batches.append(diffs)
+        if b'fail' in diffs:
+            raise ValueError('cannot predict')
+        return [d.upper()[:max_len] for d in diffs]
+
+
+class _LocalPredictor():
+    def predict(self, diff, max_len=300):
+        return b'local'
+
+
+class Test_Serve():
+    @classmethod
+    def setup_method(cls):
+        cls.__old_sys_argv = sys.argv
+        cls.__old_sys_stdin = sys.stdin
+        cls.tmp = Path(tempfile.mkdtemp())
+        cls.predictor = _EchoPredictor()
+
+    @classmethod
+    def teardown_method(cls):
+        sys.argv = cls.__old_sys_argv
+        sys.stdin = cls.__old_sys_stdin
+        shutil.rmtree(cls.tmp)
+
+    def _start(self, **kwargs):
+        server = serve.make_server(self.predictor, **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+    def _stop(self, server):
+        server.shutdown()
+        server.server_close()
+        server.batcher.close()
+
+    def test_micro_batching(self):
+        batcher = serve.MicroBatcher(self.predictor, max_batch_size=3,
+                                     max_wait=10.0)
+        self.predictor.release.clear()
+        futures = [batcher.submit(b'first')]
+        futures += [batcher.submit(d, 3) for d in [b'abcd', b'efgh']]
+        futures += [batcher.submit(d) for d in [b'ijkl', b'mnop', b'qrst']]
+        self.predictor.release.set()
+
+        assert [f.result(timeout=10) for f in futures] == [
+            b'FIRST', b'ABC', b'EFG', b'IJKL', b'MNOP', b'QRST'
+        ]
+        # full batches of 3, each split by max_len
+        assert self.predictor.batches == [
+            [b'first'], [b'abcd', b'efgh'], [b'ijkl', b'mnop', b'qrst']
+        ]
+
+        batcher.max_wait = 0.0
+        with pytest.raises(ValueError):
+            batcher.submit(b'fail').result(timeout=10)
+        batcher.close()
+
+    def test_unix_socket(self, monkeypatch):
+        socket_path = self.tmp / 'dashm.sock'
+        server = self._start(socket_path=socket_path, max_wait=0.05)
+        try:
+            with pytest.raises(RuntimeError):
+                serve.make_server(self.predictor, socket_path=socket_path)
+
+            results = {}
+
+            def ask(diff):
+                results[diff] = serve.request(diff, socket_path=socket_path)
+
+            threads = [threading.Thread(target=ask, args=(d,))
+                       for d in [b'a', b'b', b'c', b'd']]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert results == {b'a': b'A', b'b': b'B', b'c': b'C', b'd': b'D'}
+            assert len(self.predictor.batches) < 4
+
+            assert serve.request('str', socket_path=socket_path) == b'STR'
+            with pytest.raises(RuntimeError):
+                serve.request(b'fail', socket_path=socket_path)
+
+            # the thin client asks the server
+            sys.stdin = io.StringIO('from stdin')
+            sys.argv = ['predict.py', '--socket', str(socket_path)]
+            f = io.StringIO()
+            with redirect_stdout(f):
+                predict.cli()
+            assert f.getvalue() == 'FROM STDIN\n'
+
+            # and predicts locally if the server fails
+            monkeypatch.setattr(predict, 'Predictor', _LocalPredictor)
+            sys.stdin = io.StringIO('fail')
+            f = io.StringIO()
+            with redirect_stdout(f):
+                predict.cli()
+            assert f.getvalue() == 'local\n'
+        finally:
+            self._stop(server)
+        assert not socket_path.exists()
+
+        with pytest.raises(OSError):
+            serve.request(b'a', socket_path=socket_path)
+
+    def test_stale_socket(self):
+        socket_path = self.tmp / 'dashm.sock'
+        server = self._start(socket_path=socket_path)
+        server.shutdown()
+        server.socket.close()  # leaves the socket file behind
+        server.batcher.close()
+        assert socket_path.exists()
+
+        server = self._start(socket_path=socket_path)
+        try:
+            assert serve.request(b'a', socket_path=socket_path) == b'A'
+        finally:
+            self._stop(server)
+
+    def test_http(self):
+        server = self._start(port=0)
+        port = server.server_address[1]
+        try:
+            assert serve.request(b'abc', 2, port=port) == b'AB'
+            with pytest.raises(RuntimeError):
+                serve.request(b'fail', port=port)
+        finally:
+            self._stop(server)
+
+    def test_default_socket(self, monkeypatch):
+        socket_path = self.tmp / 'private' / 'dashm.sock'
+        monkeypatch.setattr(serve, 'DEFAULT_SOCKET', socket_path)
+        server = self._start()
+        try:
+            assert socket_path.parent.stat().st_mode & 0o777 == 0o700
+            assert serve.request(b'a') == b'A'
+
+            # never send a diff to another user's socket
+            uid = os.getuid()
+            monkeypatch.setattr(os, 'getuid', lambda: uid + 1)
+            with pytest.raises(PermissionError):
+                serve.request(b'a')
+        finally:
+            self._stop(server)
+
+        # nor listen in a folder others can access
+        socket_path.parent.chmod(0o755)
+        with pytest.raises(RuntimeError):
+            serve.make_server(self.predictor)
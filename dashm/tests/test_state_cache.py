@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import pytest
+
+from dashm.models import state_cache
+
+
+class Test_StateCache():
+    @classmethod
+    def setup_method(cls):
+        cls.path = Path(tempfile.mkdtemp())
+
+    @classmethod
+    def teardown_method(cls):
+        shutil.rmtree(cls.path)
+
+    def test_lru(self):
+        cache = state_cache.StateCache('weights', maxsize=2)
+        keys = [state_cache.diff_key(d) for d in [b'a', b'b', b'c']]
+        assert len(set(keys)) == 3
+
+        stored = cache.put(keys[0], np.zeros((1, 4)))
+        assert not stored.flags.writeable
+        cache.put(keys[1], np.ones((1, 4)))
+        assert cache.get(keys[0]) is stored  # now the most recent
+        cache.put(keys[2], np.ones((1, 4)))
+
+        assert len(cache) == 2
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[0]) is stored
+        assert (cache.hits, cache.misses) == (2, 1)
+
+        with pytest.raises(ValueError):
+            stored[0, 0] = 1
+
+    def test_disk(self):
+        key = state_cache.diff_key(b'diff')
+        state = np.arange(4, dtype=np.float32)[None]
+
+        cache = state_cache.StateCache('weights', path=self.path)
+        cache.put(key, state)
+
+        reloaded = state_cache.StateCache('weights', maxsize=0,
+                                          path=self.path)
+        np.testing.assert_array_equal(reloaded.get(key), state)
+        assert len(reloaded) == 0
+
+        # new weights have their own store, the old one stays usable
+        changed = state_cache.StateCache('other', path=self.path)
+        assert changed.get(key) is None
+        assert sorted(p.name for p in self.path.iterdir()) == ['other',
+                                                               'weights']
+
+        # until pruned
+        changed.prune()
+        assert [p.name for p in self.path.iterdir()] == ['other']
+        other_key = state_cache.diff_key(b'other')
+        cache.put(other_key, state)  # only in memory now
+        np.testing.assert_array_equal(cache.get(other_key), state)
+
+        cache = state_cache.StateCache('other', path=self.path)
+        cache.put(key, state)
+        cache.clear()
+        assert cache.get(key) is None
+
+    def test_threads(self):
+        cache = state_cache.StateCache('weights', maxsize=8, path=self.path)
+        keys = [state_cache.diff_key(bytes([i])) for i in range(32)]
+
+        def work(offset):
+            for i in range(200):
+                key = keys[(i + offset) % len(keys)]
+                if cache.get(key) is None:
+                    cache.put(key, np.full((1, 4), (i + offset) % 32))
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(cache) == 8
+        assert cache.hits + cache.misses == 800
+
+    def test_fingerprint(self):
+        weights = self.path / 'weights'
+        weights.write_bytes(b'1234')
+        before = state_cache.fingerprint([weights])
+        assert before == state_cache.fingerprint([weights])
+        weights.write_bytes(b'1235')
+        assert before != state_cache.fingerprint([weights])
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from dashm.data import tokenizer
+from dashm.data.encode import encode_diff, encode_msg, PAD
+
+DIFF = (b'diff --git a/dashm/data/load.py b/dashm/data/load.py\n'
+        b'--- a/dashm/data/load.py\n'
+        b'+++ b/dashm/data/load.py\n'
+        b'@@ -1,3 +1,4 @@\n'
+        b'-    return encode_diff(x)\n'
+        b'+    return encode_diff(x, tokenizer)\n')
+
+
+class Test_Tokenizer():
+    @staticmethod
+    def test_fit():
+        tok = tokenizer.fit([DIFF] * 10, vocab_size=200)
+        assert PAD < tokenizer.FIRST_MERGE < tok.vocab_size <= 200
+
+        ids = tok.encode(DIFF)
+        assert ids.dtype == np.uint16
+        assert len(ids) * 2 < len(DIFF)
+        assert tok.decode(ids) == DIFF
+        assert not (ids == PAD).any()
+
+    @staticmethod
+    def test_no_merges():
+        tok = tokenizer.Tokenizer([])
+        assert tok.vocab_size == PAD + 1
+        assert (tok.encode_diff(b'abc\x00\xff')
+                == encode_diff(b'abc\x00\xff')).all()
+        assert (tok.encode_msg(b'abc') == encode_msg(b'abc')).all()
+
+    @staticmethod
+    def test_markers():
+        tok = tokenizer.fit([DIFF] * 10, vocab_size=200)
+        x = tok.encode_diff(DIFF, max_len=5)
+        assert len(x) == 6 and x[-1] == 1
+        y = tok.encode_msg(b'Fix the load function', max_len=3)
+        assert len(y) == 5 and y[0] == 0 and y[-1] == 1
+        assert tok.decode(tok.encode_msg(b'Fix')[1:-1]) == b'Fix'
+
+    @staticmethod
+    def test_save_load(tmpdir):
+        tok = tokenizer.fit([DIFF] * 10, vocab_size=200)
+        path = str(tmpdir.join(tokenizer.TOKENIZER_FILE))
+        tok.save(path)
+        loaded = tokenizer.Tokenizer.load(path)
+        assert loaded.merges == tok.merges
+        assert (loaded.encode(DIFF) == tok.encode(DIFF)).all()
+
+    @staticmethod
+    def test_bad_vocab_size():
+        with pytest.raises(ValueError):
+            tokenizer.fit([DIFF], vocab_size=PAD)
@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
 from pathlib import Path
 import shutil
 import sys
 
+import pytest
+
+from dashm import profiling
 from dashm.data import get_data
 from dashm.data import process_data
+from dashm.data import multi
 from dashm.models import train
+from dashm.models.predict import Predictor
 
 
 class Test_Train():
@@ -73,6 +79,91 @@ class Test_Train():
             assert 'encoder.h5' in all_filenames
             assert 'decoder.h5' in all_filenames
 
+    def test_train_bucketed(self):
+        train.train('dashm-testing', 0.5, bucketed=True, epochs=2)
+
+        saved_folders = list(self.models_path.glob('*dashm-testing'))
+        assert saved_folders
+
+        for folder in saved_folders:
+            all_filenames = [os.path.split(f)[-1]
+                             for f in Path(folder).glob('*')]
+            assert 'trainer.h5' in all_filenames
+            assert 'encoder.h5' in all_filenames
+            assert 'decoder.h5' in all_filenames
+
+    def test_train_bptt(self):
+        train.train('dashm-testing', 0.5, bucketed=True, epochs=1,
+                    max_diff_len=300, bptt_steps=100)
+        train.train('dashm-testing', 0.5, steps_per_epoch=2, epochs=1,
+                    max_diff_len=300, bptt_steps=100, embedding_dim=4)
+
+        with pytest.raises(ValueError):
+            train.train('dashm-testing', 0.5, max_diff_len=100,
+                        bptt_steps=100)
+
+    def test_train_tokenizer(self):
+        train.train('dashm-testing', 0.5, steps_per_epoch=2, epochs=1,
+                    embedding_dim=4, vocab_size=300, max_diff_len=100)
+
+        folder, = self.models_path.glob('*dashm-testing')
+        assert (folder / 'tokenizer.json').exists()
+        p = Predictor(folder.name)
+        vocab_size = p._model.tokenizer.vocab_size
+        assert p.predict_proba(b'diff', n=3).shape[-1] == vocab_size
+        msg = p.predict(b'diff --git a/README b/README', max_len=10)
+        assert isinstance(msg, bytes)
+        assert p.predict_batch([b'diff', b'diff'], max_len=10)[0] == (
+            p.predict(b'diff', max_len=10)
+        )
+        assert b''.join(p.predict_stream(b'diff', max_len=10)) == (
+            p.predict(b'diff', max_len=10)
+        )
+
+        with pytest.raises(ValueError):
+            train.train('dashm-testing', 0.5, vocab_size=300)
+
+    def test_train_profile(self):
+        train.train('dashm-testing', 0.5, steps_per_epoch=3, epochs=2,
+                    profile=True)
+        assert profiling.active() is None
+
+        folder, = self.models_path.glob('*dashm-testing')
+        with open(folder / 'profile.json') as f:
+            profile = json.load(f)
+        assert profile['timers']['train.batch']['count'] == 6
+        assert profile['timers']['datagen.batch']['count'] >= 6
+        assert profile['timers']['load.read']['count'] > 0
+        assert profile['counters']['train.batches'] == 6
+        assert (0 <= profile['counters'].get('train.starved_batches', 0)
+                <= 6)
+        assert list((folder / 'logs' / 'profile').glob('events.*'))
+
+    def test_train_multi(self, tmpdir):
+        manifest = str(tmpdir.join('dashm-testing.json'))
+        multi.write_manifest(manifest, ['dashm-testing', 'dashm-testing'],
+                             [1.0, 3.0])
+        train.train(manifest, 0.5, steps_per_epoch=2, epochs=1, val_size=8)
+        train.train(manifest, 0.5, workers=2, epochs=1)
+
+        saved_folders = list(self.models_path.glob('*dashm-testing'))
+        assert len(saved_folders) == 2
+        for folder in saved_folders:
+            assert (folder / 'trainer.h5').exists()
+
+    def test_train_workers(self):
+        train.train('dashm-testing', 0.5, workers=2, epochs=2)
+
+        saved_folders = list(self.models_path.glob('*dashm-testing'))
+        assert saved_folders
+
+        for folder in saved_folders:
+            all_filenames = [os.path.split(f)[-1]
+                             for f in Path(folder).glob('*')]
+            assert 'trainer.h5' in all_filenames
+            assert 'encoder.h5' in all_filenames
+            assert 'decoder.h5' in all_filenames
+
     def test_cli(self):
         sys.argv = ['train.py', 'dashm-testing', '0.5', '--steps_per_epoch',
                     '3', '--epochs', '1']